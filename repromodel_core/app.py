@@ -306,7 +306,7 @@ def kill_training_process():
 
     try:        
 
-        # Kill the training process.
+        # Kill the training process. pkill sends SIGTERM; during training epochs the trainer then saves latest checkpoints before exiting.
         subprocess.run(['pkill', '-f', 'trainer.py'])
         app.logger.info("Process with name 'trainer' killed successfully.")
 
@@ -321,6 +321,73 @@ def kill_training_process():
         return jsonify({'error': error_message}), 500
 
 
+# POST /submit-sweep-config-start-sweep
+# Description: Start a hyperparameter sweep from frontend.
+@app.route('/submit-sweep-config-start-sweep', methods=['POST'])
+def submit_sweep_config_start_sweep():
+    try:
+
+        # Get JSON data from the request.
+        data = request.get_json()
+
+        if not data:
+            error_message = "No data provided in request."
+            app.logger.error(error_message)
+
+            # Return HTTP 400 Bad Request status code.
+            return jsonify({'error': error_message}), 400
+
+        # Convert the JSON data to a string to pass as an argument.
+        json_data = json.dumps(data)
+        app.logger.info("Received sweep JSON data for processing.")
+
+        # Run the script sweeper.py, which starts the trainer processes of the trials.
+        command = ['python', 'repromodel_core/sweeper.py', json_data]
+        result = subprocess.run(command, capture_output=True, text=True)
+
+        # Check the subprocess result.
+        if result.returncode == 0:
+            app.logger.info("Sweep executed successfully with output: %s", result.stdout)
+            return jsonify({'output': result.stdout, 'error': None})
+
+        else:
+            error_detail = f"Sweep has been stopped: {result.stderr}"
+            app.logger.error(error_detail)
+
+            # Return HTTP 400 Bad Request status code.
+            return jsonify({'output': result.stdout, 'error': error_detail}), 400
+
+    except Exception as e:
+        error_message = f"An internal error occurred: {str(e)}"
+        app.logger.exception(error_message)
+
+        # Return HTTP 500 Internal Server Error status code.
+        return jsonify({'error': error_message}), 500
+
+
+# POST /kill-sweep-process
+# Description: Kill the sweep started from frontend together with its trials.
+@app.route('/kill-sweep-process', methods=['POST'])
+def kill_sweep_process():
+
+    try:
+
+        # Kill the sweep first so that it does not start new trials.
+        subprocess.run(['pkill', '-f', 'sweeper.py'])
+        subprocess.run(['pkill', '-f', 'trainer.py'])
+        app.logger.info("Process with name 'sweeper' killed successfully.")
+
+        return jsonify({'message': "Process with name 'sweeper' killed successfully."})
+
+    except Exception as e:
+
+        error_message = f"An internal error occurred: {str(e)}"
+        app.logger.exception(error_message)
+
+        # Return HTTP 500 Internal Server Error status code.
+        return jsonify({'error': error_message}), 500
+
+
 # POST /copy-covered-files
 # Description:
 @app.route('/copy-covered-files', methods=['POST'])
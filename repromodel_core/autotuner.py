@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import torch
+from trainer import train
+from src.autotune import save_tuning
+from src.utils import print_to_file
+
+# Standalone throughput autotuning: tunes threads and DataLoader workers for every model of a
+# training config and caches the fastest setting, which training runs with autotune 'cached' then
+# apply. Inter-op threads can only be set once per process, so every inter-op thread count is tried
+# in its own process.
+def autotune_command(input_data, interop_options=None):
+    if isinstance(input_data, dict):
+        config = input_data
+    elif os.path.isfile(input_data):
+        with open(input_data, 'r') as f:
+            config = json.load(f)
+    else:
+        config = json.loads(input_data)
+    cache_path = config.get("autotune_cache_path", "repromodel_core/cache/autotune.json")
+    cpu_count = os.cpu_count() or 1
+    interop_options = interop_options or sorted({1, 2, max(1, cpu_count // 2)})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Every process keeps its result in a scratch cache only if it is faster than the ones before
+        trial_config = dict(config, autotune_cache_path=os.path.join(tmp_dir, "autotune.json"))
+        for num_interop_threads in interop_options:
+            print_to_file(f"Autotuning with {num_interop_threads} inter-op threads")
+            subprocess.run([sys.executable, os.path.abspath(__file__), json.dumps(trial_config),
+                            "--interop-threads", str(num_interop_threads)])
+        if not os.path.exists(trial_config['autotune_cache_path']):
+            raise RuntimeError("No autotuning trial finished")
+        with open(trial_config['autotune_cache_path'], 'r') as f:
+            results = json.load(f)
+    for key, settings in results.items():
+        save_tuning(cache_path, key, settings)
+        print_to_file(f"{key}: {settings['num_threads']} threads, {settings['num_interop_threads']} inter-op threads, "
+                      f"{settings['num_workers']} workers, {settings['samples_per_second']:.1f} samples/s")
+    return results
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser(description='Tune threads and DataLoader workers for a training config')
+        parser.add_argument('input_data', type=str, help='Path to the JSON request file or JSON string')
+        parser.add_argument('--interop-threads', type=int, default=None,
+                            help='Run the trials of a single inter-op thread count in this process')
+        args = parser.parse_args()
+    except:
+        print_to_file("Parsing arguments failed")
+
+    try:
+        if args.interop_threads is None:
+            autotune_command(args.input_data)
+        else:
+            torch.set_num_interop_threads(args.interop_threads)
+            train(args.input_data, autotune_only=True)
+    except Exception as e:
+        print_to_file(f"Autotuning failed. Exiting with an error: {e}")
@@ -455,6 +455,446 @@ if __name__ == "__main__":
     }
 
 
+    ######################################################################
+    # Key: num_workers
+    # Description: Number of DataLoader worker processes.
+    ######################################################################
+
+    json_obj["num_workers"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 64)"
+    }
+
+
+    ######################################################################
+    # Key: preprocessing_mode
+    # Description: Preprocess the dataset upfront or per sample inside the DataLoader.
+    ######################################################################
+
+    json_obj["preprocessing_mode"] = {
+        "type": "str",
+        "default": "offline",
+        "options": "['offline', 'on_the_fly']"
+    }
+
+
+    ######################################################################
+    # Key: preprocessing_cache
+    # Description: Write samples preprocessed on the fly to a cache folder.
+    ######################################################################
+
+    json_obj["preprocessing_cache"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: augmentation_mode
+    # Description: Augment per sample in the dataset or per batch after loading.
+    ######################################################################
+
+    json_obj["augmentation_mode"] = {
+        "type": "str",
+        "default": "sample",
+        "options": "['sample', 'batch']"
+    }
+
+
+    ######################################################################
+    # Key: echo_factor
+    # Description: Number of times each loaded training sample is reused (1 disables data echoing).
+    ######################################################################
+
+    json_obj["echo_factor"] = {
+        "type": "int",
+        "default": 1,
+        "range": "(1, 16)"
+    }
+
+
+    ######################################################################
+    # Key: echo_buffer_size
+    # Description: Shuffle buffer size for data echoing in samples (0 uses four batches).
+    ######################################################################
+
+    json_obj["echo_buffer_size"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 100000)"
+    }
+
+
+    ######################################################################
+    # Key: transform_cache
+    # Description: Cache the deterministic part of the augmentation per sample.
+    ######################################################################
+
+    json_obj["transform_cache"] = {
+        "type": "str",
+        "default": "none",
+        "options": "['none', 'memory', 'disk']"
+    }
+
+
+    ######################################################################
+    # Key: cache_path
+    # Description: Location of on-disk caches.
+    ######################################################################
+
+    json_obj["cache_path"] = {
+        "type": "str",
+        "default": "repromodel_core/cache/"
+    }
+
+
+    ######################################################################
+    # Key: fold_cache
+    # Description: Where cross-validation indices are kept and reused.
+    ######################################################################
+
+    json_obj["fold_cache"] = {
+        "type": "str",
+        "default": "disk",
+        "options": "['memory', 'disk', 'mmap']"
+    }
+
+
+    ######################################################################
+    # Key: val_batch_cache
+    # Description: Keep the collated validation batches after the first epoch.
+    ######################################################################
+
+    json_obj["val_batch_cache"] = {
+        "type": "str",
+        "default": "none",
+        "options": "['none', 'memory', 'disk']"
+    }
+
+
+    ######################################################################
+    # Key: val_cache_budget_mb
+    # Description: Maximum size of the cached validation batches per fold.
+    ######################################################################
+
+    json_obj["val_cache_budget_mb"] = {
+        "type": "int",
+        "default": 1024,
+        "range": "(1, 1048576)"
+    }
+
+
+    ######################################################################
+    # Key: val_every_epochs
+    # Description: Validate every N epochs (ignored if val_every_steps is set).
+    ######################################################################
+
+    json_obj["val_every_epochs"] = {
+        "type": "int",
+        "default": 1,
+        "range": "(1, 1000)"
+    }
+
+
+    ######################################################################
+    # Key: val_every_steps
+    # Description: Validate every M optimizer steps instead of per epoch; 0 disables.
+    ######################################################################
+
+    json_obj["val_every_steps"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 10000000)"
+    }
+
+
+    ######################################################################
+    # Key: val_subsample
+    # Description: Fraction of the validation set used, stratified by class if possible.
+    ######################################################################
+
+    json_obj["val_subsample"] = {
+        "type": "float",
+        "default": 1.0,
+        "range": "(0.01, 1.0)"
+    }
+
+
+    ######################################################################
+    # Key: full_val_every
+    # Description: With subsampling, every n-th validation uses the full set; 0 never.
+    ######################################################################
+
+    json_obj["full_val_every"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 1000)"
+    }
+
+
+    ######################################################################
+    # Key: async_validation
+    # Description: Validate weight snapshots in a separate CPU process while training continues.
+    ######################################################################
+
+    json_obj["async_validation"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: async_val_threads
+    # Description: Number of CPU threads of the asynchronous validation process.
+    ######################################################################
+
+    json_obj["async_val_threads"] = {
+        "type": "int",
+        "default": 1,
+        "range": "(1, 64)"
+    }
+
+
+    ######################################################################
+    # Key: lockstep_models
+    # Description: Train all models together on the same batches, loading the data once per fold.
+    ######################################################################
+
+    json_obj["lockstep_models"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: vmap_ensemble
+    # Description: Train variants of one model as a single vectorised computation.
+    ######################################################################
+
+    json_obj["vmap_ensemble"] = {
+        "mode": {
+            "type": "str",
+            "default": "none",
+            "options": "['none', 'hyperparameters', 'folds']"
+        },
+        "member_params": {
+            "type": "str",
+            "default": ""
+        }
+    }
+
+
+    ######################################################################
+    # Key: distributed
+    # Description: Data-parallel training over the processes started by torchrun (gloo backend).
+    ######################################################################
+
+    json_obj["distributed"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: cv_racing
+    # Description: Stop training the remaining folds of models that are significantly worse than the best model so far.
+    ######################################################################
+
+    json_obj["cv_racing"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: cv_racing_alpha
+    # Description: Significance level of the paired t-test deciding that a model is out of contention.
+    ######################################################################
+
+    json_obj["cv_racing_alpha"] = {
+        "type": "float",
+        "default": 0.05,
+        "range": "(0.001, 0.5)"
+    }
+
+
+    ######################################################################
+    # Key: cv_racing_min_folds
+    # Description: Folds a model completes before it can be abandoned.
+    ######################################################################
+
+    json_obj["cv_racing_min_folds"] = {
+        "type": "int",
+        "default": 2,
+        "range": "(2, 20)"
+    }
+
+
+    ######################################################################
+    # Key: memoize_runs
+    # Description: Reuse checkpoints and test metrics of (model, fold) units already trained with an identical config, data and code.
+    ######################################################################
+
+    json_obj["memoize_runs"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: run_index_path
+    # Description: Folder of the local index of trained units.
+    ######################################################################
+
+    json_obj["run_index_path"] = {
+        "type": "str",
+        "default": "repromodel_core/run_index/"
+    }
+
+
+    ######################################################################
+    # Key: latest_checkpoint_every_steps
+    # Description: Save the complete training state every n optimizer steps so that training continues from there; 0 disables.
+    ######################################################################
+
+    json_obj["latest_checkpoint_every_steps"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 100000)"
+    }
+
+
+    ######################################################################
+    # Key: latest_checkpoint_every_minutes
+    # Description: Save the complete training state every n minutes; 0 disables. SIGTERM always saves it before exiting.
+    ######################################################################
+
+    json_obj["latest_checkpoint_every_minutes"] = {
+        "type": "float",
+        "default": 0,
+        "range": "(0, 1440)"
+    }
+
+
+    ######################################################################
+    # Key: auto_batch_size
+    # Description: Before training, probe the largest batch size that trains within the memory budget and use it instead of batch_size.
+    ######################################################################
+
+    json_obj["auto_batch_size"] = {
+        "type": "bool",
+        "default": False
+    }
+
+
+    ######################################################################
+    # Key: batch_size_memory_budget_mb
+    # Description: Memory budget of the batch size finder (device memory on CUDA, memory added to the process on CPU), split between models or members trained at the same time; 0 uses 90% of the GPU or 80% of the available RAM.
+    ######################################################################
+
+    json_obj["batch_size_memory_budget_mb"] = {
+        "type": "int",
+        "default": 0,
+        "range": "(0, 1048576)"
+    }
+
+
+    ######################################################################
+    # Key: max_auto_batch_size
+    # Description: Largest batch size the batch size finder considers.
+    ######################################################################
+
+    json_obj["max_auto_batch_size"] = {
+        "type": "int",
+        "default": 1024,
+        "range": "(1, 65536)"
+    }
+
+
+    ######################################################################
+    # Key: lr_scaling
+    # Description: Adapt the learning rate to the batch size chosen by the batch size finder.
+    ######################################################################
+
+    json_obj["lr_scaling"] = {
+        "type": "str",
+        "default": "none",
+        "options": "['none', 'linear', 'sqrt']"
+    }
+
+
+    ######################################################################
+    # Key: autotune
+    # Description: Tune intra-op threads and DataLoader workers for throughput: cached reuses the setting cached for this host, models, dataset and batch size, always tunes anew.
+    ######################################################################
+
+    json_obj["autotune"] = {
+        "type": "str",
+        "default": "off",
+        "options": "['off', 'cached', 'always']"
+    }
+
+
+    ######################################################################
+    # Key: autotune_batches
+    # Description: Timed training steps per autotuning trial.
+    ######################################################################
+
+    json_obj["autotune_batches"] = {
+        "type": "int",
+        "default": 20,
+        "range": "(5, 500)"
+    }
+
+
+    ######################################################################
+    # Key: autotune_cache_path
+    # Description: File in which the autotuned settings are cached.
+    ######################################################################
+
+    json_obj["autotune_cache_path"] = {
+        "type": "str",
+        "default": "repromodel_core/cache/autotune.json"
+    }
+
+
+    ######################################################################
+    # Key: target_encoding
+    # Description: Expansion of compact targets per batch; auto uses the dataset's.
+    ######################################################################
+
+    json_obj["target_encoding"] = {
+        "type": "str",
+        "default": "auto",
+        "options": "['auto', 'one_hot', 'complement', 'none']"
+    }
+
+
+    ######################################################################
+    # Key: label_smoothing
+    # Description: Label smoothing applied to the encoded targets.
+    ######################################################################
+
+    json_obj["label_smoothing"] = {
+        "type": "float",
+        "default": 0.0,
+        "range": "(0.0, 1.0)"
+    }
+
+
+    ######################################################################
+    # Key: target_dtype
+    # Description: Data type of the encoded targets.
+    ######################################################################
+
+    json_obj["target_dtype"] = {
+        "type": "str",
+        "default": "float32",
+        "options": "['float32', 'float16', 'float64']"
+    }
+
+
     ######################################################################
     # Key: model_save_path
     # Description: Output location for model.
@@ -0,0 +1,117 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# Vectorised augmentations applied to whole collated batches of tensors (B x C x H x W).
+# Every function takes and returns (inputs, targets) and draws its random parameters per
+# sample, so a batch gets the same variety as per-sample augmentation. Targets are only
+# transformed geometrically if they are spatial, i.e. their last two dimensions match the
+# inputs (masks of shape B x H x W or B x C x H x W); class labels are passed through.
+
+def _is_spatial(targets, inputs):
+    return targets is not None and targets.dim() >= 3 and targets.shape[-2:] == inputs.shape[-2:]
+
+def _per_sample(flags, tensor):
+    # Reshape a (B,) tensor so it broadcasts against a batch tensor
+    return flags.view(-1, *([1] * (tensor.dim() - 1)))
+
+def _warp(tensor, grid, mode):
+    squeeze = tensor.dim() == 3
+    if squeeze:
+        tensor = tensor.unsqueeze(1)
+    dtype = tensor.dtype
+    warped = F.grid_sample(tensor.float(), grid, mode=mode, padding_mode='reflection', align_corners=False)
+    if not dtype.is_floating_point:
+        warped = warped.round()
+    warped = warped.to(dtype)
+    return warped.squeeze(1) if squeeze else warped
+
+def random_shift_scale_rotate(inputs, targets=None, shift_limit=0.0625, scale_limit=0.1, rotate_limit=45, p=0.5):
+    """
+    Randomly translate, scale and rotate every sample of a batch with a single affine warp.
+
+    Args:
+    - inputs (Tensor): Batch of images, B x C x H x W.
+    - targets (Tensor): Batch of targets, warped with nearest-neighbour sampling if spatial.
+    - shift_limit (float): Maximum shift as a fraction of the image size.
+    - scale_limit (float): Maximum relative change of scale.
+    - rotate_limit (int): Maximum rotation in degrees.
+    - p (float): Probability of transforming each sample.
+    """
+    batch_size, height, width = inputs.size(0), inputs.size(-2), inputs.size(-1)
+    device = inputs.device
+
+    def uniform(limit):
+        return (torch.rand(batch_size, device=device) * 2 - 1) * limit
+
+    apply = (torch.rand(batch_size, device=device) < p).float()
+    angle = uniform(rotate_limit * math.pi / 180) * apply
+    scale = (1 + uniform(scale_limit) * apply).clamp(min=1e-3)
+    shift_x = uniform(shift_limit) * apply * 2  # normalised coordinates span [-1, 1]
+    shift_y = uniform(shift_limit) * apply * 2
+
+    # Forward transform in normalised coordinates, corrected for the aspect ratio
+    cos, sin = torch.cos(angle) * scale, torch.sin(angle) * scale
+    forward = torch.stack([
+        torch.stack([cos, -sin * height / width], dim=-1),
+        torch.stack([sin * width / height, cos], dim=-1)
+    ], dim=1)
+    shift = torch.stack([shift_x, shift_y], dim=-1).unsqueeze(-1)
+
+    # affine_grid maps output coordinates to input coordinates, so it needs the inverse
+    inverse = torch.linalg.inv(forward)
+    theta = torch.cat([inverse, -inverse @ shift], dim=-1)
+    grid = F.affine_grid(theta, [batch_size, 1, height, width], align_corners=False)
+
+    inputs = _warp(inputs, grid, mode='bilinear')
+    if _is_spatial(targets, inputs):
+        targets = _warp(targets, grid, mode='nearest')
+    return inputs, targets
+
+def random_horizontal_flip(inputs, targets=None, p=0.5):
+    """Flip each sample of a batch horizontally with probability p."""
+    flags = torch.rand(inputs.size(0), device=inputs.device) < p
+    inputs = torch.where(_per_sample(flags, inputs), inputs.flip(-1), inputs)
+    if _is_spatial(targets, inputs):
+        targets = torch.where(_per_sample(flags, targets), targets.flip(-1), targets)
+    return inputs, targets
+
+def random_vertical_flip(inputs, targets=None, p=0.5):
+    """Flip each sample of a batch vertically with probability p."""
+    flags = torch.rand(inputs.size(0), device=inputs.device) < p
+    inputs = torch.where(_per_sample(flags, inputs), inputs.flip(-2), inputs)
+    if _is_spatial(targets, inputs):
+        targets = torch.where(_per_sample(flags, targets), targets.flip(-2), targets)
+    return inputs, targets
+
+def resize(inputs, targets=None, height=224, width=224):
+    """Resize a batch of images (bilinear) and spatial targets (nearest) to height x width."""
+    spatial = _is_spatial(targets, inputs)
+    dtype = inputs.dtype
+    inputs = F.interpolate(inputs.float(), size=(height, width), mode='bilinear', align_corners=False).to(dtype)
+    if spatial:
+        squeeze = targets.dim() == 3
+        resized = F.interpolate((targets.unsqueeze(1) if squeeze else targets).float(), size=(height, width), mode='nearest')
+        targets = (resized.squeeze(1) if squeeze else resized).to(targets.dtype)
+    return inputs, targets
+
+def random_brightness_contrast(inputs, targets=None, brightness_limit=0.2, contrast_limit=0.2, p=0.5):
+    """
+    Randomly change brightness and contrast of each sample of a batch. Only the inputs are changed.
+    Brightness is shifted relative to the maximum value of the dtype (1.0 for float images).
+    """
+    batch_size, device = inputs.size(0), inputs.device
+    max_value = 1.0 if inputs.is_floating_point() else float(torch.iinfo(inputs.dtype).max)
+    apply = (torch.rand(batch_size, device=device) < p).float()
+    alpha = 1 + (torch.rand(batch_size, device=device) * 2 - 1) * contrast_limit * apply
+    beta = (torch.rand(batch_size, device=device) * 2 - 1) * brightness_limit * apply * max_value
+    adjusted = inputs.float() * _per_sample(alpha, inputs) + _per_sample(beta, inputs)
+    return adjusted.clamp(0, max_value).to(inputs.dtype), targets
+
+def compose_batch_transforms(*transforms):
+    """Chain several batch transforms into a single callable (inputs, targets) -> (inputs, targets)."""
+    def apply(inputs, targets=None):
+        for transform in transforms:
+            inputs, targets = transform(inputs, targets)
+        return inputs, targets
+    return apply
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Callable
+from typing import Callable, Optional, Tuple
 from ..decorators import enforce_types_and_ranges, tag
 # Libraries already supported by ReproModel:
 # import torchvision.transforms as T
@@ -11,6 +11,10 @@ from ..decorators import enforce_types_and_ranges, tag
 # For example, submodality=["RGB", "grayscale"].
 @tag(task=["segmentation"], subtask=["instance"], modality=["images"], submodality=["RGB"])
 class CustomAugmentations(ABC):
+    # Library of the pipeline returned by get_transforms(): "torchvision" or "albumentations".
+    # Subclasses should set it; if left as None it is detected once from the built pipeline.
+    pipeline_kind = None
+
     # Specify here every input with:
     # type: required
     # default: optional but helpful to pre-fill the value in the frontend
@@ -29,6 +33,9 @@ class CustomAugmentations(ABC):
         """
         self.p = p
         self.kwargs = kwargs
+        # Set by enable_batch_mode() when random transforms run on whole batches after loading
+        self.batch_mode = False
+        self._pipelines = {}
 
     # Method needed by the trainer and tester scripts
     @abstractmethod
@@ -36,4 +43,95 @@ class CustomAugmentations(ABC):
         """
         This abstract method should be implemented by all subclasses to return the specific set of transformations.
         """
-        pass
\ No newline at end of file
+        pass
+
+    # Optional: split get_transforms() into a deterministic prefix, whose output can be cached per
+    # sample, and a random suffix applied to the cached output in training
+    def get_deterministic_transforms(self) -> Optional[Callable]:
+        """
+        Return the leading, deterministic part of get_transforms() (e.g. resizing, normalisation), or None
+        if the augmentation does not declare one. The output of this prefix is cached when a transform
+        cache is configured.
+        """
+        return None
+
+    def get_random_transforms(self) -> Optional[Callable]:
+        """
+        Return the part of get_transforms() that follows the deterministic prefix. It is applied to the
+        cached prefix output in training mode. None means the whole pipeline is deterministic.
+        """
+        return None
+
+    def get_eval_transforms(self) -> Optional[Callable]:
+        """
+        Return the steps still needed after the deterministic prefix in validation and testing, where no
+        random augmentation is applied (e.g. conversion to tensor), or None if there are none.
+        """
+        return None
+
+    # Optional, used by file-based datasets to decode images at reduced resolution
+    def get_output_size(self) -> Optional[Tuple[int, int]]:
+        """
+        Return the (height, width) every image is resized to by get_transforms(), or None if the output
+        size depends on the input. Datasets may then decode JPEG files at close to this size.
+        """
+        return None
+
+    # Optional, used by in-memory datasets to skip PIL
+    def get_tensor_transforms(self) -> Optional[Callable]:
+        """
+        Return a version of get_transforms() for uint8 tensors of shape C x H x W or B x C x H x W, or None
+        if the augmentation needs PIL images or numpy arrays. In-memory datasets apply it to whole fetched
+        batches, so random operations would be shared within a batch; keep those in get_batch_transforms().
+        """
+        return None
+
+    # Used by the datasets to apply the transformations
+    def get_pipeline(self, stage: str = 'full') -> Optional[Callable]:
+        """
+        Return a pipeline, built once and reused for every sample.
+
+        Args:
+            stage (str): 'full' for get_transforms(), 'deterministic', 'random' or 'eval' for the
+                parts declared by get_deterministic_transforms(), get_random_transforms() and
+                get_eval_transforms(), or 'tensor' for get_tensor_transforms().
+        """
+        if not hasattr(self, '_pipelines'):
+            self._pipelines = {}
+        if stage not in self._pipelines:
+            builders = {
+                'full': self.get_transforms,
+                'deterministic': self.get_deterministic_transforms,
+                'random': self.get_random_transforms,
+                'eval': self.get_eval_transforms,
+                'tensor': self.get_tensor_transforms
+            }
+            self._pipelines[stage] = builders[stage]()
+        if self.pipeline_kind is None and stage != 'tensor' and self._pipelines[stage] is not None:
+            library = type(self._pipelines[stage]).__module__.split('.')[0]
+            self.pipeline_kind = 'albumentations' if library == 'albumentations' else 'torchvision'
+        return self._pipelines[stage]
+
+    def __getstate__(self):
+        # Every DataLoader worker (and every copy of a dataset) builds its own pipelines on first use
+        state = self.__dict__.copy()
+        state['_pipelines'] = {}
+        return state
+
+    # Optional, used by the trainer when augmentation_mode is "batch"
+    def get_batch_transforms(self) -> Optional[Callable]:
+        """
+        Return a callable (inputs, targets) -> (inputs, targets) that augments a whole collated batch
+        of tensors, e.g. composed from the functions in batchTransforms.py, or None if there is no
+        batch-capable version. While self.batch_mode is True, get_transforms() should only return the
+        per-sample steps that are still needed before collation (e.g. conversion to tensor).
+        """
+        return None
+
+    def enable_batch_mode(self) -> bool:
+        """
+        Switch to batch mode if get_batch_transforms() is implemented. Returns whether batch mode is active.
+        """
+        self.batch_mode = self.get_batch_transforms() is not None
+        self._pipelines = {}
+        return self.batch_mode
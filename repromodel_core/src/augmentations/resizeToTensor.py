@@ -1,8 +1,11 @@
+import torch
 import torchvision.transforms as T
 from .customAugmentation import CustomAugmentations
 from ..decorators import enforce_types_and_ranges
 
 class ResizeToTensor(CustomAugmentations):
+    pipeline_kind = "torchvision"
+
     @enforce_types_and_ranges({
         'p': {'type': float, 'range': (0.0, 1.0)},
         'height': {'type': int, 'range': (1, 10000), 'default': 224},
@@ -20,4 +23,22 @@ class ResizeToTensor(CustomAugmentations):
         return T.Compose([
             T.Resize((self.height, self.width)),
             T.ToTensor()
-        ])
\ No newline at end of file
+        ])
+
+    def get_output_size(self):
+        return (self.height, self.width)
+
+    def get_deterministic_transforms(self):
+        """
+        Resizing and conversion to tensor are deterministic, so the whole pipeline can be cached.
+        """
+        return self.get_transforms()
+
+    def get_tensor_transforms(self):
+        """
+        Returns the same resizing for uint8 tensors, scaling to [0, 1] floats like ToTensor.
+        """
+        return T.Compose([
+            T.Resize((self.height, self.width), antialias=True),
+            T.ConvertImageDtype(torch.float32)
+        ])
@@ -1,10 +1,15 @@
+import torch
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+from functools import partial
 
 from .customAugmentation import CustomAugmentations
+from .batchTransforms import compose_batch_transforms, random_shift_scale_rotate, random_horizontal_flip
 from ..decorators import enforce_types_and_ranges
 
 class ShiftScaleRotateFlip(CustomAugmentations):
+    pipeline_kind = "albumentations"
+
     @enforce_types_and_ranges({
         'p': {'type': float, 'range': (0.0, 1.0)},
         'shift_limit': {'type': float, 'range': (-1.0, 1.0)},
@@ -21,13 +26,34 @@ class ShiftScaleRotateFlip(CustomAugmentations):
     def get_transforms(self):
         """
         Returns an Albumentations composition of transforms that applies random rotations and shifts.
+        In batch mode only the conversion to tensor is done per sample.
         """
+        if self.batch_mode:
+            return A.Compose([ToTensorV2()])
         return A.Compose([
             A.ShiftScaleRotate(shift_limit=self.shift_limit, scale_limit=self.scale_limit, rotate_limit=self.rotate_limit, p=self.p),
             A.HorizontalFlip(p=self.p),  # Example of another transformation with its own probability
             ToTensorV2()
         ])
 
+    def get_batch_transforms(self):
+        """
+        Returns the same random rotations, shifts and flips as vectorised tensor operations on a whole batch.
+        """
+        return compose_batch_transforms(
+            partial(random_shift_scale_rotate, shift_limit=self.shift_limit, scale_limit=self.scale_limit,
+                    rotate_limit=self.rotate_limit, p=self.p),
+            partial(random_horizontal_flip, p=self.p)
+        )
+
+    def get_tensor_transforms(self):
+        """
+        In batch mode nothing is left to do per sample, so tensors are passed through unchanged.
+        """
+        if self.batch_mode:
+            return torch.nn.Identity()
+        return None
+
 # if __name__ == '__main__':
 #     import cv2
 #     import numpy as np
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import socket
+import torch
+from .utils import save_manifest, ensure_folder_exists, print_to_file
+
+# Throughput autotuning: short timed trials of the actual training step over a few combinations of
+# intra-op threads and DataLoader workers. The fastest combination is cached per host, model,
+# dataset and batch size and applied to later runs with the same key.
+#
+# Inter-op threads can only be set once per process, before any inter-op work. Trials inside the
+# trainer therefore use the current inter-op thread count; the standalone autotuner.py runs one
+# process per inter-op thread count and keeps the fastest result in the cache.
+
+def autotune_key(config, model_names):
+    """Cache key of a training setup: host, models, dataset and batch size."""
+    return f"{socket.gethostname()}|{'+'.join(model_names)}|{config.datasets}|{config.batch_size}"
+
+def load_tuning(cache_path, key):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f).get(key)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def save_tuning(cache_path, key, result, keep_faster=False):
+    """Store result under key; with keep_faster, an existing faster result is kept."""
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            cache = {}
+    if keep_faster and key in cache and cache[key]['samples_per_second'] >= result['samples_per_second']:
+        return
+    cache[key] = result
+    ensure_folder_exists(os.path.dirname(cache_path) or '.')
+    save_manifest(cache_path, cache)
+
+def candidate_settings(cpu_count=None, max_workers=8):
+    """
+    Combinations of intra-op threads and DataLoader workers that do not oversubscribe the CPU:
+    no workers with all cores for the model, and 1, 2, 4, ... workers with the remaining cores or half of them.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    settings = [{'num_threads': cpu_count, 'num_workers': 0}]
+    workers = 1
+    while workers <= min(max_workers, cpu_count - 1):
+        for threads in sorted({cpu_count - workers, max(1, (cpu_count - workers) // 2)}, reverse=True):
+            settings.append({'num_threads': threads, 'num_workers': workers})
+        workers *= 2
+    return settings
+
+def measure_throughput(make_loader, train_step, num_workers, num_threads, num_batches=20, warmup=3):
+    """
+    Samples per second of train_step on batches from make_loader(num_workers) with num_threads
+    intra-op threads. The first warmup batches, which include starting the workers, are not timed.
+    """
+    torch.set_num_threads(num_threads)
+    loader = make_loader(num_workers)
+    samples, start = 0, None
+    for i, (inputs, labels) in enumerate(loader):
+        if i == warmup:
+            start = time.perf_counter()
+        train_step(inputs, labels)
+        if i >= warmup:
+            samples += labels.size(0)
+        if i + 1 >= warmup + num_batches:
+            break
+    if start is None or samples == 0:
+        raise ValueError("Too few batches for an autotuning trial; lower autotune_batches or the batch size")
+    return samples / (time.perf_counter() - start)
+
+def autotune(make_loader, train_step, candidates, num_batches=20, warmup=3, config=None, model_num=None):
+    """Time every candidate setting and return the fastest, with the throughput of all trials."""
+    trials = []
+    for settings in candidates:
+        throughput = measure_throughput(make_loader, train_step, settings['num_workers'], settings['num_threads'],
+                                        num_batches=num_batches, warmup=warmup)
+        trials.append({**settings, 'samples_per_second': throughput})
+        print_to_file(f"Autotuning: {settings['num_threads']} threads, {settings['num_workers']} workers: "
+                      f"{throughput:.1f} samples/s", config=config, model_num=model_num)
+    best = max(trials, key=lambda trial: trial['samples_per_second'])
+    return {'num_threads': best['num_threads'], 'num_interop_threads': torch.get_num_interop_threads(),
+            'num_workers': best['num_workers'], 'samples_per_second': best['samples_per_second'], 'trials': trials}
+
+def set_interop_threads(num_interop_threads):
+    """Set the inter-op thread count if this process has not started inter-op work yet; returns whether it was set."""
+    if torch.get_num_interop_threads() == num_interop_threads:
+        return True
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+        return True
+    except RuntimeError:
+        return False
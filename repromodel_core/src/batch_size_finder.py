@@ -0,0 +1,139 @@
+import gc
+import math
+import ctypes
+import threading
+import psutil
+import torch
+from copy import deepcopy
+
+# Preflight search for the largest batch size that trains within a memory budget. Every probe runs
+# two optimizer steps (the second one with the optimizer state allocated, e.g. Adam's moments) on a
+# copy of the model with a batch assembled from a few real training samples, and measures the peak
+# memory: allocated device memory on CUDA; on the CPU the growth of the resident set size over the
+# probe, including the model copy and the batch. Memory freed by earlier probes is handed back to
+# the operating system before every CPU probe, as it would otherwise be reused without showing up in
+# the resident set size. Batch sizes are doubled until a probe exceeds the budget and then bisected.
+# On the CPU the next size is also capped by extrapolating the measured memory per sample, since
+# running out of RAM cannot be caught like a CUDA out-of-memory error.
+
+class _PeakRSS:
+    """Samples the resident set size of this process in a background thread and keeps the maximum."""
+    def __init__(self, interval=0.001):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = self.process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+def _release_freed_memory():
+    # glibc keeps freed memory for reuse; malloc_trim returns it to the operating system
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def _is_out_of_memory(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error).lower()
+
+def default_memory_budget(device):
+    """90% of the device memory on CUDA; otherwise 80% of the available RAM, which training may add to the process."""
+    if str(device).startswith('cuda'):
+        return int(0.9 * torch.cuda.get_device_properties(torch.device(device)).total_memory)
+    _release_freed_memory()
+    return int(0.8 * psutil.virtual_memory().available)
+
+def probe_batch_size(model, make_optimizer, criterion, inputs, labels, batch_size, device):
+    """
+    Train a copy of model for two steps on a batch of batch_size samples, repeated from inputs and
+    labels, and return the peak memory in bytes, or None if it ran out of memory. On the CPU this is
+    the memory the probe added to the process.
+    """
+    cuda = str(device).startswith('cuda')
+    if not cuda:
+        _release_freed_memory()
+    start_rss = psutil.Process().memory_info().rss
+    probe_model = deepcopy(model).to(device).train()
+    optimizer = make_optimizer(probe_model)
+    index = torch.arange(batch_size) % inputs.size(0)
+    batch_inputs, batch_labels = inputs[index].to(device), labels[index].to(device)
+    gc.collect()
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    peak = None
+    try:
+        with _PeakRSS() as rss:
+            for _ in range(2):
+                optimizer.zero_grad()
+                loss = criterion(probe_model(batch_inputs), batch_labels)
+                loss.backward()
+                optimizer.step()
+        peak = torch.cuda.max_memory_allocated(device) if cuda else rss.peak - start_rss
+    except (RuntimeError, MemoryError) as e:
+        if not _is_out_of_memory(e):
+            raise
+    finally:
+        del probe_model, optimizer, batch_inputs, batch_labels
+        gc.collect()
+        if cuda:
+            torch.cuda.empty_cache()
+    return peak
+
+def find_max_batch_size(probe, budget_bytes, max_batch_size=1024, start=2):
+    """
+    Return the largest batch size up to max_batch_size whose probe stays within budget_bytes, or 0
+    if not even a single sample fits, together with the peak memory of every probed size.
+
+    Args:
+    - probe (callable): Maps a batch size to its peak memory in bytes, or None if it ran out of memory.
+    - budget_bytes (int): Memory budget.
+    - max_batch_size (int): Largest batch size considered.
+    - start (int): First batch size probed.
+    """
+    peaks = {}
+    good, bad = 0, max_batch_size + 1
+    batch_size = min(start, max_batch_size)
+    while bad - good > 1:
+        peak = probe(batch_size)
+        peaks[batch_size] = peak
+        if peak is None or peak > budget_bytes:
+            bad = batch_size
+        else:
+            good = batch_size
+        if bad <= max_batch_size:
+            batch_size = (good + bad) // 2
+            continue
+        batch_size = min(2 * good, max_batch_size)
+        # Do not probe beyond the size at which the memory per sample measured so far exhausts the budget
+        fitting = sorted(size for size, peak in peaks.items() if peak is not None and peak <= budget_bytes)
+        if len(fitting) >= 2:
+            low, high = fitting[-2], fitting[-1]
+            per_sample = (peaks[high] - peaks[low]) / (high - low)
+            if per_sample > 0:
+                batch_size = max(good + 1, min(batch_size, high + int(math.floor((budget_bytes - peaks[high]) / per_sample))))
+    return good, peaks
+
+def scale_learning_rate(lr, batch_size, base_batch_size, rule):
+    """Adapt a learning rate tuned for base_batch_size to batch_size with the 'linear' or 'sqrt' scaling rule."""
+    if rule == 'linear':
+        return lr * batch_size / base_batch_size
+    if rule == 'sqrt':
+        return lr * math.sqrt(batch_size / base_batch_size)
+    if rule == 'none':
+        return lr
+    raise ValueError(f"Unknown learning rate scaling rule '{rule}'")
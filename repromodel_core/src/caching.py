@@ -0,0 +1,348 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from sklearn.model_selection import KFold, train_test_split
+from .utils import hash_params, save_manifest
+
+# Annotation tables are cached next to the other caches, so dataset folders may be read-only
+ANNOTATION_CACHE_DIR = "repromodel_core/cache/annotations"
+
+def set_annotation_cache_dir(cache_dir):
+    """Set the folder of the annotation caches of datasets constructed afterwards, e.g. under config.cache_path."""
+    global ANNOTATION_CACHE_DIR
+    ANNOTATION_CACHE_DIR = cache_dir
+
+class TransformCache:
+    """
+    Per-sample cache for the output of the deterministic prefix of an augmentation.
+
+    With storage 'memory' every process (the main process and each DataLoader worker) keeps its own
+    dictionary, so it works best with num_workers = 0 or persistent workers. With storage 'disk' the
+    samples are written to path and shared between workers and later runs with the same configuration.
+
+    Args:
+    - storage (str): 'memory' or 'disk'.
+    - path (str): Folder for the cached samples, required for 'disk'.
+    """
+    def __init__(self, storage='memory', path=None):
+        if storage not in ['memory', 'disk']:
+            raise ValueError("Storage should be 'memory' or 'disk'")
+        if storage == 'disk':
+            if path is None:
+                raise ValueError("A path is required for a disk transform cache")
+            os.makedirs(path, exist_ok=True)
+        self.storage = storage
+        self.path = path
+        self._memory = {}
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.pt")
+
+    def get(self, key):
+        if self.storage == 'memory':
+            return self._memory.get(key)
+        cache_file = self._file(key)
+        if not os.path.exists(cache_file):
+            return None
+        return torch.load(cache_file)
+
+    def put(self, key, value):
+        if self.storage == 'memory':
+            self._memory[key] = value
+            return
+        # Write to a per-process temporary file first so concurrent workers never read partial files
+        tmp_file = os.path.join(self.path, f".{key}.{os.getpid()}.tmp")
+        torch.save(value, tmp_file)
+        os.replace(tmp_file, self._file(key))
+
+    def __len__(self):
+        if self.storage == 'memory':
+            return len(self._memory)
+        return sum(1 for name in os.listdir(self.path) if name.endswith(".pt"))
+
+def _index_dtype(num_samples):
+    return np.int32 if num_samples <= np.iinfo(np.int32).max else np.int64
+
+def kfold_split(num_samples, k=5, test_size=0.2, random_seed=42):
+    """
+    Split samples into k folds: each fold uses one KFold part as test set and splits the rest into
+    train and validation sets. Returns a list of {'train', 'val', 'test'} int32 index arrays.
+    """
+    dtype = _index_dtype(num_samples)
+    kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
+    folds = []
+    for train_val_idx, test_idx in kf.split(np.arange(num_samples)):
+        train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
+        folds.append({'train': train_idx.astype(dtype), 'val': val_idx.astype(dtype), 'test': test_idx.astype(dtype)})
+    return folds
+
+def holdout_kfold_split(num_samples, k=5, test_size=0.2, random_seed=42):
+    """
+    Hold out one shared test set, then split the remaining samples into k train/validation folds.
+    Returns a list of {'train', 'val', 'test'} int32 index arrays.
+    """
+    dtype = _index_dtype(num_samples)
+    full_indices = np.random.RandomState(random_seed).permutation(num_samples)
+    train_val_indices, test_indices = train_test_split(full_indices, test_size=test_size, random_state=random_seed)
+    kfold = KFold(n_splits=k, shuffle=True, random_state=random_seed)
+    folds = []
+    for train_idx, val_idx in kfold.split(train_val_indices):
+        # KFold returns positions within train_val_indices, not sample indices
+        folds.append({
+            'train': train_val_indices[train_idx].astype(dtype),
+            'val': train_val_indices[val_idx].astype(dtype),
+            'test': test_indices.astype(dtype)
+        })
+    return folds
+
+class FoldIndexStore:
+    """
+    Store for cross-validation indices, so folds are computed once and shared by the trainer, the tester
+    and later runs instead of being regenerated by every dataset.
+
+    Folds are keyed by a dataset fingerprint, the number of samples, k, test size, seed and split function.
+    They are kept per process and, if a path is given, saved there as one .npy file per fold and split.
+    With mmap the saved arrays are memory-mapped read-only, which keeps multi-million-sample splits out
+    of the process memory and shares them between DataLoader workers.
+
+    Args:
+    - path (str): Folder for the saved folds, or None to keep them in memory only.
+    - fingerprint (str): Identifies the dataset and its configuration.
+    - mmap (bool): Whether to memory-map the saved folds.
+    """
+    _loaded = {}
+
+    def __init__(self, path=None, fingerprint="", mmap=False):
+        if mmap and path is None:
+            raise ValueError("A path is required to memory-map fold indices")
+        self.path = path
+        self.fingerprint = fingerprint
+        self.mmap = mmap
+
+    def get(self, num_samples, k=5, test_size=0.2, random_seed=42, split_fn=kfold_split):
+        key = hash_params({
+            'fingerprint': self.fingerprint,
+            'num_samples': num_samples,
+            'k': k,
+            'test_size': test_size,
+            'random_seed': random_seed,
+            'split': split_fn.__name__
+        })[:16]
+        if key in FoldIndexStore._loaded:
+            return FoldIndexStore._loaded[key]
+
+        if self.path is None:
+            folds = split_fn(num_samples, k=k, test_size=test_size, random_seed=random_seed)
+        else:
+            folder = os.path.join(self.path, key)
+            if not os.path.isdir(folder):
+                self._save(folder, split_fn(num_samples, k=k, test_size=test_size, random_seed=random_seed))
+            folds = self._load(folder, k)
+        FoldIndexStore._loaded[key] = folds
+        return folds
+
+    def _save(self, folder, folds):
+        # Write into a temporary folder and rename it, so readers never see a partial set of folds
+        tmp_folder = f"{folder}.{os.getpid()}.tmp"
+        os.makedirs(tmp_folder, exist_ok=True)
+        for fold, splits in enumerate(folds):
+            for split, indices in splits.items():
+                np.save(os.path.join(tmp_folder, f"fold{fold}_{split}.npy"), indices)
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # Another process saved the same folds first
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def _load(self, folder, k):
+        mmap_mode = 'r' if self.mmap else None
+        return [
+            {split: np.load(os.path.join(folder, f"fold{fold}_{split}.npy"), mmap_mode=mmap_mode) for split in ['train', 'val', 'test']}
+            for fold in range(k)
+        ]
+
+def get_fold_indices(num_samples, k=5, test_size=0.2, random_seed=42, store=None, split_fn=kfold_split):
+    """Return the folds for a dataset, from the store if one is given."""
+    if store is None:
+        return split_fn(num_samples, k=k, test_size=test_size, random_seed=random_seed)
+    return store.get(num_samples, k=k, test_size=test_size, random_seed=random_seed, split_fn=split_fn)
+
+def _smallest_int_dtype(data):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if data.size == 0 or (data.min() >= info.min and data.max() <= info.max):
+            return dtype
+    return np.int64
+
+class AnnotationCache:
+    """
+    Binary copies of whitespace-separated annotation tables, such as the CelebA text files.
+
+    Each table is parsed once and saved in cache_dir as an .npz file with its header, row index and
+    integer data (stored in the smallest integer type that fits), next to a record of the source file's
+    size, modification time and MD5 checksum. The copy is reused while size and modification time are
+    unchanged, or while the checksum still matches after a touch or copy. If cache_dir cannot be
+    written, the tables are parsed from the text files every time.
+
+    Args:
+    - data_dir (str): Folder of the annotation files; every folder gets its own cache.
+    - cache_dir (str): Parent folder of the binary tables and checksum records, ANNOTATION_CACHE_DIR by default.
+    """
+    def __init__(self, data_dir, cache_dir=None):
+        self.cache_dir = os.path.join(cache_dir or ANNOTATION_CACHE_DIR, hash_params(os.path.abspath(data_dir))[:16])
+
+    def _paths(self, path):
+        name = os.path.basename(path)
+        return os.path.join(self.cache_dir, f"{name}.npz"), os.path.join(self.cache_dir, f"{name}.json")
+
+    def _read_record(self, record_path):
+        try:
+            with open(record_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_record(self, record_path, record):
+        try:
+            save_manifest(record_path, record)
+        except OSError:
+            pass
+
+    def _md5(self, path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def checksum(self, path):
+        """Return the MD5 checksum of a file, from the record if the file is unchanged."""
+        stat = os.stat(path)
+        record = self._read_record(self._paths(path)[1])
+        if record is not None and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['md5']
+        return self._md5(path)
+
+    def load(self, path, header=None):
+        """
+        Return (header names, row index, data) of a table whose first column is the row index.
+
+        Args:
+        - path (str): The text file.
+        - header (int): Line number of the column names; data starts on the next line. None if there is no header.
+        """
+        table_path, record_path = self._paths(path)
+        stat = os.stat(path)
+        record = self._read_record(record_path)
+        if record is not None and os.path.isfile(table_path):
+            unchanged = record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns
+            if unchanged or (record['size'] == stat.st_size and record['md5'] == self._md5(path)):
+                with np.load(table_path) as table:
+                    if not unchanged:
+                        self._save_record(record_path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': record['md5']})
+                    return table['header'].tolist(), table['index'].tolist(), table['data'].astype(np.int64)
+
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        names = lines[header].split() if header is not None else []
+        rows = [line.split() for line in lines[(header + 1 if header is not None else 0):] if line.strip()]
+        index = [row[0] for row in rows]
+        data = np.array([row[1:] for row in rows], dtype=np.int64)
+
+        tmp_path = f"{table_path}.{os.getpid()}.tmp.npz"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(tmp_path, header=np.array(names, dtype=str), index=np.array(index, dtype=str),
+                     data=data.astype(_smallest_int_dtype(data)))
+            os.replace(tmp_path, table_path)
+        except OSError:
+            # Read-only cache location: the parsed table is used without being cached
+            return names, index, data
+        self._save_record(record_path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': self._md5(path)})
+        return names, index, data
+
+def _nbytes(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.numel()
+    if isinstance(batch, dict):
+        return sum(_nbytes(value) for value in batch.values())
+    if isinstance(batch, (tuple, list)):
+        return sum(_nbytes(value) for value in batch)
+    return 0
+
+class BatchCache:
+    """
+    Pre-collated batches of a DataLoader whose output does not change between epochs, such as the
+    validation loader. The first complete pass iterates the loader and keeps every batch; later passes
+    return the kept batches without loading, decoding or collating anything.
+
+    Batches are kept in memory, or saved under path and memory-mapped when read back. If they exceed
+    budget_bytes, caching is abandoned and the loader is used on every pass.
+
+    Args:
+    - loader (DataLoader): The loader to cache.
+    - storage (str): 'memory' or 'disk'.
+    - path (str): Folder for the saved batches, required for 'disk'. Its previous content is removed.
+    - budget_bytes (int): Maximum total size of the cached batches.
+    """
+    def __init__(self, loader, storage='memory', path=None, budget_bytes=1 << 30):
+        if storage not in ['memory', 'disk']:
+            raise ValueError("Storage should be 'memory' or 'disk'")
+        if storage == 'disk':
+            if path is None:
+                raise ValueError("A path is required for a disk batch cache")
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path, exist_ok=True)
+        self.loader = loader
+        self.storage = storage
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.batches = None
+        self.abandoned = False
+
+    @property
+    def ready(self):
+        return self.batches is not None
+
+    def __len__(self):
+        return len(self.batches) if self.ready else len(self.loader)
+
+    def _store(self, batch, i):
+        if self.storage == 'memory':
+            return batch
+        batch_file = os.path.join(self.path, f"batch{i}.pt")
+        torch.save(batch, batch_file)
+        return batch_file
+
+    def _load(self, stored):
+        if self.storage == 'memory':
+            return stored
+        return torch.load(stored, mmap=True)
+
+    def __iter__(self):
+        if self.ready:
+            for stored in self.batches:
+                yield self._load(stored)
+            return
+        if self.abandoned:
+            yield from self.loader
+            return
+
+        batches, size = [], 0
+        for batch in self.loader:
+            if batches is not None:
+                size += _nbytes(batch)
+                if size > self.budget_bytes:
+                    batches = None
+                    self.abandoned = True
+                    if self.storage == 'disk':
+                        shutil.rmtree(self.path, ignore_errors=True)
+                else:
+                    batches.append(self._store(batch, len(batches)))
+            yield batch
+        # Only a complete pass is kept; an interrupted one is redone next time
+        if batches is not None:
+            self.batches = batches
@@ -0,0 +1,152 @@
+import os
+import time
+import random
+import signal
+import itertools
+import threading
+from contextlib import contextmanager
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from .utils import save_manifest, ensure_folder_exists, print_to_file
+from .distributed import is_main_process, is_distributed, all_reduce_sum
+
+# Latest checkpoints: besides the best checkpoint of every fold, the trainer regularly writes the
+# complete state of every run, so that a stopped or preempted training continues from the step it
+# reached. A latest checkpoint holds the model, optimizer, scheduler and early-stopping states, the
+# epoch totals, the validation bookkeeping, the RNG states and the number of batches consumed in
+# the current epoch. Training loaders shuffle by seed and epoch, so the interrupted epoch is drawn in
+# the same order and the consumed batches are skipped without loading them. Runs trained together
+# (lockstep models, ensemble members) are checkpointed together, including those that already
+# finished, so that a resumed group does not train a finished run again. The latest checkpoints of
+# a group are removed once all of its runs are finished.
+
+# In distributed training, processes agree on a preemption request every this many optimizer steps
+PREEMPTION_CHECK_EVERY_STEPS = 10
+
+_preemption_requested = False
+
+def _request_preemption(signum, frame):
+    global _preemption_requested
+    _preemption_requested = True
+
+@contextmanager
+def handle_preemption():
+    """
+    Within the block, SIGTERM (e.g. from pkill or a cluster scheduler) becomes a request to checkpoint
+    and exit, see preemption_requested(). Outside of it, e.g. during preprocessing or autotuning,
+    there is nothing to checkpoint and SIGTERM terminates the process right away.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = signal.signal(signal.SIGTERM, _request_preemption)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+def preemption_requested(global_step=None):
+    """
+    Whether SIGTERM was received; in distributed training, by any of the processes. Agreeing on it
+    takes a collective, so during an epoch (global_step given) the processes only compare every
+    PREEMPTION_CHECK_EVERY_STEPS steps.
+    """
+    if not is_distributed():
+        return _preemption_requested
+    if global_step is not None and global_step % PREEMPTION_CHECK_EVERY_STEPS:
+        return False
+    return all_reduce_sum([float(_preemption_requested)])[0] > 0
+
+def get_rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class ResumableSampler(Sampler):
+    """
+    Sampler that can leave out the start of its next pass, so that an interrupted epoch continues
+    with the batches it had not reached. The wrapped sampler has to draw its order from a seed and
+    the epoch, as DistributedSampler does, so that the order of an epoch can be drawn again.
+
+    Args:
+    - sampler (Sampler): The sampler of the training loader.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.skip = 0
+
+    def skip_next(self, num_samples):
+        self.skip = num_samples
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return itertools.islice(iter(self.sampler), skip, None)
+
+    def __len__(self):
+        return len(self.sampler)
+
+class CheckpointTimer:
+    """
+    Decides when the next latest checkpoint is due: every every_steps optimizer steps and/or every
+    every_minutes minutes. Both 0 disables periodic checkpoints; preemption still writes one.
+    """
+    def __init__(self, every_steps=0, every_minutes=0):
+        self.every_steps = every_steps
+        self.every_seconds = every_minutes * 60
+        self.last_time = time.monotonic()
+
+    def due(self, global_step):
+        if self.every_steps and global_step % self.every_steps == 0:
+            return True
+        return bool(self.every_seconds) and time.monotonic() - self.last_time >= self.every_seconds
+
+    def reset(self):
+        self.last_time = time.monotonic()
+
+def latest_checkpoint_path(config, name, fold):
+    return f"{config.model_save_path}{name}/{name}_latest_fold_{fold}.pt"
+
+def save_latest_checkpoints(runs, batches_done):
+    """Write the complete state of every FoldRun of a group and point the progress file at the group."""
+    if not is_main_process():
+        return
+    config = runs[0].cfg
+    paths = []
+    for run in runs:
+        path = latest_checkpoint_path(config, run.name, run.k)
+        ensure_folder_exists(os.path.dirname(path))
+        # Write to a temporary file first, so that an interrupted save keeps the previous checkpoint
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(run.latest_state(batches_done), tmp_path)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    if runs[0].progress is not None:
+        progress = runs[0].progress.entry()
+    else:
+        progress = {'model_name': config.models[runs[0].m], 'fold': runs[0].k, 'epoch': runs[0].epoch}
+    save_manifest(config.progress_path, {**progress, 'step': runs[0].global_step, 'latest_checkpoints': paths})
+    print_to_file(f"Latest checkpoints saved for {len(paths)} runs (epoch {runs[0].epoch}, step {runs[0].global_step})",
+                  config=config, model_num=runs[0].m)
+
+def load_latest_checkpoint(config, name, fold):
+    """Return the state saved by save_latest_checkpoints(), or None if there is none."""
+    path = latest_checkpoint_path(config, name, fold)
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location='cpu')
+
+def remove_latest_checkpoint(config, name, fold):
+    path = latest_checkpoint_path(config, name, fold)
+    if is_main_process() and os.path.exists(path):
+        os.remove(path)
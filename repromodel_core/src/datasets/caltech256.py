@@ -3,10 +3,10 @@ import numpy as np
 from PIL import Image
 from torchvision.datasets import Caltech256
 import scipy.io
-from sklearn.model_selection import KFold, train_test_split
 from typing import Any, Callable, List, Optional, Union, Tuple
 from ..decorators import enforce_types_and_ranges, tag
-from ..utils import one_hot_encode
+from ..utils import transform_sample, load_image, get_output_size
+from ..caching import get_fold_indices
 import unittest
 
 @tag(task=["classification"], subtask=["image"], modality=["images"], submodality=["RGB"])
@@ -32,6 +32,7 @@ class Caltech256Dataset(Caltech256):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
         self.all_indices = np.arange(super().__len__())
 
     def set_mode(self, mode: str):
@@ -40,7 +41,14 @@ class Caltech256Dataset(Caltech256):
         self.mode = mode
 
     def set_transforms(self, transform):
-        self.transform = transform.get_transforms()
+        self.transform = transform
+
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    def get_target_encoding(self):
+        # Targets are returned as class indices and one-hot encoded per batch by the trainer.
+        return {'encoding': 'one_hot', 'num_classes': 257}
 
     def set_fold(self, fold: int):
         if self.indices is None:
@@ -52,23 +60,15 @@ class Caltech256Dataset(Caltech256):
         self.val_indices = self.indices[fold]['val']
         self.test_indices = self.indices[fold]['test']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        for train_val_idx, test_idx in kf.split(self.all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.all_indices), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             return len(self.train_indices)
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             return len(self.val_indices)
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             return len(self.test_indices)
         return super().__len__()
 
@@ -87,34 +87,24 @@ class Caltech256Dataset(Caltech256):
         return img, target
 
     def __getitem__(self, index: int) -> Tuple[Any, Any]:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             index = self.train_indices[index]
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             index = self.val_indices[index]
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             index = self.test_indices[index]
 
         img, target = self.__loaddata__(index)
 
-        # Convert grayscale images to RGB
-        img = img.convert("RGB")
-
-        if self.transform is not None:
-            try:
-                # Try to apply torchvision transforms
-                img = self.transform(img)
-            except TypeError:
-                # Apply albumentations transforms
-                img_np = np.array(img)
-                transformed = self.transform(image=img_np)
-                img = Image.fromarray(transformed['image'])
+        # Convert grayscale images to RGB; the image is only decoded if it is not served from the cache,
+        # and JPEGs are decoded at close to the size the augmentation resizes to
+        decode_size = get_output_size(self.transform)
+        img = transform_sample(self.transform, lambda: load_image(img, size=decode_size),
+                               cache=self.transform_cache, key=index, train=self.mode == 'train')
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        if isinstance(target, int):
-            target = one_hot_encode(labels=target, num_classes=257, type="numpy")
-
         return img, target
     
 class _TestCaltech256Dataset(unittest.TestCase):
@@ -1,14 +1,14 @@
 import os
 import numpy as np
-from PIL import Image
 import torch
-from sklearn.model_selection import KFold, train_test_split
 from torchvision.datasets.utils import verify_str_arg
 from torchvision.datasets import CelebA
+from torchvision.datasets.celeba import CSV
 from typing import Any, Callable, List, Optional, Union, Tuple
 from ..decorators import enforce_types_and_ranges, tag
+from ..utils import transform_sample, load_image, get_output_size
+from ..caching import get_fold_indices, AnnotationCache
 import unittest
-import pandas as pd
 
 @tag(task=["classification"], subtask=["attribute"], modality=["images"], submodality=["RGB"])
 class CelebADataset(CelebA):
@@ -31,6 +31,7 @@ class CelebADataset(CelebA):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
         self.split = split
         
         # Load split information
@@ -43,27 +44,47 @@ class CelebADataset(CelebA):
         }
         self.split_ = split_map[verify_str_arg(split.lower(), "split", ("train", "valid", "test", "trainval", "all"))]
 
-        # Load necessary data
-        self.splits = pd.read_csv(os.path.join(self.root, self.base_folder, "list_eval_partition.txt"), sep='\s+', header=None, index_col=0)
-        self.identity = pd.read_csv(os.path.join(self.root, self.base_folder, "identity_CelebA.txt"), sep='\s+', header=None, index_col=0)
-        self.bbox = pd.read_csv(os.path.join(self.root, self.base_folder, "list_bbox_celeba.txt"), sep='\s+', header=1, index_col=0)
-        self.landmarks_align = pd.read_csv(os.path.join(self.root, self.base_folder, "list_landmarks_align_celeba.txt"), sep='\s+', header=1)
-        self.attr = pd.read_csv(os.path.join(self.root, self.base_folder, "list_attr_celeba.txt"), sep='\s+', header=1)
+        # Load necessary data from the binary annotation cache filled by the parent constructor
+        splits = self._load_csv("list_eval_partition.txt")
+        identity = self._load_csv("identity_CelebA.txt")
+        bbox = self._load_csv("list_bbox_celeba.txt", header=1)
+        landmarks_align = self._load_csv("list_landmarks_align_celeba.txt", header=1)
+        attr = self._load_csv("list_attr_celeba.txt", header=1)
 
+        split_values = splits.data[:, 0]
         if self.split_ == [0, 1]:
-            train_mask = (self.splits[1] == 0)
-            valid_mask = (self.splits[1] == 1)
-            self.mask = train_mask | valid_mask
+            self.mask = (split_values == 0) | (split_values == 1)
+        elif self.split_ is None:
+            self.mask = torch.ones_like(split_values, dtype=torch.bool)
         else:
-            self.mask = slice(None) if self.split_ is None else (self.splits[1] == self.split_)
+            self.mask = split_values == self.split_
 
-        self.filename = self.splits[self.mask].index.values
-        self.identity = torch.as_tensor(self.identity[self.mask].values)
-        self.bbox = torch.as_tensor(self.bbox[self.mask].values)
-        self.landmarks_align = torch.as_tensor(self.landmarks_align[self.mask].values)
-        self.attr = torch.as_tensor(self.attr[self.mask].values)
+        self.filename = np.asarray(splits.index)[self.mask.numpy()]
+        self.identity = identity.data[self.mask]
+        self.bbox = bbox.data[self.mask]
+        self.landmarks_align = landmarks_align.data[self.mask]
+        self.attr = attr.data[self.mask]
         self.attr = (self.attr + 1) // 2  # map from {-1, 1} to {0, 1}
 
+    def _annotation_cache(self):
+        return AnnotationCache(os.path.join(self.root, self.base_folder))
+
+    def _load_csv(self, filename: str, header: Optional[int] = None) -> CSV:
+        # Replaces the parent's text parsing, which ran on every construction, with the binary cache
+        headers, indices, data = self._annotation_cache().load(os.path.join(self.root, self.base_folder, filename), header=header)
+        return CSV(headers, indices, torch.from_numpy(data))
+
+    def _check_integrity(self) -> bool:
+        # Same check as the parent, but reuses the checksums recorded by the annotation cache
+        cache = self._annotation_cache()
+        for (_, md5, filename) in self.file_list:
+            fpath = os.path.join(self.root, self.base_folder, filename)
+            _, ext = os.path.splitext(filename)
+            # Allow original archive to be deleted (zip and 7z)
+            if ext not in [".zip", ".7z"] and (not os.path.isfile(fpath) or cache.checksum(fpath) != md5):
+                return False
+        return os.path.isdir(os.path.join(self.root, self.base_folder, "img_align_celeba"))
+
     def set_mode(self, mode: str):
         if mode not in ['train', 'val', 'test']:
             raise ValueError("Mode should be 'train', 'val', or 'test'")
@@ -72,6 +93,9 @@ class CelebADataset(CelebA):
     def set_transforms(self, transform):
         self.transform = transform
 
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
     def set_fold(self, fold: int):
         if self.indices is None:
             raise RuntimeError("Please generate indices first using generate_indices()")
@@ -82,17 +106,8 @@ class CelebADataset(CelebA):
         self.val_indices = self.indices[fold]['val']
         self.test_indices = self.indices[fold]['test']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        all_indices = np.arange(len(self.filename))
-        for train_val_idx, test_idx in kf.split(all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.filename), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
         if self.mode == 'train':
@@ -111,7 +126,7 @@ class CelebADataset(CelebA):
         elif self.mode == 'test':
             index = self.test_indices[index]
 
-        X = Image.open(os.path.join(self.root, self.base_folder, "img_align_celeba", self.filename[index]))
+        img_path = os.path.join(self.root, self.base_folder, "img_align_celeba", self.filename[index])
         target: Any = []
         for t in self.target_type:
             if t == "attr":
@@ -125,20 +140,9 @@ class CelebADataset(CelebA):
             else:
                 raise ValueError(f"Target type '{t}' is not recognized.")
 
-        if self.transform is not None:
-            transformations = self.transform.get_transforms()
-            try:
-                # Try to apply torchvision transforms
-                X = transformations(X)
-                if not isinstance(X, torch.Tensor):
-                    X = torch.from_numpy(X)  # Ensure X is a tensor
-            except TypeError:
-                # Apply albumentations transforms
-                X_np = np.array(X)
-                transformed = transformations(image=X_np)
-                X = transformed['image']
-                if not isinstance(X, torch.Tensor):
-                    X = torch.from_numpy(X)  # Ensure X is a tensor
+        decode_size = get_output_size(self.transform)
+        X = transform_sample(self.transform, lambda: load_image(img_path, size=decode_size),
+                             cache=self.transform_cache, key=index, train=self.mode == 'train')
 
         if target:
             target = tuple(target) if len(target) > 1 else target[0]
@@ -1,11 +1,11 @@
 import os
-import numpy as np
+import torch
 from PIL import Image
 from torchvision.datasets import CIFAR10
-from sklearn.model_selection import KFold, train_test_split
-from typing import Any, Callable, List, Optional, Union, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 from ..decorators import enforce_types_and_ranges, tag
-from ..utils import one_hot_encode
+from ..utils import transform_sample, apply_transforms, supports_tensor_input
+from ..caching import get_fold_indices
 import unittest
 
 @tag(task=["classification"], subtask=["image"], modality=["images"], submodality=["RGB"])
@@ -26,6 +26,7 @@ class CIFAR10Dataset(CIFAR10):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
         self.train_data = self.data
         self.train_targets = self.targets
 
@@ -41,6 +42,13 @@ class CIFAR10Dataset(CIFAR10):
     def set_transforms(self, transform):
         self.transform = transform
 
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    def get_target_encoding(self):
+        # Targets are returned as class indices and one-hot encoded per batch by the trainer.
+        return {'encoding': 'one_hot', 'num_classes': 10}
+
     def set_fold(self, fold: int):
         if self.indices is None:
             raise RuntimeError("Please generate indices first using generate_indices()")
@@ -50,17 +58,8 @@ class CIFAR10Dataset(CIFAR10):
         self.train_indices = self.indices[fold]['train']
         self.val_indices = self.indices[fold]['val']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        all_indices = np.arange(len(self.data))
-        for train_val_idx, test_idx in kf.split(all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.data), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
         if self.mode == 'train':
@@ -81,24 +80,37 @@ class CIFAR10Dataset(CIFAR10):
 
         img, target = self.data[index], self.targets[index]
 
-        img = Image.fromarray(img)
-
-        if self.transform is not None:
-            transformations = self.transform.get_transforms()
-            try:
-                # Try to apply torchvision transforms
-                img = transformations(img)
-            except TypeError:
-                # Apply albumentations transforms
-                img_np = np.array(img)
-                transformed = transformations(image=img_np)
-                img = Image.fromarray(transformed['image'])
+        if supports_tensor_input(self.transform):
+            # Zero-copy Channels x Height x Width view of the stored uint8 array, no PIL round trip
+            img = torch.from_numpy(img).permute(2, 0, 1)
+            if self.transform is not None:
+                img = apply_transforms(self.transform, img, stage='tensor')
+        else:
+            img = transform_sample(self.transform, lambda: Image.fromarray(img), cache=self.transform_cache,
+                                   key=index, train=self.mode == 'train')
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        target = one_hot_encode(labels=target, num_classes=10, type="numpy")
         return img, target
+
+    def __getitems__(self, indices: List[int]) -> List[Tuple[Any, Any]]:
+        # Called by the DataLoader with a whole batch of indices; tensor samples are gathered and
+        # transformed in one go, everything else is fetched one by one
+        if not supports_tensor_input(self.transform):
+            return [self[index] for index in indices]
+
+        mode_indices = getattr(self, f"{self.mode}_indices")
+        indices = [mode_indices[index] for index in indices]
+        imgs = torch.from_numpy(self.data[indices]).permute(0, 3, 1, 2)
+        if self.transform is not None:
+            imgs = apply_transforms(self.transform, imgs, stage='tensor')
+
+        targets = [self.targets[index] for index in indices]
+        if self.target_transform is not None:
+            targets = [self.target_transform(target) for target in targets]
+
+        return list(zip(imgs.unbind(0), targets))
     
 class _TestCIFAR10Dataset(unittest.TestCase):
     def test_initialization(self):
@@ -143,6 +155,17 @@ class _TestCIFAR10Dataset(unittest.TestCase):
         with self.assertRaises(ValueError, msg="Setting fold to an out-of-range value did not raise an error"):
             dataset.set_fold(5)
 
+    def test_getitems_matches_getitem(self):
+        dataset = CIFAR10Dataset(root="repromodel_core/data/cifar10")
+        dataset.generate_indices(k=5)
+        dataset.set_fold(0)
+        batch = dataset.__getitems__([0, 1, 2])
+        for i, (img, target) in enumerate(batch):
+            single_img, single_target = dataset[i]
+            self.assertTrue(torch.equal(img, single_img), "Batched image differs from single image")
+            self.assertEqual(target, single_target, "Batched target differs from single target")
+        self.assertEqual(tuple(batch[0][0].shape), (3, 32, 32), "Tensor sample is not Channels x Height x Width")
+
     def test_cifar10_tags(self):
         dataset = CIFAR10Dataset(root="repromodel_core/data/cifar10")
         self.assertEqual(dataset.task, ["classification"], "Task tag is incorrect")
@@ -1,12 +1,10 @@
 import os
 import numpy as np
-from PIL import Image
 from torchvision.datasets import Country211
-from sklearn.model_selection import KFold, train_test_split
-from typing import Any, Callable, List, Optional, Union, Tuple
-from pathlib import Path
+from typing import Any, Callable, Optional, Tuple
 from ..decorators import enforce_types_and_ranges, tag
-from ..utils import one_hot_encode
+from ..utils import transform_sample, load_image, get_output_size
+from ..caching import get_fold_indices
 import unittest
 
 @tag(task=["classification"], subtask=["image"], modality=["images"], submodality=["RGB"])
@@ -45,6 +43,7 @@ class Country211Dataset(Country211):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
 
         # Set up all indices for the dataset
         self.all_indices = np.arange(len(self.samples))
@@ -55,7 +54,14 @@ class Country211Dataset(Country211):
         self.mode = mode
 
     def set_transforms(self, transform):
-        self.transform = transform.get_transforms()
+        self.transform = transform
+
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    def get_target_encoding(self):
+        # Targets are returned as class indices and one-hot encoded per batch by the trainer.
+        return {'encoding': 'one_hot', 'num_classes': len(self.classes)}
 
     def set_fold(self, fold: int):
         if self.indices is None:
@@ -67,53 +73,34 @@ class Country211Dataset(Country211):
         self.val_indices = self.indices[fold]['val']
         self.test_indices = self.indices[fold]['test']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        for train_val_idx, test_idx in kf.split(self.all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.all_indices), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             return len(self.train_indices)
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             return len(self.val_indices)
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             return len(self.test_indices)
         return super().__len__()
 
     def __getitem__(self, index: int) -> Tuple[Any, Any]:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             index = self.train_indices[index]
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             index = self.val_indices[index]
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             index = self.test_indices[index]
 
         img_path, target = self.samples[index][0], self.targets[index]
-        img = Image.open(img_path).convert("RGB")
-
-        if self.transform is not None:
-            try:
-                # Try to apply torchvision transforms
-                img = self.transform(img)
-            except TypeError:
-                # Apply albumentations transforms
-                img_np = np.array(img)
-                transformed = self.transform(image=img_np)
-                img = Image.fromarray(transformed['image'])
+        decode_size = get_output_size(self.transform)
+        img = transform_sample(self.transform, lambda: load_image(img_path, size=decode_size),
+                               cache=self.transform_cache, key=index, train=self.mode == 'train')
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        if isinstance(target, int):
-            target = one_hot_encode(labels=target, num_classes=len(self.classes), type="numpy")
-
         return img, target
     
 class _TestCountry211Dataset(unittest.TestCase):
@@ -1,7 +1,6 @@
 from torch.utils.data import Dataset
-from sklearn.model_selection import KFold, train_test_split
-import numpy as np
-from ..utils import one_hot_encode
+from ..utils import transform_sample
+from ..caching import get_fold_indices
 from ..decorators import enforce_types_and_ranges, tag
 from typing import Any, Tuple
 
@@ -30,6 +29,7 @@ class CustomDataset(Dataset):
         self.mode = mode
         self.transforms = transforms
         self.extension = extension
+        self.transform_cache = None
         # Additional setup 
         pass
 
@@ -43,6 +43,15 @@ class CustomDataset(Dataset):
     def set_transforms(self, transform):
         self.transform = transform
 
+    # Optional: lets the trainer and tester cache the deterministic part of the augmentation
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    # Optional: how the trainer and tester expand a collated batch of targets (see utils.encode_targets)
+    def get_target_encoding(self):
+        # Targets are returned as class indices and one-hot encoded per batch by the trainer.
+        return {'encoding': 'one_hot', 'num_classes': 10}
+
     # Required by the trainer and tester scripts
     def set_fold(self, fold: int):
         if self.indices is None:
@@ -54,17 +63,8 @@ class CustomDataset(Dataset):
         self.val_indices = self.indices[fold]['val']
 
     # Required by the trainer and tester scripts
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        all_indices = np.arange(len(self.data))
-        for train_val_idx, test_idx in kf.split(all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.data), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     # Required to get the real length of every subset
     def __len__(self) -> int:
@@ -90,21 +90,10 @@ class CustomDataset(Dataset):
         from PIL import Image
         img, target = self.data[index], self.targets[index]
 
-        img = Image.fromarray(img)
-
-        if self.transform is not None:
-            transformations = self.transform.get_transforms()
-            try:
-                # Try to apply torchvision transforms
-                img = transformations(img)
-            except TypeError:
-                # Apply albumentations transforms
-                img_np = np.array(img)
-                transformed = transformations(image=img_np)
-                img = Image.fromarray(transformed['image'])
+        img = transform_sample(self.transform, lambda: Image.fromarray(img), cache=self.transform_cache,
+                               key=index, train=self.mode == 'train')
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        target = one_hot_encode(labels=target, num_classes=10, type="numpy")
         return img, target
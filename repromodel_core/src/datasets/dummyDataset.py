@@ -1,8 +1,9 @@
 import os
 from torch.utils.data import Dataset
-from sklearn.model_selection import KFold, train_test_split
 import numpy as np
 from ..decorators import enforce_types_and_ranges
+from ..utils import apply_transforms, list_files
+from ..caching import get_fold_indices, holdout_kfold_split
 
 class DummyDataset(Dataset):
     @enforce_types_and_ranges({
@@ -20,6 +21,7 @@ class DummyDataset(Dataset):
         self.mode = mode
         self.transforms = transforms
         self.extension = extension
+        self.preprocessor = None
 
         self.input_list = self.scan_folder(self.input_path) 
         self.target_list = self.scan_folder(self.target_path)
@@ -40,9 +42,32 @@ class DummyDataset(Dataset):
     def set_transforms(self, transforms):
         self.transforms = transforms
 
+    def get_target_encoding(self):
+        """
+        Describe how the trainer expands a batch of masks: each mask is stacked with its complement
+        into a two-channel target, channel axis first.
+        """
+        return {'encoding': 'complement', 'dim': 1}
+
+    def set_preprocessor(self, preprocessor):
+        """
+        Apply a preprocessor to every loaded file instead of reading preprocessed .npy files.
+        In this mode input_path and target_path point to the raw data.
+
+        Parameters:
+        - preprocessor: An object with a load_sample(file_path) method returning a numpy array.
+        """
+        self.preprocessor = preprocessor
+
+    def _load_file(self, file_path):
+        if self.preprocessor is not None:
+            return self.preprocessor.load_sample(file_path)
+        return np.load(file_path)
+
     def scan_folder(self, dir):
         """
         Scan a folder for data files matching given extension.
+        The listing is cached in a manifest and only redone when the folder changes.
 
         Parameters:
         - dir: The directory to scan.
@@ -52,18 +77,13 @@ class DummyDataset(Dataset):
         """
         abs_dir = os.path.join(os.getcwd(), dir)
 
-        data_list = []
         assert os.path.isdir(abs_dir), '%s is not a valid directory' % abs_dir
-        for root, _, fnames in sorted(os.walk(abs_dir)):
-            for fname in fnames:
-                if fname.startswith('.') or not any(fname.endswith(ext) for ext in self.extension):
-                    continue
-                data_list.append(os.path.join(root, fname))
+        data_list = list_files(abs_dir, extensions=self.extension)
         if len(data_list) == 0:
             raise RuntimeError(f"Found 0 files in: {abs_dir}\nSupported extension is: {self.extension}")
-        return sorted(data_list)
+        return data_list
 
-    def generate_indices(self, k=5, test_size=0.2, random_seed=42):
+    def generate_indices(self, k=5, test_size=0.2, random_seed=42, store=None):
         """
         Generate indices for train/test split, then apply KFold cross-validation on the training set.
 
@@ -71,22 +91,11 @@ class DummyDataset(Dataset):
         - k: Number of folds.
         - test_size: Proportion of the dataset to include in the test split.
         - random_seed: Seed for randomness.
+        - store: Optional FoldIndexStore to reuse previously generated folds from.
         """
-        np.random.seed(random_seed)
-        full_indices = np.random.permutation(len(self.input_list))
-        
-        # Initial train/test split
-        train_val_indices, test_indices = train_test_split(full_indices, test_size=test_size, random_state=random_seed)
-
-        kfold = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        
-        self.indices = {}
-        for i, (train_idx, val_idx) in enumerate(kfold.split(train_val_indices)):
-            self.indices[i] = {
-                'train': train_idx,
-                'val': val_idx,
-                'test': test_indices
-            }
+        folds = get_fold_indices(len(self.input_list), k=k, test_size=test_size, random_seed=random_seed,
+                                 store=store, split_fn=holdout_kfold_split)
+        self.indices = dict(enumerate(folds))
 
     def set_fold(self, fold):
         """
@@ -116,29 +125,24 @@ class DummyDataset(Dataset):
         - idx: The index of the sample to retrieve in the current fold.
 
         Returns:
-        A tuple containing the data and its corresponding label, with the channel axis first.
+        A tuple containing the data, with the channel axis first, and its single-channel uint8 mask.
         """
         actual_idx = self.indices[self.current_fold][self.mode][idx]
         input_identifier = self.input_list[actual_idx]
         target_identifier = self.target_list[actual_idx]
 
-        data = np.load(input_identifier)
-        label = np.load(target_identifier)
+        data = self._load_file(input_identifier)
+        # Masks are kept as single-channel uint8 and expanded per batch by the trainer; soft masks are
+        # binarised at 0.5, so every sample of a batch has the same dtype
+        label = (self._load_file(target_identifier) >= 0.5).astype(np.uint8)
 
         if self.transforms and self.mode == 'train':
-            # Get the transformation
-            transformations = self.transforms.get_transforms()
-            transformed = transformations(image=data, mask=label)
-            data, label = transformed['image'], transformed['mask']
-
-        # Create a two-channel label by duplicating the negative label along the channel dimension
-        label = np.stack((label, 1-label), axis=-1)
-
-        # Assuming the data and labels are stored as Height x Width x Channels
-        # and we need them as Channels x Height x Width
-        if self.mode in ['val','test']:
+            # Get the transformation, which ends with a conversion to a Channels x Height x Width tensor
+            data, label = apply_transforms(self.transforms, data, label)
+        else:
+            # Assuming the data is stored as Height x Width x Channels
+            # and we need it as Channels x Height x Width
             data = np.transpose(data, (2, 0, 1))
-            label = np.transpose(label, (2, 0, 1))
 
         return data, label
 
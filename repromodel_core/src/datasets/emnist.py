@@ -1,11 +1,12 @@
 import os
 import numpy as np
+import torch
 from PIL import Image
 from torchvision.datasets import EMNIST
-from sklearn.model_selection import KFold, train_test_split
 from typing import Any, Callable, List, Optional, Union, Tuple
 from ..decorators import enforce_types_and_ranges, tag
-from ..utils import one_hot_encode
+from ..utils import transform_sample, apply_transforms, supports_tensor_input
+from ..caching import get_fold_indices
 import unittest
 
 @tag(task=["classification"], subtask=["image"], modality=["images"], submodality=["grayscale"])
@@ -55,6 +56,7 @@ class EMNISTDataset(EMNIST):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
 
         # Set up all indices for the dataset
         self.all_indices = np.arange(len(self.data))
@@ -65,7 +67,14 @@ class EMNISTDataset(EMNIST):
         self.mode = mode
 
     def set_transforms(self, transform):
-        self.transform = transform.get_transforms()
+        self.transform = transform
+
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    def get_target_encoding(self):
+        # Targets are returned as class indices and one-hot encoded per batch by the trainer.
+        return {'encoding': 'one_hot', 'num_classes': self.emnist_classes[self.split]}
 
     def set_fold(self, fold: int):
         if self.indices is None:
@@ -77,52 +86,68 @@ class EMNISTDataset(EMNIST):
         self.val_indices = self.indices[fold]['val']
         self.test_indices = self.indices[fold]['test']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        for train_val_idx, test_idx in kf.split(self.all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.all_indices), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             return len(self.train_indices)
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             return len(self.val_indices)
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             return len(self.test_indices)
         return super().__len__()
 
     def __getitem__(self, index: int) -> Tuple[Any, Any]:
-        if self.mode == 'train' and self.train_indices:
+        if self.mode == 'train' and len(self.train_indices):
             index = self.train_indices[index]
-        elif self.mode == 'val' and self.val_indices:
+        elif self.mode == 'val' and len(self.val_indices):
             index = self.val_indices[index]
-        elif self.mode == 'test' and self.test_indices:
+        elif self.mode == 'test' and len(self.test_indices):
             index = self.test_indices[index]
 
         img, target = self.data[index], self.targets[index]
 
-        if self.expand_to_rgb:
-            img_rgb_array = np.stack((img,) * 3, axis=-1)
-            img = Image.fromarray(img_rgb_array, mode='RGB')
+        if supports_tensor_input(self.transform):
+            img = self._to_tensor(img)
+            if self.transform is not None:
+                img = apply_transforms(self.transform, img, stage='tensor')
         else:
-            img = Image.fromarray(img, mode='L')
-
+            def load_image():
+                if self.expand_to_rgb:
+                    img_rgb_array = np.stack((img,) * 3, axis=-1)
+                    return Image.fromarray(img_rgb_array, mode='RGB')
+                return Image.fromarray(img, mode='L')
+
+            img = transform_sample(self.transform, load_image, cache=self.transform_cache,
+                                   key=index, train=self.mode == 'train')
+
+        return img, self._prepare_target(target)
+
+    def __getitems__(self, indices: List[int]) -> List[Tuple[Any, Any]]:
+        # Called by the DataLoader with a whole batch of indices; tensor samples are gathered and
+        # transformed in one go, everything else is fetched one by one
+        if not supports_tensor_input(self.transform):
+            return [self[index] for index in indices]
+
+        mode_indices = getattr(self, f"{self.mode}_indices")
+        if len(mode_indices):
+            indices = [mode_indices[index] for index in indices]
+        imgs = self._to_tensor(self.data[indices])
         if self.transform is not None:
-            try:
-                # Try to apply torchvision transforms
-                img = self.transform(img)
-            except TypeError:
-                # Apply albumentations transforms
-                img_np = np.array(img)
-                transformed = self.transform(image=img_np)
-                img = Image.fromarray(transformed['image'])
+            imgs = apply_transforms(self.transform, imgs, stage='tensor')
 
+        targets = [self._prepare_target(self.targets[index]) for index in indices]
+        return list(zip(imgs.unbind(0), targets))
+
+    def _to_tensor(self, img):
+        # Zero-copy (..., Channels, Height, Width) view of the stored uint8 array; RGB is a broadcast of the gray channel
+        img = torch.from_numpy(img).unsqueeze(-3)
+        if self.expand_to_rgb:
+            img = img.expand(*img.shape[:-3], 3, *img.shape[-2:])
+        return img
+
+    def _prepare_target(self, target):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
@@ -130,9 +155,7 @@ class EMNISTDataset(EMNIST):
             # classes are from 1 to 26
             if self.split=='letters':
                 target -= 1
-            target = one_hot_encode(labels=target, num_classes=self.emnist_classes[self.split], type="numpy")
-
-        return img, target
+        return target
 
 class _TestEMNISTDataset(unittest.TestCase):
     @classmethod
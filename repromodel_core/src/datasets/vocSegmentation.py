@@ -1,11 +1,12 @@
 from torchvision.datasets import VOCSegmentation
-from sklearn.model_selection import KFold, train_test_split
 import numpy as np
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from pathlib import Path
 from PIL import Image
 import unittest
 from ..decorators import enforce_types_and_ranges, tag
+from ..utils import transform_sample
+from ..caching import get_fold_indices
 
 @tag(task=["segmentation"], subtask=["semantic"], modality=["images"], submodality=["RGB"])
 class VOCSegmentationDataset(VOCSegmentation):
@@ -26,6 +27,7 @@ class VOCSegmentationDataset(VOCSegmentation):
         self.indices = None
         self.current_fold = None
         self.mode = 'train'
+        self.transform_cache = None
 
     def set_mode(self, mode: str):
         if mode not in ['train', 'val', 'test']:
@@ -33,7 +35,14 @@ class VOCSegmentationDataset(VOCSegmentation):
         self.mode = mode
 
     def set_transforms(self, transforms):
-        self.transforms = transforms.get_transforms()
+        self.transforms = transforms
+
+    def set_transform_cache(self, cache):
+        self.transform_cache = cache
+
+    def get_target_encoding(self):
+        # Masks are stacked with their complement along the last axis per batch by the trainer.
+        return {'encoding': 'complement', 'dim': -1}
 
     def set_fold(self, fold: int):
         if self.indices is None:
@@ -45,17 +54,8 @@ class VOCSegmentationDataset(VOCSegmentation):
         self.val_indices = self.indices[fold]['val']
         self.test_indices = self.indices[fold]['test']
 
-    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42):
-        kf = KFold(n_splits=k, shuffle=True, random_state=random_seed)
-        self.indices = []
-        all_indices = np.arange(len(self.images))
-        for train_val_idx, test_idx in kf.split(all_indices):
-            train_idx, val_idx = train_test_split(train_val_idx, test_size=test_size, random_state=random_seed)
-            self.indices.append({
-                'train': train_idx.tolist(),
-                'val': val_idx.tolist(),
-                'test': test_idx.tolist()
-            })
+    def generate_indices(self, k: int = 5, test_size: float = 0.2, random_seed: int = 42, store=None):
+        self.indices = get_fold_indices(len(self.images), k=k, test_size=test_size, random_seed=random_seed, store=store)
 
     def __len__(self) -> int:
         if self.mode == 'train':
@@ -74,22 +74,14 @@ class VOCSegmentationDataset(VOCSegmentation):
         elif self.mode == 'test':
             index = self.test_indices[index]
 
-        img = Image.open(self.images[index]).convert("RGB")
-        target = Image.open(self.masks[index])
-
-        if self.transforms is not None:
-            try:
-                #torchvision transforms
-                img = self.transforms(img)
-                target = self.transforms(target)
-            except:
-                #albumentation transforms 
-                img_np = np.array(img)
-                target_np = np.array(target)
-                transformed = self.transforms(image=img_np, mask=target_np)
-                img, target = transformed['image'], transformed['mask']
-                
-        target = np.stack((target, 1-target), axis=-1)
+        def load_sample():
+            return Image.open(self.images[index]).convert("RGB"), Image.open(self.masks[index])
+
+        img, target = transform_sample(self.transforms, load_sample, cache=self.transform_cache,
+                                       key=index, train=self.mode == 'train', with_mask=True)
+
+        # The complement channel is added per batch by the trainer
+        target = np.asarray(target)
         return img, target
 
 class _TestVOCSegmentationDataset(unittest.TestCase):
@@ -0,0 +1,97 @@
+import os
+from contextlib import contextmanager
+import torch
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+# Helpers for data-parallel training with torch.distributed. The trainer is started once per
+# process by torchrun, e.g. on each of two hosts:
+#   torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=host0:29500 \
+#       repromodel_core/trainer.py config.json
+# torchrun sets RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT, which init_distributed() reads.
+# Without a process group every helper falls back to single-process behaviour.
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group described by the torchrun environment variables.
+    Returns True if training runs in more than one process.
+    """
+    if is_distributed():
+        return True
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if not dist.is_available():
+        raise RuntimeError("torch.distributed is not available in this PyTorch build")
+    dist.init_process_group(backend=backend)
+    return True
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+@contextmanager
+def main_process_first():
+    """Let the main process run a block first, e.g. to fill a cache on disk, before the others run it."""
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers or tensors over all processes. Tensors keep their shape; the result is
+    a list in the same order, on the CPU.
+    """
+    if not is_distributed():
+        return values
+    tensors = [torch.as_tensor(value, dtype=torch.float64).detach().cpu() for value in values]
+    flat = torch.cat([tensor.flatten() for tensor in tensors])
+    dist.all_reduce(flat)
+    results, offset = [], 0
+    for value, tensor in zip(values, tensors):
+        part = flat[offset:offset + tensor.numel()].view(tensor.shape)
+        offset += tensor.numel()
+        results.append(part if isinstance(value, torch.Tensor) else part.item())
+    return results
+
+def broadcast_object(obj):
+    """Return obj of the main process on every process; obj must be picklable."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+def get_sampler(dataset, shuffle, seed=0, drop_last=False):
+    """
+    Return a DistributedSampler giving every process its own share of the dataset, or None when
+    not distributed. Without drop_last, a few samples are repeated so that all shares have equal size.
+    """
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle, seed=seed, drop_last=drop_last)
+
+def set_sampler_epoch(loader, epoch):
+    """Reshuffle the share of a DistributedSampler for a new epoch; also looks through an EchoingLoader and a ResumableSampler."""
+    loader = getattr(loader, 'loader', loader)
+    sampler = getattr(loader, 'sampler', None)
+    sampler = getattr(sampler, 'sampler', sampler)
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
@@ -0,0 +1,79 @@
+import math
+import random
+import torch
+from torch.utils.data import default_collate
+
+def _select(batch, i):
+    # Take sample i out of a collated batch (tensors, or tuples, lists and dicts of them)
+    if isinstance(batch, torch.Tensor):
+        return batch[i]
+    if isinstance(batch, dict):
+        return {key: _select(value, i) for key, value in batch.items()}
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_select(value, i) for value in batch)
+    return batch
+
+def _batch_size(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.size(0)
+    if isinstance(batch, dict):
+        return _batch_size(next(iter(batch.values())))
+    return _batch_size(batch[0])
+
+class EchoingLoader:
+    """
+    Data echoing for slow input pipelines: every sample read from the wrapped DataLoader is used
+    echo_factor times, so the model keeps training while the workers load the next samples.
+
+    Loaded batches are split into samples, each sample is put echo_factor times into a shuffle buffer,
+    and batches are drawn from the buffer at random, so repeats of a sample are spread over several
+    batches. Echoes are only augmented differently by augmentations applied after this stage, i.e.
+    with augmentation_mode "batch"; otherwise they repeat the same augmented sample.
+
+    An epoch of the echoing loader yields echo_factor times as many samples as the wrapped loader.
+
+    Args:
+    - loader (DataLoader): The training DataLoader.
+    - echo_factor (int): How often every loaded sample is used.
+    - buffer_size (int): Number of samples in the shuffle buffer; 0 uses four batches.
+    - seed (int): Seed for drawing from the buffer.
+    """
+    def __init__(self, loader, echo_factor=2, buffer_size=0, seed=None):
+        if echo_factor < 1:
+            raise ValueError("echo_factor should be at least 1")
+        self.loader = loader
+        self.echo_factor = echo_factor
+        self.batch_size = loader.batch_size
+        self.buffer_size = max(buffer_size or 4 * self.batch_size, self.batch_size)
+        self.drop_last = loader.drop_last
+        self.rng = random.Random(seed)
+        self.fresh_samples = 0
+
+    def __len__(self):
+        num_samples = len(self.loader.dataset) * self.echo_factor
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return math.ceil(num_samples / self.batch_size)
+
+    def _draw(self, buffer, size):
+        samples = []
+        for _ in range(size):
+            j = self.rng.randrange(len(buffer))
+            buffer[j], buffer[-1] = buffer[-1], buffer[j]
+            samples.append(buffer.pop())
+        return default_collate(samples)
+
+    def __iter__(self):
+        self.fresh_samples = 0
+        buffer = []
+        for batch in self.loader:
+            size = _batch_size(batch)
+            self.fresh_samples += size
+            for i in range(size):
+                sample = _select(batch, i)
+                buffer.extend([sample] * self.echo_factor)
+            while len(buffer) >= self.buffer_size:
+                yield self._draw(buffer, self.batch_size)
+
+        while len(buffer) >= self.batch_size or (buffer and not self.drop_last):
+            yield self._draw(buffer, min(self.batch_size, len(buffer)))
@@ -0,0 +1,75 @@
+import json
+import torch
+from torch.func import functional_call, vmap
+
+def get_member_params(config):
+    """
+    Return the per-member optimizer parameter overrides of a vectorised ensemble, e.g.
+    [{"lr": 0.01}, {"lr": 0.001, "seed": 3}]. A "seed" entry seeds the initial weights of the member.
+    The list may be given as JSON string.
+    """
+    ensemble = config.get("vmap_ensemble", {})
+    members = ensemble.get("member_params", [])
+    if isinstance(members, str):
+        members = json.loads(members) if members.strip() else []
+    if not members and ensemble.get("mode", "none") == "hyperparameters":
+        raise ValueError("vmap_ensemble.mode 'hyperparameters' needs at least one entry in vmap_ensemble.member_params")
+    return [dict(member) for member in members]
+
+def ensemble_forward(models, inputs, shared_inputs=False):
+    """
+    Run several models of the same architecture as one batched computation.
+
+    The parameters and buffers of the members are stacked along a new first dimension and the
+    template model is called on them with torch.func.functional_call under vmap. Stacking is
+    differentiable, so gradients flow back into the parameters of every member and each member can
+    keep its own optimizer. Buffers updated during the call (e.g. BatchNorm running statistics) are
+    copied back into the members.
+
+    Args:
+    - models (list): Members with identical architecture, in train or eval mode.
+    - inputs (Tensor): Batch of shape N x B x ..., one batch per member, or B x ... if shared_inputs.
+    - shared_inputs (bool): Whether all members get the same batch.
+
+    Returns:
+    - Outputs of shape N x B x ...
+    """
+    member_params = [dict(model.named_parameters()) for model in models]
+    member_buffers = [dict(model.named_buffers()) for model in models]
+    params = {name: torch.stack([member[name] for member in member_params]) for name in member_params[0]}
+    buffers = {name: torch.stack([member[name] for member in member_buffers]) for name in member_buffers[0]}
+
+    def call(params, buffers, x):
+        return functional_call(models[0], (params, buffers), (x,))
+
+    outputs = vmap(call, in_dims=(0, 0, None if shared_inputs else 0), randomness='different')(params, buffers, inputs)
+
+    with torch.no_grad():
+        for i, member in enumerate(member_buffers):
+            for name, buffer in member.items():
+                buffer.copy_(buffers[name][i])
+    return outputs
+
+def train_ensemble_step(runs, inputs, labels, shared_inputs=False):
+    """
+    One optimizer step for every run of a vectorised ensemble.
+
+    The forward and backward passes of all members run as one batched computation; afterwards
+    every run steps its own optimizer and records loss and metrics as in FoldRun.train_step().
+
+    Args:
+    - runs (list): FoldRun objects whose models share an architecture.
+    - inputs (Tensor): N x B x ... batches, or a single B x ... batch if shared_inputs.
+    - labels (Tensor): Encoded labels, stacked like inputs.
+    - shared_inputs (bool): Whether all members get the same batch.
+    """
+    for run in runs:
+        run.optimizer.zero_grad()
+    outputs = ensemble_forward([run.model for run in runs], inputs, shared_inputs=shared_inputs)
+    member_labels = [labels if shared_inputs else labels[i] for i in range(len(runs))]
+    losses = [run.criterion(outputs[i], member_labels[i]) for i, run in enumerate(runs)]
+    # Every loss only depends on its own member, so one backward pass yields all gradients
+    torch.stack(losses).sum().backward()
+    for i, run in enumerate(runs):
+        run.optimizer.step()
+        run.record_step(outputs[i].detach(), member_labels[i], losses[i])
@@ -1,9 +1,14 @@
 import json
 import importlib
 from torch.utils.tensorboard import SummaryWriter
-from src.utils import ensure_folder_exists
+from src.utils import ensure_folder_exists, hash_params, print_to_file, encode_targets
+from src.caching import TransformCache, FoldIndexStore
+from src.distributed import is_main_process
 import os
 import os.path
+import inspect
+import torch
+from functools import partial
 from typing import Any, List
 from sklearn.model_selection import train_test_split, KFold
 import numpy as np
@@ -63,15 +68,91 @@ def configure_component(name, params):
         # if not found in the source code, look for the class in third-party libs
         return get_from_lib(module, name, params)
 
+def set_streaming_preprocessor(dataset, preprocessor, dataset_name):
+    if not hasattr(dataset, 'set_preprocessor'):
+        raise ValueError(f"Dataset '{dataset_name}' does not support on-the-fly preprocessing")
+    if not hasattr(preprocessor, 'load_sample'):
+        raise ValueError(f"Preprocessor '{type(preprocessor).__name__}' does not support on-the-fly preprocessing")
+    dataset.set_preprocessor(preprocessor)
+
+def set_transform_cache(dataset, augmentor, config):
+    """
+    Attach a cache for the deterministic prefix of the augmentation to the dataset, as selected by
+    config.transform_cache ('none', 'memory' or 'disk'). Disk caches live under config.cache_path in
+    a folder named after the dataset and augmentation configuration, so they are reused across runs.
+
+    Returns the cache, or None if caching is disabled or not possible.
+    """
+    storage = config.get("transform_cache", "none")
+    if storage == "none":
+        return None
+    if not hasattr(dataset, 'set_transform_cache'):
+        raise ValueError(f"Dataset '{config.datasets}' does not support transform caching")
+    if augmentor.get_pipeline('deterministic') is None:
+        print_to_file(f"{config.augmentations} declares no deterministic transforms, transform caching is disabled")
+        return None
+    key = hash_params({
+        'dataset': config.datasets,
+        'dataset_params': config.datasets_params[config.datasets],
+        'augmentation': config.augmentations,
+        'augmentation_params': config.augmentations_params[config.augmentations]
+    })
+    cache_path = os.path.join(config.get("cache_path", "repromodel_core/cache/"), "transforms", key[:16])
+    cache = TransformCache(storage=storage, path=cache_path if storage == "disk" else None)
+    dataset.set_transform_cache(cache)
+    return cache
+
+def generate_fold_indices(dataset, config):
+    """
+    Generate the cross-validation folds of a dataset through a shared FoldIndexStore, so the trainer,
+    the tester and later runs with the same dataset configuration reuse the same int32 index arrays.
+    config.fold_cache selects 'memory' (per process), 'disk' (saved under config.cache_path) or 'mmap'
+    (saved and memory-mapped). Datasets whose generate_indices() takes no store compute their own folds.
+    """
+    k, random_seed = config.data_splits.k, config.data_splits.random_seed
+    if 'store' not in inspect.signature(dataset.generate_indices).parameters:
+        dataset.generate_indices(k=k, random_seed=random_seed)
+        return
+    storage = config.get("fold_cache", "disk")
+    fingerprint = hash_params({'dataset': config.datasets, 'dataset_params': config.datasets_params[config.datasets]})
+    path = None if storage == "memory" else os.path.join(config.get("cache_path", "repromodel_core/cache/"), "folds")
+    store = FoldIndexStore(path=path, fingerprint=fingerprint, mmap=storage == "mmap")
+    dataset.generate_indices(k=k, random_seed=random_seed, store=store)
+
+def get_target_encoder(dataset, config):
+    """
+    Build the function that expands a collated batch of compact targets before the loss and metrics.
+
+    The dataset describes its targets with get_target_encoding(); config.target_encoding overrides the
+    encoding unless it is 'auto', and config.label_smoothing and config.target_dtype adjust the result.
+    Datasets without get_target_encoding() are passed through unchanged.
+    """
+    if hasattr(dataset, 'get_target_encoding'):
+        encoding = dict(dataset.get_target_encoding())
+    else:
+        encoding = {'encoding': 'none'}
+    if config.get("target_encoding", "auto") != "auto":
+        encoding['encoding'] = config.target_encoding
+    encoding['smoothing'] = config.get("label_smoothing", 0.0)
+    encoding['dtype'] = getattr(torch, config.get("target_dtype", "float32"))
+    return partial(encode_targets, **encoding)
+
 def configure_device_specific(component, device):
     if hasattr(component, 'to'):
         return component.to(device)
     return component
 
-def init_tensorboard_logging(config, fold, model_num, base_dir="logs"):
+class _NullWriter:
+    # Stands in for the SummaryWriter on processes that do not log
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def init_tensorboard_logging(config, fold, model_num, base_dir="logs", suffix=""):
+    if not is_main_process():
+        return _NullWriter()
     base_dir = config.tensorboard_log_path
     ensure_folder_exists(base_dir)
-    subdir = f"{base_dir}/{config['training_name']}_{config['models'][model_num].split('.')[-1]}_{config['datasets'].split('.')[-1]}_{fold}"
+    subdir = f"{base_dir}/{config['training_name']}_{config['models'][model_num].split('.')[-1]}{suffix}_{config['datasets'].split('.')[-1]}_{fold}"
     ensure_folder_exists(subdir)
     writer = SummaryWriter(subdir)
     config_path = f"{subdir}/config.json"
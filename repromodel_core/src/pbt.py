@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import subprocess
+import torch
+from .utils import print_to_file, ensure_folder_exists, load_state, save_manifest
+from .sweeps import CHOICES_PATH, TRAINER_SCRIPT, resolve_search_space, random_search, _trial_config
+
+# Population-based training: every member of the population is an ordinary trainer process. At
+# regular intervals a member publishes its weights, optimizer, scheduler and early-stopping states
+# and its latest validation loss in the population folder. A member in the bottom quantile then
+# copies the states of a member from the top quantile (exploit) and perturbs the copied
+# hyperparameters (explore). Members exchange states only within the same model and fold, as the
+# weights of different architectures do not fit each other.
+#
+# Hyperparameters are named by their config path, as in sweeps. Optimizer parameters
+# (optimizers_params.<optimizer>.<name>) are changed in the optimizer's param groups, augmentation
+# parameters (augmentations_params.<augmentation>.<name>) on the augmentation object.
+
+def _save_state(state_dict, path):
+    # Write to a temporary file first, so that other members never load partial files
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, path)
+
+def apply_hyperparameters(run, hyperparameters, augmentor=None):
+    """
+    Set hyperparameters given by config path on a running FoldRun. Returns True if the
+    augmentation changed, in which case pipelines and batch transforms have to be rebuilt.
+    """
+    augmentation_changed = False
+    for path, value in hyperparameters.items():
+        kind, name = path.split('.')[0], path.split('.')[-1]
+        if kind == 'optimizers_params':
+            for i, group in enumerate(run.optimizer.param_groups):
+                if name == 'lr' and hasattr(run.lr_scheduler, 'base_lrs') and group['lr'] > 0:
+                    # Keep the schedule relative to the new learning rate
+                    run.lr_scheduler.base_lrs[i] *= value / group['lr']
+                group[name] = value
+        elif kind == 'augmentations_params':
+            if augmentor is None:
+                raise ValueError(f"No augmentation to set '{path}' on")
+            setattr(augmentor, name, value)
+            augmentation_changed = True
+        else:
+            raise ValueError(f"'{path}' cannot be changed during training")
+    if augmentation_changed and isinstance(getattr(augmentor, '_pipelines', None), dict):
+        augmentor._pipelines.clear()
+    return augmentation_changed
+
+class PopulationMember:
+    """
+    Exploit and explore steps of one population member, called by FoldRun after every validation.
+
+    Args:
+    - config (dict): The 'pbt' section of the member's training config:
+        - population_dir (str): Folder shared by all members.
+        - member_id (int): Index of this member.
+        - hyperparameters (dict): Current hyperparameters by config path.
+        - space (dict): Resolved search space of the hyperparameters, see sweeps.resolve_search_space().
+        - ready_every (int): Validations between two exploit and explore steps.
+        - quantile (float): Fraction of members that copy from, and are copied by, others.
+        - perturb_factors (list): Factors numeric hyperparameters are multiplied with.
+        - resample_probability (float): Probability of drawing a categorical hyperparameter anew.
+    - apply (callable): Called with (run, hyperparameters) to set perturbed hyperparameters.
+    """
+    def __init__(self, config, apply):
+        self.population_dir = config['population_dir']
+        self.member_id = config['member_id']
+        self.hyperparameters = dict(config['hyperparameters'])
+        self.space = config['space']
+        self.ready_every = config.get('ready_every', 2)
+        self.quantile = config.get('quantile', 0.25)
+        self.perturb_factors = config.get('perturb_factors', [0.8, 1.2])
+        self.resample_probability = config.get('resample_probability', 0.25)
+        self.apply = apply
+        self.rng = random.Random(self.member_id)
+        self.validations = 0
+
+    def _fold_dir(self, run):
+        # Runs are named after their model (and ensemble member), see FoldRun.name
+        return os.path.join(self.population_dir, run.name, f"fold_{run.k}")
+
+    def _member_dir(self, run, member_id):
+        return os.path.join(self._fold_dir(run), f"member_{member_id}")
+
+    def _read_scores(self, run):
+        fold_dir = self._fold_dir(run)
+        scores = []
+        for entry in os.scandir(fold_dir):
+            score_path = os.path.join(entry.path, "score.json")
+            if entry.is_dir() and os.path.exists(score_path):
+                try:
+                    with open(score_path, 'r') as f:
+                        scores.append(json.load(f))
+                except (OSError, json.JSONDecodeError):
+                    continue
+        return scores
+
+    def _publish(self, run, val_loss):
+        member_dir = self._member_dir(run, self.member_id)
+        ensure_folder_exists(member_dir)
+        states = {'model': run.model, 'optimizer': run.optimizer, 'lr_scheduler': run.lr_scheduler,
+                  'early_stopping': run.early_stopper}
+        for name, component in states.items():
+            if hasattr(component, 'state_dict'):
+                _save_state(component.state_dict(), os.path.join(member_dir, f"{name}.pt"))
+        save_manifest(os.path.join(member_dir, "score.json"), {
+            'member_id': self.member_id, 'model': run.name, 'score': val_loss, 'step': run.global_step,
+            'hyperparameters': self.hyperparameters})
+
+    def _explore(self, hyperparameters):
+        explored = {}
+        for path, value in hyperparameters.items():
+            spec = self.space[path]
+            if spec['kind'] == 'categorical':
+                explored[path] = self.rng.choice(spec['options']) if self.rng.random() < self.resample_probability else value
+            else:
+                value = min(max(value * self.rng.choice(self.perturb_factors), spec['low']), spec['high'])
+                explored[path] = int(round(value)) if spec['kind'] == 'int' else value
+        return explored
+
+    def step(self, run, val_loss):
+        """Publish the state of run and, if it is among the worst members, replace it by a perturbed copy of a better one."""
+        self.validations += 1
+        if self.validations % self.ready_every:
+            return
+        self._publish(run, val_loss)
+
+        scores = sorted(self._read_scores(run), key=lambda entry: entry['score'])
+        if len(scores) < 2:
+            return
+        cutoff = max(1, int(math.ceil(len(scores) * self.quantile)))
+        top, bottom = scores[:cutoff], scores[-cutoff:]
+        if not any(entry['member_id'] == self.member_id for entry in bottom) or \
+                any(entry['member_id'] == self.member_id for entry in top):
+            return
+
+        # Exploit: continue from the states of a better member
+        donor = self.rng.choice(top)
+        donor_dir = self._member_dir(run, donor['member_id'])
+        try:
+            run.model = load_state(run.model, torch.load(os.path.join(donor_dir, "model.pt"), map_location=run.cfg.device))
+            run.optimizer = load_state(run.optimizer, torch.load(os.path.join(donor_dir, "optimizer.pt")))
+            run.lr_scheduler = load_state(run.lr_scheduler, torch.load(os.path.join(donor_dir, "lr_scheduler.pt")))
+            if os.path.exists(os.path.join(donor_dir, "early_stopping.pt")):
+                run.early_stopper = load_state(run.early_stopper, torch.load(os.path.join(donor_dir, "early_stopping.pt")))
+        except (OSError, RuntimeError) as e:
+            print_to_file(f"PBT member {self.member_id} could not copy member {donor['member_id']}: {e}", config=run.cfg, model_num=run.m)
+            return
+
+        # Explore: perturb the hyperparameters of the donor
+        self.hyperparameters = self._explore(donor['hyperparameters'])
+        self.apply(run, self.hyperparameters)
+        run.writer.add_scalar('PBT/Copied Member', donor['member_id'], run.global_step)
+        print_to_file(f"PBT member {self.member_id} (val loss {val_loss}) copied member {donor['member_id']} "
+                      f"(val loss {donor['score']}) and continues with {self.hyperparameters}", config=run.cfg, model_num=run.m)
+
+def run_population(pbt_config):
+    """
+    Train a population with population-based training and return the final ranking.
+
+    Args:
+    - pbt_config (dict): Sweep config with method 'pbt'. Uses sweep_name, base_config,
+      search_space, seed and output_path as run_sweep() does, plus:
+        - population_size (int): Number of members, all trained at the same time.
+        - ready_every, quantile, perturb_factors, resample_probability: See PopulationMember.
+    """
+    sweep_name = pbt_config['sweep_name']
+    base_config = pbt_config['base_config']
+    if isinstance(base_config, str):
+        with open(base_config, 'r') as f:
+            base_config = json.load(f)
+    choices = None
+    if os.path.exists(CHOICES_PATH):
+        with open(CHOICES_PATH, 'r') as f:
+            choices = json.load(f)
+    space = resolve_search_space(pbt_config['search_space'], choices)
+    for path in space:
+        if path.split('.')[0] not in ('optimizers_params', 'augmentations_params'):
+            raise ValueError(f"'{path}' cannot be changed during training; PBT supports optimizer and augmentation parameters")
+
+    sweep_dir = os.path.join(pbt_config.get('output_path', 'repromodel_core/sweeps/'), sweep_name)
+    population_dir = os.path.join(sweep_dir, "population")
+    ensure_folder_exists(population_dir)
+    population_size = pbt_config.get('population_size', 4)
+    rng = random.Random(pbt_config.get('seed', 0))
+    env = dict(os.environ, OMP_NUM_THREADS=str(max(1, (os.cpu_count() or 1) // population_size)))
+
+    members = []
+    for member_id in range(population_size):
+        hyperparameters = random_search(space, rng)
+        config, member_dir = _trial_config(base_config, hyperparameters, sweep_dir, sweep_name, member_id)
+        config['pbt'] = {
+            'population_dir': population_dir, 'member_id': member_id, 'hyperparameters': hyperparameters,
+            # Resolved here, as the trainer replaces the '>' that choices.json lookups rely on
+            'space': space,
+            **{key: pbt_config[key] for key in ('ready_every', 'quantile', 'perturb_factors', 'resample_probability') if key in pbt_config}
+        }
+        ensure_folder_exists(member_dir)
+        with open(os.path.join(member_dir, "config.json"), 'w') as f:
+            json.dump(config, f, indent=4)
+        log_file = open(os.path.join(member_dir, "trainer_output.txt"), 'w')
+        process = subprocess.Popen([sys.executable, TRAINER_SCRIPT, json.dumps(config)],
+                                   stdout=log_file, stderr=subprocess.STDOUT, env=env)
+        members.append({'id': member_id, 'process': process, 'log_file': log_file})
+        print_to_file(f"Population {sweep_name}: started member {member_id} with {hyperparameters}")
+
+    while any(member['process'].poll() is None for member in members):
+        time.sleep(pbt_config.get('poll_interval', 2))
+    for member in members:
+        member['log_file'].close()
+
+    # Rank the members by their last published validation loss, per model and fold
+    ranking = []
+    for model_entry in sorted(os.scandir(population_dir), key=lambda entry: entry.name):
+        if not model_entry.is_dir():
+            continue
+        for fold_entry in sorted(os.scandir(model_entry.path), key=lambda entry: entry.name):
+            if not fold_entry.is_dir():
+                continue
+            scores = []
+            for member_entry in os.scandir(fold_entry.path):
+                score_path = os.path.join(member_entry.path, "score.json")
+                if os.path.exists(score_path):
+                    with open(score_path, 'r') as f:
+                        scores.append(json.load(f))
+            ranking.append({'model': model_entry.name, 'fold': fold_entry.name,
+                            'members': sorted(scores, key=lambda entry: entry['score'])})
+    with open(os.path.join(sweep_dir, "leaderboard.json"), 'w') as f:
+        json.dump(ranking, f, indent=4)
+
+    print_to_file(f"Population {sweep_name} finished.")
+    for fold in ranking:
+        for rank, entry in enumerate(fold['members'], start=1):
+            print_to_file(f"{fold['model']} {fold['fold']} {rank}. member {entry['member_id']}: val loss {entry['score']} with {entry['hyperparameters']}")
+    return ranking
@@ -4,7 +4,7 @@ import multiprocessing
 from pathlib import Path
 from tqdm import tqdm
 from ..decorators import enforce_types_and_ranges, tag
-from utils import print_to_file
+from utils import print_to_file, hash_params, file_fingerprint, load_manifest, save_manifest, get_stale_files, chunk_list, list_files
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 # In tag decorator, specify custom task, subtask, modality, and submodality. 
@@ -21,32 +21,63 @@ class CustomPreprocessor:
         'data_path': {'type': str},
         'output_path': {'type': str},
         'input_type': {'type': str, 'options': ['input', 'output', 'temp']},
-        'num_workers': {'type': int, 'range': (1, 32)}
+        'num_workers': {'type': int, 'range': (1, 32)},
+        'chunk_size': {'type': int, 'default': 32, 'range': (1, 4096)}
     })
-    def __init__(self, data_path, output_path, input_type='input', num_workers=1):
+    def __init__(self, data_path, output_path, input_type='input', num_workers=1, chunk_size=32):
         self.input_type = input_type
         self.output_path = Path(output_path) / input_type
         self.data_path = Path(data_path) / input_type
         self.output_path_type = Path(output_path) / input_type
         self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        # Fingerprint of everything that changes the produced files, used to skip unchanged outputs.
+        # Add every preprocessing parameter here; num_workers and chunk_size only change the speed.
+        self.fingerprint = hash_params({
+            'preprocessor': type(self).__name__,
+            'data_path': str(self.data_path),
+            'output_path': str(self.output_path),
+            'input_type': input_type
+        })
         self._create_output_dirs()
 
     def _create_output_dirs(self):
         self.output_path_type.mkdir(parents=True, exist_ok=True)
 
-    def _process_file(self, file_path, output_path):
+    def _output_file(self, file_path):
+        # Define where the processed version of file_path is written
+        return self.output_path_type / file_path.name
+
+    def _process_file(self, file_path):
         # Define specific processing logic here
         pass
 
+    def _process_chunk(self, file_paths):
+        entries = []
+        for file_path in file_paths:
+            fingerprint = file_fingerprint(file_path)
+            self._process_file(file_path)
+            entries.append((file_path.name, fingerprint))
+        return entries
+
     def preprocess(self):
-        input_paths = list(self.data_path.glob('*'))  # List all files in data_path
-        log_message = f"Starting preprocessing of {len(input_paths)} files.\n"
+        # List all files in data_path, reusing the cached listing if the folder is unchanged
+        input_paths = [Path(path) for path in list_files(self.data_path, recursive=False)]
+        manifest_path = self.output_path_type / ".manifest.json"
+        manifest = load_manifest(manifest_path, self.fingerprint)
+        stale_paths = get_stale_files(input_paths, manifest, self._output_file)
+        log_message = f"Starting preprocessing of {len(stale_paths)} of {len(input_paths)} files.\n"
         print_to_file(log_message)
 
+        # Files are processed in chunks so that each worker task covers many files
+        chunk_size = max(1, min(self.chunk_size, -(-len(stale_paths) // self.num_workers)))
+        chunks = chunk_list(stale_paths, chunk_size)
         if self.num_workers > 1:
             with multiprocessing.Pool(self.num_workers) as pool:
-                list(tqdm(pool.imap(self._process_file, input_paths), total=len(input_paths)))
+                for entries in tqdm(pool.imap(self._process_chunk, chunks), total=len(chunks)):
+                    manifest['files'].update(entries)
         else:
-            for file_path in tqdm(input_paths):
-                self._process_file(file_path)
+            for chunk in tqdm(chunks):
+                manifest['files'].update(self._process_chunk(chunk))
+        save_manifest(manifest_path, manifest)
 
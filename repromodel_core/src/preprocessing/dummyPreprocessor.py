@@ -1,21 +1,34 @@
+import os
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from PIL import Image
 import numpy as np
 from tqdm import tqdm
 from ..decorators import enforce_types_and_ranges
-from ..utils import print_to_file
+from ..utils import print_to_file, hash_params, file_fingerprint, load_manifest, save_manifest, get_stale_files, chunk_list, list_files
 
 class DummyPreprocessor:
     @enforce_types_and_ranges({
         'parent_input_path': {'type': str},
         'parent_output_path': {'type': str},
-        'num_workers': {'type': int, 'range': (1, 32)}
+        'num_workers': {'type': int, 'range': (1, 32)},
+        'chunk_size': {'type': int, 'default': 32, 'range': (1, 4096)},
+        'use_cache': {'type': bool, 'default': True}
     })
-    def __init__(self, parent_input_path, parent_output_path, num_workers=1):
+    def __init__(self, parent_input_path, parent_output_path, num_workers=1, chunk_size=32, use_cache=True):
         self.parent_input_path = parent_input_path
         self.parent_output_path = parent_output_path
         self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.use_cache = use_cache
+        self.write_through = False
+
+        # Only parameters that change the produced files belong in the fingerprint
+        self.fingerprint = hash_params({
+            'preprocessor': type(self).__name__,
+            'parent_input_path': str(Path(parent_input_path).resolve()),
+            'parent_output_path': str(Path(parent_output_path).resolve())
+        })
 
     def create_paths(self, input_type):
         self.input_type = input_type
@@ -26,32 +39,104 @@ class DummyPreprocessor:
     def _create_output_dirs(self):
         self.output_path.mkdir(parents=True, exist_ok=True)
 
-    def _process_file(self, file_path):
+    def _output_file(self, file_path):
+        return self.output_path / (file_path.name.replace(".png", "") + ".npy")
+
+    def _transform_file(self, file_path):
         # Load the image
         image = Image.open(file_path)
         image_array = np.array(image, dtype=np.float32)
 
         # Normalize the image data to 0-1
-        normalized_image = image_array / 255.0
+        return image_array / 255.0
 
+    def _process_file(self, file_path):
         # Save the processed image
-        output_path = self.output_path / file_path.name.replace(".png", "")
-        np.save(output_path, normalized_image)
+        np.save(self._output_file(file_path), self._transform_file(file_path))
+
+    def set_streaming(self, write_through=False):
+        """
+        Prepare the preprocessor to be applied per sample by a dataset instead of upfront.
+
+        Parameters:
+        - write_through: If True, every sample processed on the fly is also saved to a cache
+          folder under parent_output_path and read from there on later epochs.
+        """
+        self.write_through = write_through
+        self.stream_cache_path = Path(self.parent_output_path) / ".stream_cache" / self.fingerprint[:16]
+
+    def _stream_cache_file(self, file_path):
+        try:
+            relative_path = Path(file_path).resolve().relative_to(Path(self.parent_input_path).resolve())
+        except ValueError:
+            relative_path = Path(hash_params(str(Path(file_path).resolve()))) / Path(file_path).name
+        return self.stream_cache_path / relative_path.with_suffix(".npy")
+
+    def load_sample(self, file_path):
+        """
+        Return the preprocessed version of a single raw file, as used in on-the-fly mode.
+        Safe to call from several DataLoader workers at once.
+        """
+        if not self.write_through:
+            return self._transform_file(file_path)
+
+        cache_file = self._stream_cache_file(file_path)
+        if cache_file.exists() and cache_file.stat().st_mtime_ns >= os.stat(file_path).st_mtime_ns:
+            return np.load(cache_file)
+
+        sample = self._transform_file(file_path)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a per-process temporary file first so concurrent workers never see partial files
+        tmp_file = cache_file.with_name(f".{cache_file.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp_file, sample)
+        os.replace(tmp_file, cache_file)
+        return sample
+
+    def _process_chunk(self, file_paths):
+        """Process a chunk of files and return their manifest entries."""
+        entries = []
+        for file_path in file_paths:
+            fingerprint = file_fingerprint(file_path)
+            self._process_file(file_path)
+            entries.append((file_path.name, fingerprint))
+        return entries
 
     def preprocess(self):
         for input_type in ['input','target']:
             self.create_paths(input_type)
 
-            input_paths = list(self.data_path.glob('*'))  # List all files in data_path
-            print_to_file(f"Starting preprocessing of {len(input_paths)} files for {input_type}")
+            # List all files in data_path, reusing the cached listing if the folder is unchanged
+            input_paths = [Path(path) for path in list_files(self.data_path, recursive=False)]
+            manifest_path = self.output_path / ".manifest.json"
+            manifest = load_manifest(manifest_path, self.fingerprint) if self.use_cache else {'fingerprint': self.fingerprint, 'files': {}}
+            stale_paths = get_stale_files(input_paths, manifest, self._output_file)
+
+            if not stale_paths:
+                print_to_file(f"All {len(input_paths)} {input_type} files are up to date, skipping preprocessing")
+                save_manifest(manifest_path, manifest)
+                continue
+            print_to_file(f"Starting preprocessing of {len(stale_paths)} of {len(input_paths)} files for {input_type}")
+
+            # Submit one task per chunk instead of one per file to amortise pickling and IPC
+            chunk_size = min(self.chunk_size, -(-len(stale_paths) // self.num_workers))
+            chunks = chunk_list(stale_paths, chunk_size)
+            with tqdm(total=len(stale_paths)) as progress_bar:
+                if self.num_workers > 1 and len(chunks) > 1:
+                    with ProcessPoolExecutor(max_workers=min(self.num_workers, len(chunks))) as executor:
+                        for entries in executor.map(self._process_chunk, chunks):
+                            manifest['files'].update(entries)
+                            progress_bar.update(len(entries))
+                else:
+                    for chunk in chunks:
+                        entries = self._process_chunk(chunk)
+                        manifest['files'].update(entries)
+                        progress_bar.update(len(entries))
 
-            if self.num_workers > 1:
-                with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
-                    list(tqdm(executor.map(self._process_file, input_paths), total=len(input_paths)))
-            else:
-                for file_path in tqdm(input_paths):
-                    self._process_file(file_path)
-        print_to_file(f"Finished preprocessing of {input_type} files")
+            # Forget files that no longer exist in the input folder
+            input_names = {path.name for path in input_paths}
+            manifest['files'] = {name: entry for name, entry in manifest['files'].items() if name in input_names}
+            save_manifest(manifest_path, manifest)
+            print_to_file(f"Finished preprocessing of {input_type} files")
 
 def main():
     preprocessor = DummyPreprocessor(
@@ -62,4 +147,4 @@ def main():
     preprocessor.preprocess()
 
 # if __name__ == '__main__':
-#     main()
\ No newline at end of file
+#     main()
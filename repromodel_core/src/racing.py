@@ -0,0 +1,109 @@
+import os
+import json
+import math
+import tempfile
+import unittest
+from scipy import stats
+from .utils import save_manifest, ensure_folder_exists
+from .distributed import is_main_process
+
+class FoldRace:
+    """
+    Racing over the folds of a cross-validation: after every completed fold, every candidate
+    model is compared with the best model so far on the folds both have completed. A candidate
+    whose fold scores are worse with a one-sided paired t-test at level alpha is out of contention
+    and its remaining folds are not trained.
+
+    Fold scores are the best validation losses; lower is better. The scores and the decisions are
+    written to path after every fold, so an abandoned model keeps its partial results and a
+    resumed training continues the race.
+
+    Args:
+    - path (str): JSON file the race is recorded in.
+    - alpha (float): Significance level of the test.
+    - min_folds (int): Folds a candidate completes before it can be abandoned.
+    - resume (bool): Whether to continue the race recorded in path.
+    """
+    def __init__(self, path, alpha=0.05, min_folds=2, resume=False):
+        self.path = path
+        self.alpha = alpha
+        self.min_folds = max(2, min_folds)
+        self.candidates = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.candidates = json.load(f)['candidates']
+
+    def record(self, name, fold, score):
+        """Record the score of a candidate on a completed fold."""
+        candidate = self.candidates.setdefault(name, {'scores': {}, 'status': 'running'})
+        candidate['scores'][str(fold)] = score
+
+    def mean_score(self, name):
+        scores = self.candidates[name]['scores'].values()
+        return sum(scores) / len(scores) if scores else float('inf')
+
+    def best(self):
+        """Name of the candidate with the lowest mean fold score, ignoring abandoned ones."""
+        contenders = [name for name, candidate in self.candidates.items()
+                      if candidate['status'] != 'abandoned' and candidate['scores']]
+        return min(contenders, key=self.mean_score) if contenders else None
+
+    def _p_value(self, name, best):
+        # One-sided paired t-test of H0: the candidate is not worse than the best on the shared folds
+        folds = sorted(set(self.candidates[name]['scores']) & set(self.candidates[best]['scores']))
+        if len(folds) < self.min_folds:
+            return None
+        differences = [self.candidates[name]['scores'][k] - self.candidates[best]['scores'][k] for k in folds]
+        if all(d == differences[0] for d in differences):
+            # No variance: the test is undefined, only a consistent loss decides
+            return 0.0 if differences[0] > 0 else 1.0
+        p_value = stats.ttest_1samp(differences, 0.0, alternative='greater').pvalue
+        return None if math.isnan(p_value) else float(p_value)
+
+    def eliminate(self, names):
+        """Abandon the candidates among names that are out of contention and return them."""
+        best = self.best()
+        abandoned = []
+        for name in names:
+            # Candidates without a finite score on any fold yet (e.g. a NaN loss) have nothing to compare
+            if best is None or name == best or name not in self.candidates or self.candidates[name]['status'] == 'abandoned':
+                continue
+            p_value = self._p_value(name, best)
+            if p_value is not None and p_value < self.alpha:
+                self.candidates[name].update(status='abandoned', against=best, p_value=p_value)
+                abandoned.append(name)
+        return abandoned
+
+    def finish(self, name):
+        if self.candidates.get(name, {}).get('status') == 'running':
+            self.candidates[name]['status'] = 'complete'
+
+    def save(self):
+        if not is_main_process():
+            return
+        ensure_folder_exists(os.path.dirname(self.path) or '.')
+        save_manifest(self.path, {'alpha': self.alpha, 'min_folds': self.min_folds, 'best': self.best(),
+                                  'candidates': self.candidates})
+
+class _TestFoldRace(unittest.TestCase):
+    def test_eliminate_consistently_worse_candidate(self):
+        race = FoldRace(os.path.join(tempfile.mkdtemp(), "race.json"), min_folds=2)
+        for fold, (a, b) in enumerate([(0.1, 0.5), (0.2, 0.6)]):
+            race.record("a", fold, a)
+            race.record("b", fold, b)
+        self.assertEqual(race.eliminate(["a", "b"]), ["b"], "Consistently worse candidate was not abandoned")
+        self.assertEqual(race.candidates["b"]["status"], "abandoned")
+        self.assertEqual(race.candidates["b"]["against"], "a")
+
+    def test_eliminate_skips_unrecorded_candidates(self):
+        # A candidate whose loss was never finite has no scores to be compared on
+        race = FoldRace(os.path.join(tempfile.mkdtemp(), "race.json"), min_folds=2)
+        for fold in range(2):
+            race.record("a", fold, 0.1)
+        self.assertEqual(race.eliminate(["a", "nan_model"]), [], "Unrecorded candidate was abandoned")
+        self.assertNotIn("nan_model", race.candidates)
+        race.save()
+        self.assertTrue(os.path.exists(race.path), "Race was not saved")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from .utils import hash_params, save_manifest, ensure_folder_exists, scan_directory
+from .distributed import is_main_process
+
+# Run memoization: every trained (model, fold) unit is recorded in a local run index under the
+# fingerprint of everything that determines its result. A later training with the same
+# fingerprint reuses the recorded checkpoint instead of training the unit again, and the tester
+# reuses recorded test metrics the same way. The index is a folder with one JSON file per unit, so
+# parallel trainers of a sweep never write the same file.
+
+# Keys that name outputs or only change how fast a run is, not what it computes
+_IGNORED_KEYS = {
+    'training_name', 'model_save_path', 'tensorboard_log_path', 'progress_path', 'load_from_checkpoint',
+    'trial_report_path', 'num_workers', 'async_validation', 'async_val_threads', 'lockstep_models',
+    'fold_cache', 'cache_path', 'transform_cache', 'val_batch_cache', 'val_cache_budget_mb',
+    'cv_racing', 'cv_racing_alpha', 'cv_racing_min_folds', 'memoize_runs', 'run_index_path',
+    'latest_checkpoint_every_steps', 'latest_checkpoint_every_minutes', 'autotune', 'autotune_batches', 'autotune_cache_path',
+    # The batch size and learning rate chosen by the batch size finder are part of the config
+    'auto_batch_size', 'batch_size_memory_budget_mb', 'max_auto_batch_size', 'lr_scaling', 'batch_size_decision',
+    'models', 'models_params', 'metrics', 'metrics_params',
+}
+
+_code_version = None
+
+def code_version():
+    """Digest of the trainer and all sources under src, and of the installed PyTorch version."""
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sha1 = hashlib.sha1(torch.__version__.encode('utf-8'))
+        paths = [os.path.join(root, "trainer.py")]
+        for directory, dirnames, filenames in os.walk(os.path.join(root, "src")):
+            dirnames.sort()
+            paths += [os.path.join(directory, name) for name in sorted(filenames) if name.endswith('.py')]
+        for path in paths:
+            sha1.update(os.path.relpath(path, root).encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha1.update(f.read())
+        _code_version = sha1.hexdigest()
+    return _code_version
+
+_data_fingerprints = {}
+
+def data_files_fingerprint(config):
+    """
+    Digest of the path, size and modification time of every file in the folders named by the dataset
+    parameters (e.g. root, input_path). The listings come from the mtime-validated file manifests,
+    so changed, added or removed data files give a new digest without reading any file.
+    """
+    params = config.datasets_params[config.datasets]
+    folders = sorted({os.path.abspath(value) for value in params.values() if isinstance(value, str) and os.path.isdir(value)})
+    key = tuple(folders)
+    if key not in _data_fingerprints:
+        sha1 = hashlib.sha1()
+        for folder in folders:
+            sha1.update(folder.encode('utf-8'))
+            for rel_path, size, mtime_ns in scan_directory(folder)['files']:
+                sha1.update(f"{rel_path}|{size}|{mtime_ns}\n".encode('utf-8'))
+        _data_fingerprints[key] = sha1.hexdigest()
+    return _data_fingerprints[key]
+
+def fold_data_fingerprint(dataset, fold, config):
+    """Digest of the dataset's files and, if the dataset exposes its folds, of the sample indices of a fold."""
+    sha1 = hashlib.sha1(data_files_fingerprint(config).encode('utf-8'))
+    indices = getattr(dataset, 'indices', None)
+    if indices is not None:
+        for mode, mode_indices in sorted(indices[fold].items()):
+            sha1.update(mode.encode('utf-8'))
+            sha1.update(np.ascontiguousarray(mode_indices, dtype=np.int64).tobytes())
+    return sha1.hexdigest()
+
+def unit_fingerprint(config, model_name, fold, data_fingerprint):
+    """
+    Fingerprint of training model_name on one fold: the configuration without output paths and
+    performance settings, the parameters of this model only, the fold's data and the code version.
+    """
+    canonical = {key: value for key, value in config.items() if key not in _IGNORED_KEYS}
+    canonical.update(model=model_name, model_params=config.models_params[model_name], fold=fold,
+                     data=data_fingerprint, code=code_version())
+    return hash_params(canonical)
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class RunIndex:
+    """
+    Local index of completed training units and their test results.
+
+    Args:
+    - path (str): Folder of the index.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _entry_path(self, fingerprint, kind):
+        return os.path.join(self.path, f"{fingerprint}_{kind}.json")
+
+    def lookup(self, fingerprint, kind="train"):
+        """
+        Return the entry recorded for fingerprint, or None if there is none or its checkpoint is gone
+        or was overwritten since, e.g. by a later training of the same experiment without memoization.
+        """
+        try:
+            with open(self._entry_path(fingerprint, kind), 'r') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        for path_key, mtime_key in (('model_state_dict_path', 'model_mtime_ns'), ('metadata_path', 'metadata_mtime_ns')):
+            if path_key not in entry:
+                continue
+            if mtime_key not in entry or _mtime_ns(entry[path_key]) != entry[mtime_key]:
+                return None
+        return entry
+
+    def record(self, fingerprint, entry, kind="train"):
+        if not is_main_process():
+            return
+        ensure_folder_exists(self.path)
+        save_manifest(self._entry_path(fingerprint, kind), {'fingerprint': fingerprint, **entry})
+
+def reuse_checkpoint(entry, config, model_name, fold):
+    """
+    Make the checkpoint of a recorded unit the best checkpoint of model_name on fold in this
+    experiment. Its metadata is written to the experiment folder and still points to the recorded
+    state files, so the tester finds the checkpoint without copying weights.
+    """
+    experiment_folder = config.model_save_path + model_name
+    metadata_path = f"{experiment_folder}/{model_name}_best_fold_{fold}_metadata.json"
+    if os.path.abspath(metadata_path) == os.path.abspath(entry['metadata_path']) or not is_main_process():
+        return
+    with open(entry['metadata_path'], 'r') as f:
+        metadata = json.load(f)
+    metadata.update(experiment_folder=experiment_folder, config=config, reused_from=entry['metadata_path'])
+    ensure_folder_exists(experiment_folder)
+    save_manifest(metadata_path, metadata)
@@ -0,0 +1,416 @@
+import os
+import sys
+import ast
+import json
+import math
+import time
+import random
+import itertools
+import subprocess
+from copy import deepcopy
+from .utils import print_to_file, ensure_folder_exists
+
+# Where the parameter ranges declared with enforce_types_and_ranges are collected
+CHOICES_PATH = "repromodel_core/choices.json"
+TRAINER_SCRIPT = "repromodel_core/trainer.py"
+
+######################################################################
+# Trial reports
+######################################################################
+
+def report_trial_result(path, record):
+    """Append one intermediate result of a trial to its report file (one JSON object per line)."""
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+def read_trial_reports(path):
+    """Read the results reported so far; a line that is still being written is skipped."""
+    if not os.path.exists(path):
+        return []
+    reports = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                reports.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return reports
+
+######################################################################
+# Search space
+######################################################################
+
+def get_config_value(config, path):
+    for key in path.split('.'):
+        config = config[key]
+    return config
+
+def set_config_value(config, path, value):
+    """Set a value in a nested config; path is dot-separated, e.g. 'optimizers_params.torch>optim>Adam.lr'."""
+    keys = path.split('.')
+    for key in keys[:-1]:
+        config = config.setdefault(key, {})
+    config[keys[-1]] = value
+
+def lookup_choice(choices, path):
+    """Return the entry of choices.json describing the config value at path."""
+    keys = path.split('.')
+    if len(keys) == 3 and keys[0].endswith('_params'):
+        # Component parameters, e.g. augmentations_params.shiftScaleRotateFlip>ShiftScaleRotateFlip.p
+        module, _, class_name = keys[1].rpartition('>')
+        return choices[keys[0][:-len('_params')]][module][class_name][keys[2]]
+    return get_config_value(choices, path)
+
+def _parse_literal(value):
+    return ast.literal_eval(value) if isinstance(value, str) else value
+
+def resolve_search_space(search_space, choices=None):
+    """
+    Normalise a search space to {path: spec}, where spec is either
+    {'kind': 'categorical', 'options': [...]} or {'kind': 'int' | 'float', 'low', 'high', 'log'}.
+
+    Every entry of search_space maps a dot-separated config path to one of:
+    - a list of options,
+    - {"options": [...]},
+    - {"range": [low, high], "type": "int" | "float", "log": bool},
+    - "auto", which takes the options or range declared for the parameter in choices.json.
+      Ranges spanning more than two orders of magnitude are searched on a log scale.
+    """
+    space = {}
+    for path, spec in search_space.items():
+        if spec == "auto":
+            if choices is None:
+                raise ValueError(f"No choices available to resolve the range of '{path}'")
+            choice = lookup_choice(choices, path)
+            if 'options' in choice:
+                spec = {'options': _parse_literal(choice['options'])}
+            elif choice.get('type') == 'bool':
+                spec = {'options': [False, True]}
+            elif 'range' in choice:
+                low, high = _parse_literal(choice['range'])
+                spec = {'range': [low, high], 'type': choice['type'],
+                        'log': low > 0 and high / low > 100}
+            else:
+                raise ValueError(f"'{path}' declares neither options nor a range")
+        if isinstance(spec, list):
+            spec = {'options': spec}
+
+        if 'options' in spec:
+            space[path] = {'kind': 'categorical', 'options': list(spec['options'])}
+        elif 'range' in spec:
+            low, high = spec['range']
+            kind = spec.get('type', 'int' if isinstance(low, int) and isinstance(high, int) else 'float')
+            if kind not in ('int', 'float'):
+                raise ValueError(f"Unsupported type '{kind}' for '{path}'")
+            if spec.get('log', False) and low <= 0:
+                raise ValueError(f"Log scale needs a positive range for '{path}'")
+            space[path] = {'kind': kind, 'low': low, 'high': high, 'log': spec.get('log', False)}
+        else:
+            raise ValueError(f"Search space entry '{path}' needs options or a range")
+    return space
+
+def _to_unit(spec, value):
+    # Map a numeric value to [0, 1], on a log scale if requested
+    low, high = spec['low'], spec['high']
+    if spec['log']:
+        low, high, value = math.log(low), math.log(high), math.log(value)
+    return 0.0 if high == low else (value - low) / (high - low)
+
+def _from_unit(spec, u):
+    low, high = spec['low'], spec['high']
+    u = min(max(u, 0.0), 1.0)
+    value = math.exp(math.log(low) + u * (math.log(high) - math.log(low))) if spec['log'] else low + u * (high - low)
+    return int(round(value)) if spec['kind'] == 'int' else value
+
+######################################################################
+# Samplers
+######################################################################
+
+def grid_search(space, num_points=3):
+    """All combinations of the options, with num_points evenly spaced values per numeric range."""
+    axes = []
+    for spec in space.values():
+        if spec['kind'] == 'categorical':
+            axes.append(spec['options'])
+        else:
+            values = [_from_unit(spec, i / max(num_points - 1, 1)) for i in range(num_points)]
+            axes.append(list(dict.fromkeys(values)))
+    return [dict(zip(space, values)) for values in itertools.product(*axes)]
+
+def random_search(space, rng):
+    params = {}
+    for path, spec in space.items():
+        if spec['kind'] == 'categorical':
+            params[path] = rng.choice(spec['options'])
+        else:
+            params[path] = _from_unit(spec, rng.random())
+    return params
+
+class TPESampler:
+    """
+    Tree-structured Parzen estimator. The finished trials are split into the best gamma fraction
+    and the rest; per parameter, candidates are drawn from a density fitted to the good values and
+    the candidate with the highest ratio of good to bad density is chosen. The first n_startup
+    trials are drawn at random.
+
+    Args:
+    - space (dict): Search space from resolve_search_space().
+    - seed (int): Seed of the sampler.
+    - n_startup (int): Number of random trials before the model is used.
+    - gamma (float): Fraction of trials considered good.
+    - n_candidates (int): Candidates drawn per parameter.
+    """
+    def __init__(self, space, seed=None, n_startup=5, gamma=0.25, n_candidates=24):
+        self.space = space
+        self.rng = random.Random(seed)
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.n_candidates = n_candidates
+
+    def sample(self, history):
+        """Suggest parameters given a list of (params, score) of finished trials; lower scores are better."""
+        history = [(params, score) for params, score in history if score is not None]
+        if len(history) < self.n_startup:
+            return random_search(self.space, self.rng)
+        history.sort(key=lambda item: item[1])
+        n_good = max(1, int(math.ceil(self.gamma * len(history))))
+        good = [params for params, _ in history[:n_good]]
+        bad = [params for params, _ in history[n_good:]] or good
+
+        params = {}
+        for path, spec in self.space.items():
+            if spec['kind'] == 'categorical':
+                params[path] = self._sample_categorical(spec, [p[path] for p in good], [p[path] for p in bad])
+            else:
+                params[path] = self._sample_numeric(spec, [_to_unit(spec, p[path]) for p in good],
+                                                    [_to_unit(spec, p[path]) for p in bad])
+        return params
+
+    def _sample_categorical(self, spec, good, bad):
+        options = spec['options']
+        def probabilities(values):
+            # Observed frequencies with one pseudo-count per option as prior
+            return [(values.count(option) + 1) / (len(values) + len(options)) for option in options]
+        p_good, p_bad = probabilities(good), probabilities(bad)
+        candidates = self.rng.choices(range(len(options)), weights=p_good, k=self.n_candidates)
+        best = max(candidates, key=lambda i: p_good[i] / p_bad[i])
+        return options[best]
+
+    def _sample_numeric(self, spec, good, bad):
+        def bandwidth(values):
+            mean = sum(values) / len(values)
+            std = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+            return max(std * len(values) ** -0.2, 0.05)
+
+        def log_density(u, values, sigma):
+            # Gaussian mixture around the observations, mixed with a uniform prior on [0, 1]
+            kernel = sum(math.exp(-0.5 * ((u - v) / sigma) ** 2) / (sigma * math.sqrt(2 * math.pi)) for v in values)
+            return math.log((kernel + 1.0) / (len(values) + 1))
+
+        sigma_good, sigma_bad = bandwidth(good), bandwidth(bad)
+        candidates = [min(max(self.rng.gauss(self.rng.choice(good), sigma_good), 0.0), 1.0)
+                      for _ in range(self.n_candidates)]
+        best = max(candidates, key=lambda u: log_density(u, good, sigma_good) - log_density(u, bad, sigma_bad))
+        return _from_unit(spec, best)
+
+######################################################################
+# Pruning
+######################################################################
+
+class ASHAPruner:
+    """
+    Asynchronous successive halving. Rungs lie at min_resource * reduction_factor**i validations.
+    When a trial reaches a rung, its best validation loss so far is recorded there, and the trial
+    continues only if it is among the best 1/reduction_factor of all trials that reached the rung.
+    Rungs with fewer than reduction_factor results prune nothing.
+
+    A trial may report several independent sequences of validation losses, e.g. one per model and
+    fold. Each sequence is a stream with rungs of its own, so a fold is only compared with the same
+    fold of other trials.
+
+    Args:
+    - min_resource (int): Validations before the first rung.
+    - reduction_factor (int): Fraction of trials kept at each rung is 1/reduction_factor.
+    - max_resource (int): Validations after which trials are no longer pruned; None for no limit.
+    """
+    def __init__(self, min_resource=1, reduction_factor=3, max_resource=None):
+        if reduction_factor < 2:
+            raise ValueError("reduction_factor should be at least 2")
+        self.min_resource = min_resource
+        self.reduction_factor = reduction_factor
+        self.max_resource = max_resource
+        self.rungs = {}
+        self.recorded = {}
+
+    def _rung_resources(self, resource):
+        rung = self.min_resource
+        while rung <= resource and (self.max_resource is None or rung < self.max_resource):
+            yield rung
+            rung *= self.reduction_factor
+
+    def record(self, trial_id, losses, stream=None):
+        """
+        Record the rungs reached by one stream of a trial with the given validation losses. Returns
+        whether the trial falls outside the best 1/reduction_factor at a newly reached rung. Finished
+        trials are recorded as well, so that running trials are compared against them.
+        """
+        recorded = self.recorded.setdefault((trial_id, stream), set())
+        prune = False
+        for rung in self._rung_resources(len(losses)):
+            if rung in recorded:
+                continue
+            recorded.add(rung)
+            value = min(losses[:rung])
+            values = self.rungs.setdefault((stream, rung), [])
+            values.append(value)
+            if len(values) < self.reduction_factor:
+                continue
+            cutoff = sorted(values)[len(values) // self.reduction_factor - 1]
+            prune = prune or value > cutoff
+        return prune
+
+######################################################################
+# Sweep
+######################################################################
+
+def _trial_config(base_config, params, sweep_dir, sweep_name, trial_id):
+    config = deepcopy(base_config)
+    for path, value in params.items():
+        set_config_value(config, path, value)
+    trial_dir = os.path.join(sweep_dir, f"trial_{trial_id}")
+    config['training_name'] = f"{sweep_name}_trial{trial_id}"
+    config['model_save_path'] = os.path.join(trial_dir, "ckpts") + "/"
+    config['tensorboard_log_path'] = os.path.join(trial_dir, "logs")
+    config['progress_path'] = os.path.join(trial_dir, "ckpts", "progress.json")
+    config['load_from_checkpoint'] = False
+    config['trial_report_path'] = os.path.join(trial_dir, "reports.jsonl")
+    return config, trial_dir
+
+def _trial_streams(reports):
+    """Validation losses of a trial per (model, fold), in the order they were reported."""
+    streams = {}
+    for report in reports:
+        streams.setdefault((report['model'], report['fold']), []).append(report['val_loss'])
+    return streams
+
+def _trial_score(streams):
+    # Mean over models and folds of the best validation loss, so that folds are not compared across trials
+    if not streams:
+        return None
+    return sum(min(losses) for losses in streams.values()) / len(streams)
+
+def run_sweep(sweep_config):
+    """
+    Run a hyperparameter sweep and return its leaderboard.
+
+    Every trial is a trainer process on a copy of base_config with the sampled parameters set.
+    Trials report every validation to a file; the sweep reads these reports to prune trials early
+    and to score them by the best validation loss of every model and fold, averaged.
+
+    Args:
+    - sweep_config (dict):
+        - sweep_name (str): Name of the sweep and of its output folder.
+        - base_config (dict or str): Training config, or path to it.
+        - search_space (dict): See resolve_search_space().
+        - method (str): 'grid', 'random' or 'tpe'; 'pbt' is handled by pbt.run_population().
+        - num_trials (int): Number of trials; for grid search at most the size of the grid.
+        - grid_points (int): Values per numeric range in grid search.
+        - parallel_trials (int): Trials running at the same time; CPU threads are split between them.
+        - pruner (dict): {'type': 'asha', 'min_resource', 'reduction_factor', 'max_resource'} or {'type': 'none'}.
+        - seed (int): Seed of the sampler.
+        - output_path (str): Parent folder of the sweep output.
+    """
+    sweep_name = sweep_config['sweep_name']
+    base_config = sweep_config['base_config']
+    if isinstance(base_config, str):
+        with open(base_config, 'r') as f:
+            base_config = json.load(f)
+
+    choices = None
+    if os.path.exists(CHOICES_PATH):
+        with open(CHOICES_PATH, 'r') as f:
+            choices = json.load(f)
+    space = resolve_search_space(sweep_config['search_space'], choices)
+
+    method = sweep_config.get('method', 'random')
+    num_trials = sweep_config.get('num_trials', 10)
+    seed = sweep_config.get('seed', 0)
+    rng = random.Random(seed)
+    if method == 'grid':
+        grid = grid_search(space, sweep_config.get('grid_points', 3))
+        num_trials = min(num_trials, len(grid)) if 'num_trials' in sweep_config else len(grid)
+    elif method == 'tpe':
+        sampler = TPESampler(space, seed=seed)
+    elif method != 'random':
+        raise ValueError(f"Unknown sweep method '{method}'")
+
+    pruner_config = dict(sweep_config.get('pruner', {'type': 'asha'}))
+    pruner = None
+    if pruner_config.pop('type', 'asha') == 'asha':
+        pruner = ASHAPruner(**pruner_config)
+
+    sweep_dir = os.path.join(sweep_config.get('output_path', 'repromodel_core/sweeps/'), sweep_name)
+    ensure_folder_exists(sweep_dir)
+    parallel_trials = max(1, sweep_config.get('parallel_trials', 1))
+    env = dict(os.environ, OMP_NUM_THREADS=str(max(1, (os.cpu_count() or 1) // parallel_trials)))
+
+    trials, running = [], []
+    while len(trials) < num_trials or running:
+        # Start trials until all slots are busy
+        while len(running) < parallel_trials and len(trials) < num_trials:
+            trial_id = len(trials)
+            if method == 'grid':
+                params = grid[trial_id]
+            elif method == 'tpe':
+                params = sampler.sample([(trial['params'], trial['score']) for trial in trials if trial['status'] != 'running'])
+            else:
+                params = random_search(space, rng)
+            config, trial_dir = _trial_config(base_config, params, sweep_dir, sweep_name, trial_id)
+            ensure_folder_exists(trial_dir)
+            with open(os.path.join(trial_dir, "config.json"), 'w') as f:
+                json.dump(config, f, indent=4)
+            log_file = open(os.path.join(trial_dir, "trainer_output.txt"), 'w')
+            process = subprocess.Popen([sys.executable, TRAINER_SCRIPT, json.dumps(config)],
+                                       stdout=log_file, stderr=subprocess.STDOUT, env=env)
+            trial = {'id': trial_id, 'params': params, 'status': 'running', 'score': None, 'validations': 0,
+                     'report_path': config['trial_report_path'], 'process': process, 'log_file': log_file}
+            trials.append(trial)
+            running.append(trial)
+            print_to_file(f"Sweep {sweep_name}: started trial {trial_id} with {params}")
+
+        time.sleep(sweep_config.get('poll_interval', 2))
+
+        for trial in list(running):
+            streams = _trial_streams(read_trial_reports(trial['report_path']))
+            trial['validations'] = sum(len(losses) for losses in streams.values())
+            trial['score'] = _trial_score(streams)
+            finished = trial['process'].poll() is not None
+            # Every stream is recorded, also of trials that finished since the last poll
+            prune = False
+            if pruner is not None:
+                for stream, losses in streams.items():
+                    prune = pruner.record(trial['id'], losses, stream=stream) or prune
+            if not finished and prune:
+                trial['process'].terminate()
+                trial['process'].wait()
+                trial['status'] = 'pruned'
+            elif finished:
+                trial['status'] = 'completed' if trial['process'].returncode == 0 and streams else 'failed'
+            else:
+                continue
+            trial['log_file'].close()
+            running.remove(trial)
+            print_to_file(f"Sweep {sweep_name}: trial {trial['id']} {trial['status']} after {trial['validations']} validations, best val loss {trial['score']}")
+
+    leaderboard = sorted(
+        ({key: trial[key] for key in ('id', 'params', 'status', 'score', 'validations')} for trial in trials),
+        key=lambda trial: (trial['score'] is None, trial['score'] if trial['score'] is not None else 0.0))
+    with open(os.path.join(sweep_dir, "leaderboard.json"), 'w') as f:
+        json.dump(leaderboard, f, indent=4)
+
+    print_to_file(f"Sweep {sweep_name} finished. Leaderboard:")
+    for rank, trial in enumerate(leaderboard, start=1):
+        print_to_file(f"{rank}. trial {trial['id']} ({trial['status']}, {trial['validations']} validations): "
+                      f"val loss {trial['score']} with {trial['params']}")
+    return leaderboard
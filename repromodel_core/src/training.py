@@ -0,0 +1,342 @@
+import torchmetrics
+from torch.nn.parallel import DistributedDataParallel
+from tqdm import tqdm
+from .utils import save_model, print_to_file, accepts_argument
+from .validation import validate
+from .distributed import all_reduce_sum, is_main_process
+from .sweeps import report_trial_result
+from .checkpointing import get_rng_state
+
+def run_name(model_name, member=None):
+    """Name under which a run is checkpointed; ensemble members get their own checkpoint folders."""
+    if member is None:
+        return model_name
+    return f"{model_name}_member{member}"
+
+class GroupProgress:
+    """
+    Resume point of runs trained together, such as lockstep models or the members of a vectorised
+    ensemble. The progress file that load_from_checkpoint resumes from names the first model of the
+    group and the lowest fold it has not finished, so that a resumed training picks up every run of
+    the group. Its epoch is the lowest epoch checkpointed by an unfinished run of that fold.
+
+    Args:
+    - model_name (str): The first model of the group.
+    - runs (list): The FoldRun objects of the group; each reports its checkpoints here.
+    """
+    def __init__(self, model_name, runs):
+        self.model_name = model_name
+        self.runs = list(runs)
+        self.epochs = {}
+        for run in self.runs:
+            run.progress = self
+
+    def entry(self, run=None, epoch=None):
+        """Return the progress entry, after run saved a checkpoint to resume at epoch if given."""
+        if run is not None:
+            self.epochs[run] = epoch
+        unfinished = [run for run in self.runs if not run.finished] or self.runs
+        fold = min(run.k for run in unfinished)
+        epoch = min(self.epochs.get(run, 0) for run in unfinished if run.k == fold)
+        return {'model_name': self.model_name, 'fold': fold, 'epoch': epoch}
+
+class FoldRun:
+    """
+    Training state of one model on one fold: model, optimizer, LR scheduler, early stopper,
+    TensorBoard writer and the validation bookkeeping.
+
+    The trainer owns the data pipeline and feeds every batch to train_step(), so several runs can
+    consume the same batches (lockstep training). Per epoch the trainer calls start_epoch(), then
+    train_step() per batch and end_epoch(); validate() is called in between when validating every
+    val_every_steps optimizer steps. A run is finished once its early stopper fires and end_epoch()
+    has handled the stop.
+
+    Args:
+    - cfg (EasyDict): The training configuration.
+    - m (int): Index of the model in cfg.models.
+    - k (int): Fold index.
+    - model, optimizer, lr_scheduler, early_stopper: The configured components.
+    - writer (SummaryWriter): TensorBoard writer of this model and fold.
+    - criterion (callable): The loss function.
+    - train_metrics, val_metrics (list): Metric objects of this run.
+    - target_encoder (callable): Expands the compact labels of a batch.
+    - val_dataloader: Loader of the full validation set.
+    - val_subset_dataloader: Loader of the validation subset, or None.
+    - tqdm_file (TqdmFile): Output file of the validation progress bars.
+    - epoch (int): Epoch to start from.
+    - global_step (int): Optimizer steps taken before epoch.
+    - async_validator (AsyncValidator): Sidecar validation process, or None to validate in place.
+    - member (int): Index of the ensemble member, if the run is one of several variants of the same model and fold.
+    - population_member (PopulationMember): Exploit and explore steps of population-based training, or None.
+    """
+    def __init__(self, cfg, m, k, model, optimizer, lr_scheduler, early_stopper, writer, criterion,
+                 train_metrics, val_metrics, target_encoder, val_dataloader, val_subset_dataloader=None,
+                 tqdm_file=None, epoch=0, global_step=0, async_validator=None, member=None, population_member=None):
+        self.cfg = cfg
+        self.m = m
+        self.k = k
+        self.model = model
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+        self.early_stopper = early_stopper
+        self.writer = writer
+        self.criterion = criterion
+        self.train_metrics = train_metrics
+        self.val_metrics = val_metrics
+        self.target_encoder = target_encoder
+        self.val_dataloader = val_dataloader
+        self.val_subset_dataloader = val_subset_dataloader
+        self.tqdm_file = tqdm_file
+        self.async_validator = async_validator
+        self.member = member
+        self.population_member = population_member
+
+        # Validation cadence: every val_every_steps optimizer steps if set, otherwise every val_every_epochs epochs
+        self.val_every_steps = cfg.get("val_every_steps", 0)
+        self.val_every_epochs = cfg.get("val_every_epochs", 1)
+        self.full_val_every = cfg.get("full_val_every", 0)
+        # Metric-driven schedulers and early stoppers are stepped after every validation,
+        # time-driven ones (e.g. StepLR, ScheduledStop) once per epoch
+        self.scheduler_on_metric = accepts_argument(lr_scheduler.step, 'metrics')
+        self.stopper_on_metric = accepts_argument(early_stopper.step, 'current_value')
+
+        self.best_val_loss = float('inf')
+        self.epoch = epoch
+        self.global_step = global_step
+        self.num_validations = 0
+        self.last_val_step = None
+        self.finished = False
+        # Position within the first epoch when continuing from a latest checkpoint
+        self.resume_position = None
+        # Set by GroupProgress when the run is trained together with others
+        self.progress = None
+        self.model.train()
+
+    @property
+    def name(self):
+        return run_name(self.cfg.models[self.m], self.member)
+
+    @property
+    def should_stop(self):
+        return self.early_stopper.should_stop
+
+    @property
+    def train_loss(self):
+        """Average training loss of the current epoch so far."""
+        return self.total_train_loss / max(self.total_samples, 1)
+
+    def _epoch_totals(self):
+        # Loss, sample and metric totals of the epoch so far, summed over all processes
+        total_train_loss, total_samples, *total_train_metrics = all_reduce_sum(
+            [self.total_train_loss, self.total_samples] + self.total_train_metrics)
+        return total_train_loss, total_samples, total_train_metrics
+
+    def start_epoch(self):
+        resume, self.resume_position = self.resume_position, None
+        if resume is not None and resume['batches_done'] > 0:
+            # Continue the totals of the interrupted epoch
+            self.total_train_loss = resume['total_train_loss']
+            self.total_train_metrics = resume['total_train_metrics']
+            self.total_samples = resume['total_samples']
+            return
+        self.total_train_loss = 0.0
+        self.total_train_metrics = [0]*len(self.cfg.metrics)
+        self.total_samples = 0
+
+    def latest_state(self, batches_done):
+        """Complete state of the run after batches_done batches of the current epoch, see checkpointing.save_latest_checkpoints()."""
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        return {
+            'model': model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'early_stopping': self.early_stopper.state_dict() if hasattr(self.early_stopper, 'state_dict') else None,
+            'epoch': self.epoch,
+            'global_step': self.global_step,
+            'batches_done': batches_done,
+            'total_train_loss': self.total_train_loss,
+            'total_train_metrics': self.total_train_metrics,
+            'total_samples': self.total_samples,
+            'best_val_loss': self.best_val_loss,
+            'num_validations': self.num_validations,
+            'last_val_step': self.last_val_step,
+            'finished': self.finished,
+            'rng_state': get_rng_state(),
+        }
+
+    def load_latest_state(self, state):
+        """Continue from a state returned by latest_state(); the trainer skips the batches already consumed."""
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        if state['early_stopping'] is not None:
+            self.early_stopper.load_state_dict(state['early_stopping'])
+        self.epoch = state['epoch']
+        self.global_step = state['global_step']
+        self.best_val_loss = state['best_val_loss']
+        self.num_validations = state['num_validations']
+        self.last_val_step = state['last_val_step']
+        self.finished = state.get('finished', False)
+        self.resume_position = state
+
+    def close(self):
+        """Release the TensorBoard writer and the sidecar process of a run that does not train further."""
+        if self.async_validator is not None:
+            self.async_validator.close()
+        self.writer.close()
+
+    def train_step(self, inputs, labels):
+        """One optimizer step on a batch of inputs and encoded labels."""
+        self.optimizer.zero_grad()
+        outputs = self.model(inputs)
+        train_loss = self.criterion(outputs, labels)
+        train_loss.backward()
+        self.optimizer.step()
+        self.record_step(outputs, labels, train_loss)
+
+    def record_step(self, outputs, labels, train_loss):
+        """Count an optimizer step and add its loss and metrics to the epoch totals; also used for steps taken outside train_step()."""
+        self.global_step += 1
+
+        #caluclate and save train metrics
+        for i, metric in enumerate(self.train_metrics):
+            if isinstance(metric, torchmetrics.Dice):
+                labels = labels.long()
+            self.total_train_metrics[i] += metric(outputs, labels)
+
+        self.total_train_loss += train_loss.item() * labels.size(0)
+        self.total_samples += labels.size(0)
+
+    def validate(self, end_of_epoch=False, force_full=False):
+        """Validate the current weights, synchronously or by handing a snapshot to the sidecar process."""
+        self.num_validations += 1
+        self.last_val_step = self.global_step
+        full = (self.val_subset_dataloader is None or force_full
+                or (self.full_val_every > 0 and self.num_validations % self.full_val_every == 0))
+        total_train_loss, total_samples, _ = self._epoch_totals()
+        info = {'epoch': self.epoch, 'step': self.global_step, 'train_loss': total_train_loss / max(total_samples, 1),
+                'end_of_epoch': end_of_epoch, 'full': full}
+        if self.async_validator is not None:
+            # The previous snapshot must be finished before it is overwritten, which bounds the lag to one validation
+            self.collect_validation()
+            self.async_validator.submit(self.model, info, dataset='full' if full else 'subset')
+            return
+
+        loader = self.val_dataloader if full else self.val_subset_dataloader
+        progress_bar = tqdm(loader, total=len(loader), file=self.tqdm_file,
+                            desc=f"Fold {self.k}, Epoch {self.epoch} - {'Val' if full else 'Subsampled Val'} Batch")
+        average_val_loss, average_val_metrics = validate(self.model, progress_bar, self.criterion, self.val_metrics,
+                                                         self.target_encoder, self.cfg.device)
+        self.model.train()
+        self._finish_validation(info, average_val_loss, average_val_metrics, self.model)
+
+    def collect_validation(self):
+        """Wait for the validation running in the sidecar process, if any, and act on its result."""
+        result = self.async_validator.collect()
+        if result is not None:
+            self._finish_validation(*result, self.async_validator.shared_model)
+
+    def _finish_validation(self, info, average_val_loss, average_val_metrics, validated_model):
+        # Step the metric-driven scheduler and early stopper and save the validated weights if they are the best
+        cfg = self.cfg
+        train_loss = info['train_loss']
+        current_lr = self.optimizer.param_groups[0]['lr']
+        if self.scheduler_on_metric:
+            if cfg.monitor == 'val_loss':
+                self.lr_scheduler.step(average_val_loss)
+            elif cfg.monitor == 'train_loss':
+                self.lr_scheduler.step(train_loss)
+
+        # Log against epochs, or against optimizer steps when validating within epochs
+        x = info['step'] if self.val_every_steps else info['epoch']
+        self.writer.add_scalar('Validation/Loss', average_val_loss, x)
+        self.writer.add_scalar('Validation/Full Pass', int(info['full']), x)
+        for i, metric in enumerate(cfg.metrics):
+            self.writer.add_scalar(f'Validation/{metric}', average_val_metrics[i], x)
+
+        # Save best model; a checkpoint taken within an epoch resumes at the start of that epoch.
+        # With asynchronous validation the optimizer, scheduler and early stopping states are up to one validation newer than the weights.
+        if average_val_loss < self.best_val_loss:
+            self.best_val_loss = average_val_loss
+            epoch = info['epoch'] + 1 if info['end_of_epoch'] else info['epoch']
+            save_model(config=cfg,
+                       model = validated_model,
+                       model_name=self.name,
+                       fold=self.k,
+                       epoch=epoch,
+                       optimizer=self.optimizer,
+                       lr_scheduler=self.lr_scheduler,
+                       early_stopping=self.early_stopper,
+                       train_loss=train_loss,
+                       val_loss=self.best_val_loss,
+                       is_best=True,
+                       step=info['step'],
+                       progress=self.progress.entry(self, epoch) if self.progress is not None else None)
+
+        if self.stopper_on_metric:
+            self.early_stopper.step(average_val_loss if cfg.monitor == 'val_loss' else train_loss, current_lr, info['epoch'])
+
+        # Trials of a sweep report every validation so that the sweep can prune them early
+        if cfg.get("trial_report_path") and is_main_process():
+            report_trial_result(cfg.trial_report_path, {'model': self.name, 'fold': self.k, 'epoch': info['epoch'],
+                                                        'step': info['step'], 'val_loss': average_val_loss, 'full': info['full']})
+
+        # In population-based training a poorly scoring run continues from a better member's states
+        if self.population_member is not None:
+            self.population_member.step(self, average_val_loss)
+
+    def end_epoch(self, fresh_samples=None):
+        """
+        Validate if due, step time-driven schedulers and stoppers and log the epoch.
+        Returns True once the run has finished.
+
+        Args:
+        - fresh_samples (int): Samples actually loaded this epoch when data echoing is used.
+        """
+        total_train_loss, total_samples, total_train_metrics = self._epoch_totals()
+        average_train_loss = total_train_loss / max(total_samples, 1)
+
+        #average metrics calculation
+        average_train_metrics = []
+        for train_m in total_train_metrics:
+            average_train_metrics.append(train_m / max(total_samples, 1))
+
+        if not self.val_every_steps and (self.epoch + 1) % self.val_every_epochs == 0:
+            self.validate(end_of_epoch=True)
+
+        # Time-driven learning rate adjustment
+        if not self.scheduler_on_metric:
+            self.lr_scheduler.step()
+
+        #log learning rate
+        lr = self.optimizer.param_groups[0]['lr']
+        self.writer.add_scalar('Train/Learning Rate', lr, self.epoch)
+
+        #log losses
+        self.writer.add_scalar('Train/Loss', average_train_loss, self.epoch)
+        if fresh_samples is not None:
+            # Samples actually loaded, as opposed to the echoed samples counted in total_samples
+            self.writer.add_scalar('Train/Fresh Samples', fresh_samples, self.epoch)
+
+        # Log metrics
+        for i, metric in enumerate(self.cfg.metrics):
+            self.writer.add_scalar(f'Train/{metric}', average_train_metrics[i], self.epoch)
+
+        # Early stopping
+        if not self.stopper_on_metric:
+            self.early_stopper.step(self.epoch)
+        if self.early_stopper.should_stop:
+            # Training may end between validations; make sure the last weights were validated in full
+            if self.last_val_step != self.global_step:
+                self.validate(end_of_epoch=True, force_full=True)
+            if self.async_validator is not None:
+                self.collect_validation()
+                self.async_validator.close()
+            print_to_file(f"Early stopping at epoch {self.epoch+1}, step {self.global_step}", config=self.cfg, model_num = self.m)
+            self.writer.close()
+            self.finished = True
+            return True
+
+        self.epoch += 1
+        return False
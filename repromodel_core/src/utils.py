@@ -2,12 +2,19 @@ import os
 import json
 import ast
 import shutil
+import hashlib
+import inspect
 import numpy as np
 import torch
+from PIL import Image
 from datetime import datetime
 import collections
 from torchvision.models.inception import InceptionOutputs
 from torchvision.models.googlenet import GoogLeNetOutputs
+from .distributed import is_main_process
+
+# Where scan_directory keeps its listings of dataset folders
+FILE_MANIFEST_DIR = "repromodel_core/cache/manifests"
 
 def parse_constructor_params(node):
     """Extract constructor parameters and type annotations from a class node."""
@@ -53,6 +60,345 @@ def one_hot_encode(labels, num_classes, type="numpy"):
         
         return one_hot_encoded
 
+def encode_targets(targets, encoding, num_classes=None, smoothing=0.0, dtype=torch.float32, dim=1):
+    """
+    Expand a collated batch of compact targets into the dense form the losses and metrics expect.
+
+    Args:
+    - targets (Tensor): Integer class labels of shape (B,) or binary masks of shape (B, H, W).
+    - encoding (str): 'one_hot' for class labels, 'complement' to stack a mask with its complement
+      along dim, or 'none' to return the targets unchanged.
+    - num_classes (int): Number of classes, required for 'one_hot'.
+    - smoothing (float): Label smoothing factor, moving this much probability mass uniformly over all classes.
+    - dtype (torch.dtype): Floating point dtype of the encoded targets.
+    - dim (int): Dimension of the two channels for 'complement'.
+
+    Returns:
+    - The encoded targets.
+    """
+    if encoding == 'none':
+        return targets
+    if encoding == 'one_hot':
+        if num_classes is None:
+            raise ValueError("num_classes is required for one-hot encoding")
+        encoded = torch.nn.functional.one_hot(targets.long(), num_classes).to(dtype)
+    elif encoding == 'complement':
+        targets = targets.to(dtype)
+        encoded = torch.stack((targets, 1 - targets), dim=dim)
+        num_classes = 2
+    else:
+        raise ValueError(f"Unknown target encoding '{encoding}'")
+    if smoothing > 0:
+        encoded = encoded * (1 - smoothing) + smoothing / num_classes
+    return encoded
+
+def hash_params(params):
+    """Return a stable SHA-1 hex digest of a JSON-serialisable parameter dictionary."""
+    serialized = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+def file_fingerprint(file_path, with_content=True):
+    """
+    Fingerprint a file by its size and modification time, and optionally by a hash of its content.
+
+    Args:
+    - file_path (str or Path): The file to fingerprint.
+    - with_content (bool): Whether to also hash the file content.
+
+    Returns:
+    - fingerprint (dict): Keys 'size', 'mtime_ns' and, if requested, 'sha1'.
+    """
+    stat = os.stat(file_path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_content:
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+def load_manifest(manifest_path, fingerprint):
+    """
+    Load a preprocessing manifest. A new, empty manifest is returned if the file does not exist,
+    cannot be read, or was written by a preprocessor with a different fingerprint.
+    """
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('fingerprint') == fingerprint:
+                return manifest
+            print_to_file(f"Preprocessing configuration changed, rebuilding {manifest_path}")
+        except (OSError, ValueError) as e:
+            print_to_file(f"Manifest {manifest_path} could not be read ({e}), rebuilding it")
+    return {'fingerprint': fingerprint, 'files': {}}
+
+def save_manifest(manifest_path, manifest, indent=4):
+    """Atomically write a manifest, so an interrupted run never leaves a corrupt file."""
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=indent)
+    os.replace(tmp_path, manifest_path)
+
+def _file_manifest_is_valid(manifest, directory):
+    # Adding, removing or renaming an entry changes the modification time of its directory
+    try:
+        return all(os.stat(os.path.join(directory, rel_dir)).st_mtime_ns == mtime_ns
+                   for rel_dir, mtime_ns in manifest['dirs'].items())
+    except OSError:
+        return False
+
+def scan_directory(directory, recursive=True, manifest_dir=FILE_MANIFEST_DIR):
+    """
+    List every non-hidden file below a directory with its size and modification time.
+
+    The listing is saved as a manifest in manifest_dir together with the modification time of every
+    scanned directory, and reused as long as none of those changed, so opening a large dataset only
+    costs one stat per directory instead of a full walk.
+
+    Args:
+    - directory (str): The directory to scan.
+    - recursive (bool): Whether to include subdirectories.
+    - manifest_dir (str): Folder for the manifests, or None to always scan.
+
+    Returns:
+    - The manifest: {'directory', 'recursive', 'dirs': {relative dir: mtime_ns},
+      'files': [[relative path, size, mtime_ns], ...] sorted by path, 'count'}.
+    """
+    directory = os.path.abspath(directory)
+    manifest_path = None
+    if manifest_dir is not None:
+        key = hash_params({'directory': directory, 'recursive': recursive})[:16]
+        manifest_path = os.path.join(manifest_dir, f"{key}.json")
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get('directory') == directory and _file_manifest_is_valid(manifest, directory):
+                    return manifest
+            except (OSError, ValueError):
+                pass
+
+    manifest = {'directory': directory, 'recursive': recursive, 'dirs': {}, 'files': []}
+    pending = ['.']
+    while pending:
+        rel_dir = pending.pop()
+        path = os.path.join(directory, rel_dir)
+        # Record the time before listing, so changes during the scan invalidate the manifest
+        manifest['dirs'][rel_dir] = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+                if entry.is_dir():
+                    if recursive:
+                        pending.append(rel_path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    manifest['files'].append([rel_path, stat.st_size, stat.st_mtime_ns])
+    manifest['files'].sort()
+    manifest['count'] = len(manifest['files'])
+
+    if manifest_path is not None:
+        try:
+            ensure_folder_exists(manifest_dir)
+            save_manifest(manifest_path, manifest, indent=None)
+        except OSError as e:
+            print_to_file(f"File manifest for {directory} could not be saved ({e})")
+    return manifest
+
+def list_files(directory, extensions=None, recursive=True, manifest_dir=FILE_MANIFEST_DIR):
+    """
+    Return the sorted absolute paths of the non-hidden files below a directory, optionally only those
+    ending with one of extensions, using the manifest from scan_directory.
+    """
+    manifest = scan_directory(directory, recursive=recursive, manifest_dir=manifest_dir)
+    if isinstance(extensions, str):
+        extensions = (extensions,)
+    return [os.path.join(manifest['directory'], rel_path) for rel_path, _, _ in manifest['files']
+            if extensions is None or rel_path.endswith(tuple(extensions))]
+
+def get_stale_files(input_paths, manifest, output_file):
+    """
+    Return the input files whose preprocessed output is missing or out of date.
+
+    A file is up to date if it is listed in the manifest, its output exists, and its size and
+    modification time are unchanged. If only the modification time changed (e.g. after a copy),
+    the content hash decides.
+
+    Args:
+    - input_paths (list of Path): Candidate input files.
+    - manifest (dict): Manifest as returned by load_manifest.
+    - output_file (callable): Maps an input path to its output path.
+    """
+    stale = []
+    for path in input_paths:
+        entry = manifest['files'].get(path.name)
+        if entry is None or not output_file(path).exists():
+            stale.append(path)
+            continue
+        current = file_fingerprint(path, with_content=False)
+        if current['size'] != entry['size']:
+            stale.append(path)
+        elif current['mtime_ns'] != entry['mtime_ns']:
+            if file_fingerprint(path)['sha1'] == entry.get('sha1'):
+                entry['mtime_ns'] = current['mtime_ns']
+            else:
+                stale.append(path)
+    return stale
+
+def chunk_list(items, chunk_size):
+    """Split a list into consecutive chunks of at most chunk_size items."""
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+def accepts_argument(function, name):
+    """Check whether a callable takes a parameter called name."""
+    try:
+        return name in inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+
+def get_sample_labels(dataset):
+    """
+    Return the class label of every sample of a dataset in its current mode, or None if the
+    dataset does not keep its labels in a 1D targets attribute next to its mode indices.
+    """
+    targets = getattr(dataset, 'targets', None)
+    indices = getattr(dataset, f"{getattr(dataset, 'mode', '')}_indices", None)
+    if targets is None or indices is None or not len(indices):
+        return None
+    labels = np.asarray(targets)
+    if labels.ndim != 1:
+        return None
+    return labels[np.asarray(indices)]
+
+def stratified_subsample(num_samples, fraction, labels=None, seed=42):
+    """
+    Draw a fixed fraction of sample positions, per class if labels are given so that the class
+    proportions are kept and every class keeps at least one sample.
+
+    Args:
+    - num_samples (int): Number of samples to draw from.
+    - fraction (float): Fraction of samples to keep, in (0, 1].
+    - labels (array): Optional class label per sample.
+    - seed (int): Seed of the draw, so that every evaluation sees the same subset.
+
+    Returns:
+    - Sorted int64 array of positions.
+    """
+    if fraction >= 1.0:
+        return np.arange(num_samples)
+    rng = np.random.default_rng(seed)
+    if labels is None:
+        size = max(1, int(round(num_samples * fraction)))
+        return np.sort(rng.choice(num_samples, size=size, replace=False))
+    labels = np.asarray(labels)
+    positions = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        size = max(1, int(round(len(members) * fraction)))
+        positions.append(rng.choice(members, size=size, replace=False))
+    return np.sort(np.concatenate(positions))
+
+def apply_transforms(transform, image, mask=None, stage='full'):
+    """
+    Apply an augmentation to an image and, optionally, a mask.
+
+    The compiled pipeline is reused across samples and the call convention is chosen from
+    transform.pipeline_kind: albumentations pipelines receive numpy arrays as keyword arguments,
+    torchvision pipelines are called on the image (and separately on the mask).
+
+    Args:
+    - transform (CustomAugmentations): The configured augmentation.
+    - image (PIL.Image or np.ndarray): The input image.
+    - mask (PIL.Image or np.ndarray): Optional segmentation mask.
+    - stage (str): Which pipeline of the augmentation to apply, see CustomAugmentations.get_pipeline.
+
+    Returns:
+    - The transformed image, or a tuple (image, mask) if a mask was given.
+    """
+    pipeline = transform.get_pipeline(stage)
+    if transform.pipeline_kind == 'albumentations' and stage != 'tensor':
+        if mask is None:
+            return pipeline(image=np.asarray(image))['image']
+        transformed = pipeline(image=np.asarray(image), mask=np.asarray(mask))
+        return transformed['image'], transformed['mask']
+    if mask is None:
+        return pipeline(image)
+    return pipeline(image), pipeline(mask)
+
+def supports_tensor_input(transform):
+    """Whether samples can be handed to the augmentation (or returned, if there is none) as uint8 tensors."""
+    if transform is None:
+        return True
+    return hasattr(transform, 'get_pipeline') and transform.get_pipeline('tensor') is not None
+
+def get_output_size(transform):
+    """Return the (height, width) the augmentation resizes images to, or None if it does not declare one."""
+    if transform is None or not hasattr(transform, 'get_output_size'):
+        return None
+    return transform.get_output_size()
+
+def load_image(source, size=None, mode="RGB"):
+    """
+    Decode an image and convert it to mode.
+
+    If size is given and the file is a JPEG, the decoder scales the image down by a power of two while
+    keeping it at least as large as size, which is much cheaper than a full decode followed by a resize.
+
+    Args:
+    - source (str or PIL.Image): A file path, or an image opened lazily with Image.open.
+    - size (tuple): Optional (height, width) the image will be resized to afterwards.
+    - mode (str): The PIL mode of the returned image.
+    """
+    img = Image.open(source) if isinstance(source, (str, os.PathLike)) else source
+    if size is not None and img.format == 'JPEG':
+        img.draft(mode, (size[1], size[0]))
+    return img.convert(mode)
+
+def transform_sample(transform, load, cache=None, key=None, train=True, with_mask=False):
+    """
+    Load a sample and apply an augmentation to it.
+
+    If the augmentation declares a deterministic prefix, validation and test samples get the prefix
+    followed by the eval steps, so no random augmentation is applied to them. If a cache is also
+    given, the prefix output is computed once per sample and kept in the cache. Afterwards only the
+    random suffix is applied in training, and validation and test samples are served from the cache
+    without being loaded again.
+
+    Args:
+    - transform (CustomAugmentations): The configured augmentation, or None.
+    - load (callable): Returns the raw image, or a tuple (image, mask) if with_mask is True.
+    - cache (TransformCache): Optional cache of deterministic prefix outputs.
+    - key: Cache key of the sample, usually its index in the underlying dataset.
+    - train (bool): Whether the random part of the augmentation is applied.
+    - with_mask (bool): Whether the sample consists of an image and a mask.
+
+    Returns:
+    - The transformed image, or a tuple (image, mask) if with_mask is True.
+    """
+    def apply(sample, stage):
+        return apply_transforms(transform, *sample, stage=stage) if with_mask else apply_transforms(transform, sample, stage=stage)
+
+    if transform is None:
+        return load()
+    if transform.get_pipeline('deterministic') is None or (cache is None and train):
+        return apply(load(), 'full')
+
+    # Validation and test samples get the deterministic prefix and the eval steps with or without a cache
+    sample = cache.get(key) if cache is not None else None
+    if sample is None:
+        sample = apply(load(), 'deterministic')
+        if cache is not None:
+            cache.put(key, sample)
+
+    stage = 'random' if train else 'eval'
+    if transform.get_pipeline(stage) is None:
+        return sample
+    return apply(sample, stage)
+
 def load_cfg(metadata_path):
     """
     Load a configuration and metadata from a metadata file.
@@ -118,7 +464,15 @@ def get_all_ckpts(model_save_path, models, num_folds):
     return ckpts
 
 def save_model(config, model, model_name, fold, epoch,
-                optimizer, lr_scheduler, early_stopping, train_loss, val_loss, is_best=False):
+                optimizer, lr_scheduler, early_stopping, train_loss, val_loss, is_best=False, step=None, progress=None):
+    # progress replaces the model, fold and epoch of this checkpoint in the progress file, e.g. for runs trained together
+    # In distributed training only the main process writes checkpoints
+    if not is_main_process():
+        return
+    # Checkpoints hold the plain model, not its DistributedDataParallel wrapper
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        model = model.module
+
 
     experiment_folder = config.model_save_path + model_name
     # Make sure that experiment folder exists
@@ -136,24 +490,27 @@ def save_model(config, model, model_name, fold, epoch,
         'model_name': model_name,
         'fold': fold,
         'epoch': epoch,
+        'step': step,
         'config': config,   
         'model_state_dict_path': f'{experiment_folder}/{model_name}{suffix}.pt',
         'optimizer_state_dict_path': f'{experiment_folder}/{model_name}{suffix}_optimizer.pt',
         'lr_scheduler_state_dict_path': f'{experiment_folder}/{model_name}{suffix}_lr_scheduler.pt',
         'early_stopping_state_dict_path': f'{experiment_folder}/{model_name}{suffix}_early_stopping.pt' if hasattr(early_stopping, 'state_dict') else '',
         'train_loss': train_loss,
-        'val_loss': val_loss
+        'val_loss': val_loss,
+        'batch_size_decision': config.get('batch_size_decision')
     }
 
     with open(f"{experiment_folder}/{model_name}{suffix}_metadata.json", 'w') as f:
         json.dump(metadata, f, indent=4)
         print_to_file(f"Metadata saved to {experiment_folder}/{model_name}{suffix}_metadata.json")
 
-    progress = {
-        'model_name': model_name,
-        'fold': fold,
-        'epoch': epoch
-    }
+    if progress is None:
+        progress = {
+            'model_name': model_name,
+            'fold': fold,
+            'epoch': epoch
+        }
 
     with open(config.progress_path, 'w') as f:
         json.dump(progress, f, indent=4)
@@ -212,6 +569,9 @@ def copy_covered_files(coverage_json_path, root_folder, additional_files=None):
 
 def print_to_file(string, config = None, tqdm=False, model_num = None):
     """Print a string to a file, with optional tqdm compatibility."""
+    # In distributed training only the main process writes the log files
+    if not is_main_process():
+        return
     if config is not None:
         file_name = f"{config.tensorboard_log_path}/{config.training_name}_{config.models[model_num].split('.')[-1]}_{config.datasets.split('.')[-1]}" + ".txt"
     else:
@@ -0,0 +1,128 @@
+import queue
+import torch
+import torch.multiprocessing as mp
+import torchmetrics
+from copy import deepcopy
+from torch.utils.data import DataLoader
+from .distributed import all_reduce_sum
+
+def validate(model, dataloader, criterion, metrics, target_encoder, device):
+    """
+    Run one validation pass and return the average loss and the average of every metric.
+
+    Args:
+    - model (nn.Module): The model to evaluate; it is left in eval mode.
+    - dataloader (iterable): Yields (inputs, labels) batches.
+    - criterion (callable): The loss function.
+    - metrics (list): Metric objects, called per batch.
+    - target_encoder (callable): Expands the compact labels of a batch.
+    - device (str): Device the batches are moved to.
+    """
+    model.eval()
+    total_val_loss = 0.0
+    total_val_metrics = [0]*len(metrics)
+    total_samples = 0
+
+    with torch.no_grad():
+        for inputs, labels in dataloader:
+            inputs, labels = inputs.to(device), labels.to(device)
+            labels = target_encoder(labels)
+            outputs = model(inputs)
+            val_loss = criterion(outputs, labels)
+            total_val_loss += val_loss.item() * inputs.size(0)
+            total_samples += inputs.size(0)
+
+            #caluclate and save val metrics
+            for i, metric in enumerate(metrics):
+                if isinstance(metric, torchmetrics.Dice):
+                    labels = labels.long()
+                total_val_metrics[i] += metric(outputs, labels)
+
+    # In distributed training every process validated its own share
+    total_val_loss, total_samples, *total_val_metrics = all_reduce_sum([total_val_loss, total_samples] + total_val_metrics)
+
+    #average loss and metrics calculation
+    average_val_metrics = [val_m / total_samples for val_m in total_val_metrics]
+    return total_val_loss / total_samples, average_val_metrics
+
+def _to_float(value):
+    return value.item() if isinstance(value, torch.Tensor) else float(value)
+
+def _validation_worker(model, datasets, batch_size, criterion, metrics, target_encoder, num_threads, requests, results):
+    # Runs in the sidecar process; model lives in shared memory and is only read here
+    torch.set_num_threads(num_threads)
+    loaders = {name: DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False)
+               for name, dataset in datasets.items()}
+    while True:
+        name = requests.get()
+        if name is None:
+            break
+        try:
+            val_loss, val_metrics = validate(model, loaders[name], criterion, metrics, target_encoder, 'cpu')
+            results.put(('ok', val_loss, [_to_float(value) for value in val_metrics]))
+        except Exception as e:
+            results.put(('error', repr(e), None))
+
+class AsyncValidator:
+    """
+    Validation in a separate process on the CPU, so training continues while a snapshot of the
+    weights is evaluated.
+
+    The weights are copied into a model in shared memory and the sidecar process evaluates that
+    copy. At most one validation is in flight: submit() may only be called after the previous
+    result was collected, which keeps the snapshot unchanged until its result is back. Results
+    therefore arrive one validation late, and shared_model still holds the weights they belong to.
+
+    The sidecar builds its own DataLoaders without workers from the datasets it is given.
+
+    Args:
+    - model (nn.Module): Model whose architecture is copied to shared memory.
+    - datasets (dict): Validation datasets by name, e.g. {'full': ..., 'subset': ...}.
+    - batch_size (int): Batch size of the validation loaders.
+    - criterion (callable): The loss function.
+    - metrics (list): Metric objects, copied to the sidecar.
+    - target_encoder (callable): Expands the compact labels of a batch; must be picklable.
+    - num_threads (int): Number of intra-op threads of the sidecar.
+    """
+    def __init__(self, model, datasets, batch_size, criterion, metrics, target_encoder, num_threads=1):
+        context = mp.get_context('spawn')
+        self.shared_model = deepcopy(model).cpu().eval()
+        self.shared_model.share_memory()
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = None
+        self.process = context.Process(target=_validation_worker, daemon=True,
+                                       args=(self.shared_model, datasets, batch_size, criterion, metrics,
+                                             target_encoder, num_threads, self.requests, self.results))
+        self.process.start()
+
+    def submit(self, model, info, dataset='full'):
+        """Snapshot the weights of model and validate them on the named dataset; info is returned with the result."""
+        if self.pending is not None:
+            raise RuntimeError("Collect the previous validation result before submitting a new one")
+        self.shared_model.load_state_dict(model.state_dict())
+        self.pending = info
+        self.requests.put(dataset)
+
+    def collect(self):
+        """Wait for the validation in flight and return (info, val_loss, val_metrics), or None if there is none."""
+        if self.pending is None:
+            return None
+        while True:
+            try:
+                status, val_loss, val_metrics = self.results.get(timeout=5)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"Validation process exited with code {self.process.exitcode}")
+        if status != 'ok':
+            raise RuntimeError(f"Validation process failed with error {val_loss}")
+        info, self.pending = self.pending, None
+        return info, val_loss, val_metrics
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,34 @@
+import os
+import json
+import argparse
+from src.sweeps import run_sweep
+from src.pbt import run_population
+from src.utils import print_to_file
+
+# Main sweep function
+def sweep(input_data):
+    # Load the sweep config from a file or a JSON string. Component names keep their '>'
+    # separators here, the trainer of every trial replaces them itself.
+    if isinstance(input_data, dict):
+        sweep_config = input_data
+    elif os.path.isfile(input_data):
+        with open(input_data, 'r') as f:
+            sweep_config = json.load(f)
+    else:
+        sweep_config = json.loads(input_data)
+    if sweep_config.get('method') == 'pbt':
+        return run_population(sweep_config)
+    return run_sweep(sweep_config)
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser(description='Run a hyperparameter sweep over training configs')
+        parser.add_argument('input_data', type=str, help='Path to the JSON sweep file or JSON string')
+        args = parser.parse_args()
+    except:
+        print_to_file("Parsing arguments failed")
+
+    try:
+        sweep(args.input_data)
+    except Exception as e:
+        print_to_file(f"Sweep failed. Exiting with an error: {e}")
@@ -5,8 +5,12 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from easydict import EasyDict as edict
 import argparse
-from src.getters import configure_component
-from src.utils import print_to_file, load_state, get_all_ckpts, delete_command_outputs, load_and_replace_keys, replace_in_string, TqdmFile
+from src.getters import configure_component, set_streaming_preprocessor, set_transform_cache, get_target_encoder, generate_fold_indices
+from src.caching import set_annotation_cache_dir
+from src.ensembles import get_member_params
+from src.training import run_name
+from src.run_index import RunIndex, unit_fingerprint, fold_data_fingerprint
+from src.utils import hash_params, print_to_file, load_state, get_all_ckpts, delete_command_outputs, load_and_replace_keys, replace_in_string, TqdmFile
 
 SRC_DIR = "src."
 
@@ -31,33 +35,65 @@ def test(input_data):
 
     # Load test dataset
     dataset_path = SRC_DIR + "datasets." + cfg.datasets
+    # Datasets that cache their annotation files keep them under cache_path
+    set_annotation_cache_dir(os.path.join(cfg.get("cache_path", "repromodel_core/cache/"), "annotations"))
     test_dataset = configure_component(dataset_path, cfg.datasets_params[cfg.datasets])
-    test_dataset.generate_indices(k=cfg.data_splits.k, random_seed=cfg.data_splits.random_seed)
+    if "preprocessing" in cfg and cfg.get("preprocessing_mode", "offline") == "on_the_fly":
+        preprocessor_path = SRC_DIR + "preprocessing." + cfg.preprocessing
+        preprocessor = configure_component(preprocessor_path, cfg.preprocessing_params[cfg.preprocessing])
+        preprocessor.set_streaming(write_through=cfg.get("preprocessing_cache", False))
+        set_streaming_preprocessor(test_dataset, preprocessor, cfg.datasets)
+    # Test samples get the eval transforms of the augmentation, as validation samples do in training
+    augmentor_path = SRC_DIR + "augmentations." + cfg.augmentations
+    augmentor = configure_component(augmentor_path, cfg.augmentations_params[cfg.augmentations])
+    test_dataset.set_transforms(augmentor)
+    # The deterministic part of the augmentation may already be cached by the training
+    set_transform_cache(test_dataset, augmentor, cfg)
+    generate_fold_indices(test_dataset, cfg)
+    target_encoder = get_target_encoder(test_dataset, cfg)
 
     # TensorBoard writer
     writer = SummaryWriter(log_dir=cfg.tensorboard_log_path)
 
+    # Test results of identical units are reused from the run index
+    run_index = RunIndex(cfg.get("run_index_path", "repromodel_core/run_index/")) if cfg.get("memoize_runs", False) else None
+
+    # Members of a hyperparameter ensemble are checkpointed, and tested, as runs of their own
+    num_members = len(get_member_params(cfg)) if cfg.get("vmap_ensemble", {}).get("mode", "none") == "hyperparameters" else 0
+    tested_runs = [(m, model_name, run_name(model_name, member if num_members else None))
+                   for m, model_name in enumerate(cfg.models) for member in range(max(num_members, 1))]
+
     # get all saved checkpoints
-    checkpoints = get_all_ckpts(cfg.model_save_path, cfg.models, cfg.data_splits.k)
-    for m, model_name in enumerate(cfg.models):
+    checkpoints = get_all_ckpts(cfg.model_save_path, [name for _, _, name in tested_runs], cfg.data_splits.k)
+    for m, model_name, name in tested_runs:
         # Custom file object for TQDM
         tqdm_file = TqdmFile(config=cfg, model_num = m)
 
         model_path = SRC_DIR + "models." + model_name 
-        checkpoint_path = checkpoints[model_name]
+        checkpoint_path = checkpoints[name]
         # Load model
         model = configure_component(model_path, cfg.models_params[model_name]).to(cfg.device)
 
         #add iteration over all folds
         for k in range(cfg.data_splits.k):
-            print_to_file(f"Testing model {model_name} on fold {k}")
+            print_to_file(f"Testing model {name} on fold {k}")
+            if run_index is not None:
+                test_fingerprint = hash_params({'unit': unit_fingerprint(cfg, model_name, k, fold_data_fingerprint(test_dataset, k, cfg)),
+                                                'run': name, 'metrics': cfg.metrics, 'metrics_params': cfg.metrics_params})
+                entry = run_index.lookup(test_fingerprint, kind="test")
+                # Metrics are only reused for the very checkpoint that is tested now; lookup() rejects entries whose checkpoint was trained again since
+                if entry is not None and entry['model_state_dict_path'] == checkpoint_path[k]:
+                    print_to_file(f"Fold {k} of model {name} was already tested in {entry['training_name']}; reusing its metrics")
+                    for metric_name, value in entry['metrics'].items():
+                        writer.add_scalar(f'CrossValTest/Fold_{k}/{name}/{metric_name}', value)
+                    continue
             checkpoint = torch.load(checkpoint_path[k], map_location=cfg.device)
             model = load_state(model, checkpoint)
 
             #configure dataloader 
             test_dataset.set_fold(k)
             test_dataset.set_mode('test')
-            test_loader = DataLoader(test_dataset, batch_size=cfg.batch_size, shuffle=False)
+            test_loader = DataLoader(test_dataset, batch_size=cfg.batch_size, shuffle=False, num_workers=cfg.get("num_workers", 0))
 
             # Configure metrics
             metrics = {}
@@ -74,6 +110,7 @@ def test(input_data):
                 progress_bar = tqdm(enumerate(test_loader), total=len(test_loader), file=tqdm_file)
                 for batch_idx, (inputs, targets) in progress_bar:
                     inputs, targets = inputs.to(cfg.device), targets.to(cfg.device)
+                    targets = target_encoder(targets)
                     outputs = model(inputs)
 
                     batch_size = inputs.size(0)
@@ -88,7 +125,12 @@ def test(input_data):
 
             # Log results to TensorBoard
             for metric_name, value in avg_metrics.items():
-                writer.add_scalar(f'CrossValTest/Fold_{k}/{model_name}/{metric_name}', value)
+                writer.add_scalar(f'CrossValTest/Fold_{k}/{name}/{metric_name}', value)
+            if run_index is not None:
+                run_index.record(test_fingerprint, {
+                    'model_name': name, 'fold': k, 'training_name': cfg.training_name,
+                    'model_state_dict_path': checkpoint_path[k], 'model_mtime_ns': os.stat(checkpoint_path[k]).st_mtime_ns,
+                    'metrics': {metric_name: float(value) for metric_name, value in avg_metrics.items()}}, kind="test")
         
     writer.close()
     print_to_file("Cross-validation testing is completed and results are logged to TensorBoard successfully.")
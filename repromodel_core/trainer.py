@@ -1,23 +1,35 @@
 import os
 import torch
 import random
-import torchmetrics
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 from easydict import EasyDict as edict
 import argparse
-from src.getters import configure_component, get_optimizer, get_lr_scheduler, configure_device_specific, init_tensorboard_logging, load_json
-from src.utils import save_model, print_to_file, delete_command_outputs, load_state, get_last_dict_paths, load_and_replace_keys, replace_in_string, TqdmFile
-from copy import deepcopy
+from src.getters import configure_component, get_optimizer, get_lr_scheduler, configure_device_specific, init_tensorboard_logging, load_json, set_streaming_preprocessor, set_transform_cache, get_target_encoder, generate_fold_indices
+from src.utils import print_to_file, ensure_folder_exists, save_manifest, get_sample_labels, stratified_subsample, delete_command_outputs, load_state, get_last_dict_paths, load_and_replace_keys, replace_in_string, TqdmFile
+from copy import copy, deepcopy
+from functools import partial
+from src.echoing import EchoingLoader
+from src.caching import BatchCache, set_annotation_cache_dir
+from src.validation import AsyncValidator
+from src.training import FoldRun, GroupProgress, run_name
+from src.ensembles import get_member_params, train_ensemble_step
+from src.racing import FoldRace
+from src.autotune import autotune_key, load_tuning, save_tuning, candidate_settings, autotune, set_interop_threads
+from src.batch_size_finder import default_memory_budget, probe_batch_size, find_max_batch_size, scale_learning_rate
+from src.checkpointing import ResumableSampler, CheckpointTimer, handle_preemption, preemption_requested, get_rng_state, set_rng_state, save_latest_checkpoints, load_latest_checkpoint, remove_latest_checkpoint
+from src.run_index import RunIndex, unit_fingerprint, fold_data_fingerprint, reuse_checkpoint
+from src.sweeps import report_trial_result
+from src.pbt import PopulationMember, apply_hyperparameters
+from src.distributed import init_distributed, cleanup_distributed, main_process_first, get_sampler, set_sampler_epoch, is_main_process, broadcast_object
 import sys 
 
 SRC_DIR = "src."
 
 # Main training function
-def train(input_data):
-    #restart command outputs file
-    delete_command_outputs()
-
+def train(input_data, autotune_only=False):
+    # With autotune_only, the threads and workers of every model group are tuned and cached without training
     # Load config
     # Check if input_data is a dictionary
     if isinstance(input_data, dict):
@@ -32,6 +44,17 @@ def train(input_data):
 
     cfg = edict(data)
 
+    #restart command outputs file, except in sweep and population trials which share it with their driver
+    if not cfg.get("trial_report_path"):
+        delete_command_outputs()
+
+    # Data-parallel training when started by torchrun with several processes
+    distributed = cfg.get("distributed", False) and init_distributed(backend="gloo")
+    if distributed and (cfg.get("vmap_ensemble", {}).get("mode", "none") != "none" or cfg.get("async_validation", False) or cfg.get("pbt")):
+        raise ValueError("Vectorised ensembles, asynchronous validation and population-based training are not supported in distributed training")
+    # A misconfigured vectorised ensemble fails before any preprocessing or training
+    get_member_params(cfg)
+
     # fix the random seed
     random.seed(cfg.data_splits.random_seed)
     torch.manual_seed(17)
@@ -55,26 +78,50 @@ def train(input_data):
             print_to_file(f"Loading from checkpoint failed with error {e}")
 
     # Get preprocessing, augmentation, and dataset configurations
+    preprocessor = None
     if "preprocessing" in cfg:
         preprocessor_path = SRC_DIR + "preprocessing." + cfg.preprocessing
         preprocessor = configure_component(preprocessor_path, cfg.preprocessing_params[cfg.preprocessing])
-        #preprocess the dataset
-        preprocessor.preprocess()
+        if cfg.get("preprocessing_mode", "offline") == "on_the_fly":
+            # preprocessing is applied per sample by the dataset inside the DataLoader workers
+            preprocessor.set_streaming(write_through=cfg.get("preprocessing_cache", False))
+        else:
+            #preprocess the dataset
+            with main_process_first():
+                preprocessor.preprocess()
 
     augmentor_path = SRC_DIR + "augmentations." + cfg.augmentations
     augmentor = configure_component(augmentor_path, cfg.augmentations_params[cfg.augmentations])
+    # In batch mode the random part of the augmentation runs on whole collated batches in the training loop
+    batch_transforms = None
+    if cfg.get("augmentation_mode", "sample") == "batch":
+        if augmentor.enable_batch_mode():
+            batch_transforms = augmentor.get_batch_transforms()
+        else:
+            print_to_file(f"{cfg.augmentations} has no batch transforms, augmenting per sample instead")
     dataset_path = SRC_DIR + "datasets." + cfg.datasets
+    # Datasets that cache their annotation files keep them under cache_path
+    set_annotation_cache_dir(os.path.join(cfg.get("cache_path", "repromodel_core/cache/"), "annotations"))
     dataset = configure_component(dataset_path, cfg.datasets_params[cfg.datasets])
     dataset.set_transforms(augmentor)
-    dataset.generate_indices(k=cfg.data_splits.k, random_seed=cfg.data_splits.random_seed)
+    if preprocessor is not None and cfg.get("preprocessing_mode", "offline") == "on_the_fly":
+        set_streaming_preprocessor(dataset, preprocessor, cfg.datasets)
+    # The deterministic part of the augmentation is computed once per sample; validation is served from the cache
+    # The main process fills the caches on disk before the other processes read them
+    with main_process_first():
+        set_transform_cache(dataset, augmentor, cfg)
+        generate_fold_indices(dataset, cfg)
+    # Datasets return compact targets (class indices, uint8 masks) that are expanded per batch on the device
+    target_encoder = get_target_encoder(dataset, cfg)
     # Get metrics, model, optimizer, scheduler, loss function, and early stopper
-    train_metrics, val_metrics = [], []
-    
-    for metric in cfg.metrics:
-        params = cfg.metrics_params[metric]
-        metric_path = SRC_DIR + "metrics." + metric
-        train_metrics.append(configure_component(metric_path, params))
-        val_metrics.append(configure_component(metric_path, params))
+    # Metric objects keep state, so every run gets its own
+    def get_metrics():
+        metrics = []
+        for metric in cfg.metrics:
+            params = cfg.metrics_params[metric]
+            metric_path = SRC_DIR + "metrics." + metric
+            metrics.append(configure_component(metric_path, params))
+        return metrics
 
     models = []
     for model_name in cfg.models:
@@ -87,30 +134,102 @@ def train(input_data):
     loss_path = SRC_DIR + "losses." + cfg.losses
     criterion = configure_component(loss_path, cfg.losses_params[cfg.losses])
 
-    for m in range(model_min, len(cfg.models)):
-        print_to_file(f"Training started. Output in file {cfg.tensorboard_log_path}/{cfg.training_name}_{cfg.models[m].split('.')[-1]}_{cfg.datasets.split('.')[-1]}" + ".txt")
-        print_to_file("Training model " + cfg.models[m], config=cfg, model_num = m)
-
-        # Custom file object for TQDM
-        tqdm_file = TqdmFile(config=cfg, model_num = m) 
-
-        # Training loop for each fold
-        for k in range(k_min, cfg.data_splits.k):
-            # Initialize TensorBoard
-            writer = init_tensorboard_logging(cfg, k, m)
+    num_workers = cfg.get("num_workers", 0)
+    echo_factor = cfg.get("echo_factor", 1)
+    val_every_steps = cfg.get("val_every_steps", 0)
+    # Cached validation batches per fold, shared by all models
+    val_batch_caches = {}
+
+    def build_loaders(k, drop_last=False):
+        """Return the training loader, validation loader and validation subset loader of fold k."""
+        # Shallow copies: the modes only differ in which shared fold indices they read
+        fold_dataset = copy(dataset)
+        fold_dataset.set_fold(k)
+
+        train_dataset = copy(fold_dataset)
+        train_dataset.set_mode('train')
+
+        val_dataset = copy(fold_dataset)
+        val_dataset.set_mode('val')
+
+        # Prepare the DataLoader for the training dataset; in distributed training every process reads its own share
+        train_sampler = get_sampler(train_dataset, shuffle=True, seed=cfg.data_splits.random_seed, drop_last=drop_last)
+        # Without distributed training a single-replica DistributedSampler gives the same seeded shuffle per epoch,
+        # so that an interrupted epoch can be drawn again and its consumed batches skipped
+        if train_sampler is None:
+            train_sampler = DistributedSampler(train_dataset, num_replicas=1, rank=0, shuffle=True, seed=cfg.data_splits.random_seed)
+        train_sampler = ResumableSampler(train_sampler)
+        # Population-based training changes augmentation parameters during training; workers that are
+        # started anew every epoch pick up the changed augmentor
+        train_dataloader = DataLoader(dataset=train_dataset, batch_size=cfg.batch_size, shuffle=False,
+                                      sampler=train_sampler, drop_last=drop_last, num_workers=num_workers,
+                                      persistent_workers=num_workers > 0 and not cfg.get("pbt"))
+        # Data echoing: every loaded sample is used echo_factor times per epoch
+        if echo_factor > 1:
+            train_dataloader = EchoingLoader(train_dataloader, echo_factor=echo_factor,
+                                             buffer_size=cfg.get("echo_buffer_size", 0), seed=cfg.data_splits.random_seed)
+            if batch_transforms is None:
+                print_to_file("Data echoing without batch augmentation repeats identical samples")
+
+        # Prepare the DataLoader for the validation dataset
+        val_dataloader = DataLoader(dataset=val_dataset, batch_size=cfg.batch_size, shuffle=False,
+                                    sampler=get_sampler(val_dataset, shuffle=False),
+                                    num_workers=num_workers, persistent_workers=num_workers > 0)
+        # Validation batches do not change between epochs, so they can be kept after the first pass
+        val_cache_storage = cfg.get("val_batch_cache", "none")
+        if val_cache_storage != "none":
+            if k not in val_batch_caches:
+                val_cache_path = os.path.join(cfg.get("cache_path", "repromodel_core/cache/"), "val_batches", f"{cfg.training_name}_fold{k}")
+                val_batch_caches[k] = BatchCache(val_dataloader, storage=val_cache_storage,
+                                                 path=val_cache_path if val_cache_storage == "disk" else None,
+                                                 budget_bytes=cfg.get("val_cache_budget_mb", 1024) * 2**20)
+            val_dataloader = val_batch_caches[k]
+        # Optional fixed, stratified subset of the validation set for cheap intermediate validations
+        val_subset_dataloader = None
+        val_subsample = cfg.get("val_subsample", 1.0)
+        if val_subsample < 1.0:
+            positions = stratified_subsample(len(val_dataset), val_subsample, labels=get_sample_labels(val_dataset),
+                                             seed=cfg.data_splits.random_seed)
+            val_subset = Subset(val_dataset, positions.tolist())
+            val_subset_dataloader = DataLoader(dataset=val_subset, batch_size=cfg.batch_size, shuffle=False,
+                                               sampler=get_sampler(val_subset, shuffle=False),
+                                               num_workers=num_workers, persistent_workers=num_workers > 0)
+        return train_dataloader, val_dataloader, val_subset_dataloader
+
+    def apply_population_hyperparameters(run, hyperparameters):
+        nonlocal batch_transforms
+        # Batch transforms bind the augmentation parameters, so they are fetched again after a change
+        if apply_hyperparameters(run, hyperparameters, augmentor) and batch_transforms is not None:
+            batch_transforms = augmentor.get_batch_transforms()
+
+    def create_run(m, k, loaders, epoch, tqdm_file, member=None, member_params=None):
+        """Configure model, optimizer, scheduler, early stopper and logging of model m on fold k."""
+        train_dataloader, val_dataloader, val_subset_dataloader = loaders
+        name = run_name(cfg.models[m], member)
+        member_params = dict(member_params or {})
+        # Initialize TensorBoard
+        writer = init_tensorboard_logging(cfg, k, m, suffix=name[len(cfg.models[m]):])
+        if "seed" in member_params:
+            # Ensemble member with its own initial weights
+            torch.manual_seed(member_params.pop("seed"))
+            model = configure_component(SRC_DIR + "models." + cfg.models[m], cfg.models_params[cfg.models[m]])
+        else:
             model = deepcopy(models[m])
-            optimizer = get_optimizer(model, cfg.optimizers, cfg.optimizers_params[cfg.optimizers])
-            lr_scheduler = get_lr_scheduler(optimizer, cfg.lr_schedulers, cfg.lr_schedulers_params[cfg.lr_schedulers])
-            early_stopper = configure_component(es_path, cfg.early_stopping_params[cfg.early_stopping])
-            
-            # Configure device specifics
-            model = configure_device_specific(model, cfg.device)
-            optimizer = configure_device_specific(optimizer, cfg.device)
-            lr_scheduler = configure_device_specific(lr_scheduler, cfg.device)
-
-            if cfg.load_from_checkpoint:
-                # Load states from checkpoints
-                paths = get_last_dict_paths(cfg.model_save_path, cfg.models[m], k)
+        optimizer = get_optimizer(model, cfg.optimizers, {**cfg.optimizers_params[cfg.optimizers], **member_params})
+        lr_scheduler = get_lr_scheduler(optimizer, cfg.lr_schedulers, cfg.lr_schedulers_params[cfg.lr_schedulers])
+        early_stopper = configure_component(es_path, cfg.early_stopping_params[cfg.early_stopping])
+
+        # Configure device specifics
+        model = configure_device_specific(model, cfg.device)
+        optimizer = configure_device_specific(optimizer, cfg.device)
+        lr_scheduler = configure_device_specific(lr_scheduler, cfg.device)
+
+        # A latest checkpoint continues from the exact step; otherwise training resumes from the best checkpoint
+        latest = load_latest_checkpoint(cfg, name, k) if cfg.load_from_checkpoint else None
+        if cfg.load_from_checkpoint and latest is None:
+            # Load states from checkpoints
+            try:
+                paths = get_last_dict_paths(cfg.model_save_path, name, k)
                 checkpoint_model = torch.load(paths["model_path"], map_location=cfg.device)
                 model = load_state(model, checkpoint_model)
                 checkpoint_optimizer = torch.load(paths["optimizer_path"], map_location=cfg.device)
@@ -119,137 +238,365 @@ def train(input_data):
                 lr_scheduler = load_state(lr_scheduler, checkpoint_scheduler)
                 checkpoint_es = torch.load(paths["es_path"], map_location=cfg.device)
                 early_stopper = load_state(early_stopper, checkpoint_es)
-                print_to_file("Checkpoint states loaded")
-                cfg.load_from_checkpoint = False
-
-            dataset.set_fold(k)
-
-            train_dataset = deepcopy(dataset)
-            train_dataset.set_mode('train')
-
-            val_dataset = deepcopy(dataset)
-            val_dataset.set_mode('val')
-
-            # Prepare the DataLoader for the training dataset
-            train_dataloader = DataLoader(dataset=train_dataset, batch_size=cfg.batch_size, shuffle=True)
-
-            # Prepare the DataLoader for the validation dataset
-            val_dataloader = DataLoader(dataset=val_dataset, batch_size=cfg.batch_size, shuffle=False)
-
-            best_val_loss = float('inf')
-            epoch = max(0, epoch_min)
-            while True:
+                print_to_file("Checkpoint states loaded", config=cfg, model_num=m)
+            except Exception as e:
+                # When several runs are resumed together, some may not have saved a checkpoint yet
+                print_to_file(f"No checkpoint loaded for {name}: {e}", config=cfg, model_num=m)
+
+        if distributed:
+            # Gradients are averaged over all processes during backward
+            model = DistributedDataParallel(model)
+
+        # Asynchronous validation: a sidecar process validates weight snapshots while training continues
+        async_validator = None
+        if cfg.get("async_validation", False):
+            val_datasets = {'full': getattr(val_dataloader, 'loader', val_dataloader).dataset}
+            if val_subset_dataloader is not None:
+                val_datasets['subset'] = val_subset_dataloader.dataset
+            async_validator = AsyncValidator(model, val_datasets, cfg.batch_size, criterion, get_metrics(),
+                                             target_encoder, num_threads=cfg.get("async_val_threads", 1))
+
+        run = FoldRun(cfg, m, k, model, optimizer, lr_scheduler, early_stopper, writer, criterion,
+                      get_metrics(), get_metrics(), target_encoder, val_dataloader, val_subset_dataloader,
+                      tqdm_file=tqdm_file, epoch=epoch, global_step=epoch * len(train_dataloader),
+                      async_validator=async_validator, member=member,
+                      population_member=PopulationMember(cfg.pbt, apply_population_hyperparameters) if cfg.get("pbt") else None)
+        if latest is not None:
+            if echo_factor > 1:
+                # Echoed batches cannot be matched to loader positions, so the interrupted epoch starts over
+                latest['batches_done'] = 0
+            run.load_latest_state(latest)
+            print_to_file(f"Continuing {name} on fold {k} from epoch {run.epoch}, batch {latest['batches_done']} (step {run.global_step})", config=cfg, model_num=m)
+        return run
+
+    def prepare_batch(inputs, labels):
+        inputs, labels = inputs.to(cfg.device), labels.to(cfg.device)
+        if batch_transforms is not None:
+            inputs, labels = batch_transforms(inputs, labels)
+        # Datasets return compact targets that are expanded per batch on the device
+        return inputs, target_encoder(labels)
+
+    def run_epochs(runs, train_dataloaders, vectorised=False):
+        """
+        Train runs until all of them stopped. train_dataloaders holds the loader of every run; runs
+        sharing one loader consume the same batches. With vectorised, the runs are members of one
+        vectorised ensemble and are stepped as one batched computation.
+        """
+        loaders = dict(zip(runs, train_dataloaders))
+        shared = all(loader is train_dataloaders[0] for loader in train_dataloaders)
+        k, epoch, tqdm_file = runs[0].k, runs[0].epoch, runs[0].tqdm_file
+        # Latest checkpoints cover the whole group, also runs that finished, so that none is trained again on resume
+        group = list(runs)
+        for run in runs:
+            if run.finished:
+                run.close()
+        runs = [run for run in runs if not run.finished]
+
+        def save_latest(batches_done, preempted):
+            save_latest_checkpoints(group, batches_done=batches_done)
+            checkpoint_timer.reset()
+            if preempted:
+                print_to_file(f"Training stopped at fold {k}, epoch {epoch}, step {runs[0].global_step}; "
+                              "continue it with load_from_checkpoint", config=cfg, model_num=group[0].m)
+                for run in runs:
+                    run.close()
+                cleanup_distributed()
+                sys.exit(0)
+
+        # SIGTERM (e.g. /kill-training-process) writes latest checkpoints after the current batch and exits
+        with handle_preemption():
+            while runs:
+                # Runs continued from a latest checkpoint re-enter their epoch at the batch they had reached
+                resume = runs[0].resume_position
+                start_batch = resume['batches_done'] if resume is not None else 0
                 # Training phase
-                model.train()
-                total_train_loss = 0.0
-                total_train_metrics = [0]*len(cfg.metrics)
-                total_samples = 0
-
-                progress_bar = tqdm(enumerate(train_dataloader), total=len(train_dataloader), file=tqdm_file)
-                for batch_idx, (inputs, labels) in progress_bar:
-                    inputs, labels = inputs.to(cfg.device), labels.to(cfg.device)
+                for run in runs:
+                    run.start_epoch()
+                for loader in set(train_dataloaders):
+                    set_sampler_epoch(loader, epoch)
+                    if start_batch:
+                        loader.sampler.skip_next(start_batch * cfg.batch_size)
+                if resume is not None:
+                    set_rng_state(resume['rng_state'])
+                # Runs that stopped within the epoch they were checkpointed in do not train further
+                training = [run for run in runs if not run.should_stop]
+                if shared:
+                    batches = (((inputs, labels),) for inputs, labels in loaders[runs[0]])
+                else:
+                    # One batch per run from its own loader; an epoch ends with the shortest loader
+                    batches = zip(*[loaders[run] for run in runs])
+                num_batches = min(len(loaders[run]) for run in runs)
+
+                progress_bar = tqdm(enumerate(batches, start=start_batch), total=num_batches, initial=start_batch, file=tqdm_file)
+                for batch_idx, batch in progress_bar:
+                    if shared:
+                        inputs, labels = prepare_batch(*batch[0])
+                        if vectorised:
+                            train_ensemble_step(training, inputs, labels, shared_inputs=True)
+                        else:
+                            for run in training:
+                                run.train_step(inputs, labels)
+                    else:
+                        # Leave out the batches of runs that stopped within this epoch
+                        member_batches = [prepare_batch(*member_batch) for run, member_batch in zip(runs, batch) if run in training]
+                        inputs = torch.stack([inputs for inputs, _ in member_batches])
+                        labels = torch.stack([labels for _, labels in member_batches])
+                        if vectorised:
+                            train_ensemble_step(training, inputs, labels)
+                        else:
+                            for i, run in enumerate(training):
+                                run.train_step(inputs[i], labels[i])
+
+                    progress_bar.set_description(f"Fold {k}, Epoch {epoch} - Train Batch")
+                    if len(training) == 1:
+                        progress_bar.set_postfix(loss=training[0].train_loss)
+                    else:
+                        progress_bar.set_postfix({run.name.split('.')[-1]: run.train_loss for run in training})
+
+                    if val_every_steps and training[0].global_step % val_every_steps == 0:
+                        for run in training:
+                            run.validate(end_of_epoch=batch_idx == num_batches - 1)
+                        # Runs whose early stopper fired drop out; the others keep consuming the batches
+                        training = [run for run in training if not run.should_stop]
+                        if not training:
+                            break
+
+                    # Latest checkpoints at regular intervals, and before exiting when the process is asked to terminate
+                    preempted = preemption_requested(training[0].global_step)
+                    if preempted or checkpoint_timer.due(training[0].global_step):
+                        save_latest(batch_idx + 1, preempted)
+
+                runs = [run for run in runs if not run.end_epoch(fresh_samples=getattr(loaders[run], 'fresh_samples', None))]
+                epoch += 1
+                # A request that arrived during the end-of-epoch validation is acted on before the next epoch
+                if runs and preemption_requested():
+                    save_latest(0, True)
+        # A finished group is never continued mid-way
+        for run in group:
+            remove_latest_checkpoint(cfg, run.name, run.k)
+
+    ensemble_mode = cfg.get("vmap_ensemble", {}).get("mode", "none")
+
+    # Opt-in preflight: train with the largest batch size that fits the memory budget. The decision is
+    # kept next to the checkpoints, so that a resumed training continues with the same batch size.
+    if cfg.get("auto_batch_size", False):
+        decision_path = cfg.model_save_path + "batch_size_decision.json"
+        decision = None
+        if cfg.load_from_checkpoint and os.path.exists(decision_path):
+            decision = load_json(decision_path)
+        elif is_main_process():
+            # The probes draw from the global RNGs (loader seeds, augmentation, dropout); the training must not see that
+            rng_state = get_rng_state()
+            probe_dataset = copy(dataset)
+            probe_dataset.set_fold(k_min)
+            probe_dataset.set_mode('train')
+            inputs, labels = prepare_batch(*next(iter(DataLoader(probe_dataset, batch_size=min(8, len(probe_dataset)), shuffle=False))))
+            budget = int(cfg.get("batch_size_memory_budget_mb", 0) * 2**20) or default_memory_budget(cfg.device)
+            # Members of a vectorised ensemble and lockstep models train at the same time; each gets an equal share of the budget
+            if ensemble_mode == "folds":
+                copies = cfg.data_splits.k - k_min
+            elif ensemble_mode == "hyperparameters":
+                copies = len(get_member_params(cfg))
+            elif cfg.get("lockstep_models", False):
+                copies = len(cfg.models) - model_min
+            else:
+                copies = 1
+            max_batch_size = min(cfg.get("max_auto_batch_size", 1024), len(probe_dataset))
+            make_optimizer = lambda model: get_optimizer(model, cfg.optimizers, cfg.optimizers_params[cfg.optimizers])
+            sizes, peaks_mb = {}, {}
+            for m in range(model_min, len(cfg.models)):
+                probe = partial(probe_batch_size, models[m], make_optimizer, criterion, inputs, labels, device=cfg.device)
+                sizes[cfg.models[m]], peaks = find_max_batch_size(probe, budget // max(copies, 1), max_batch_size=max_batch_size)
+                # JSON and EasyDict keys are strings
+                peaks_mb[cfg.models[m]] = {str(size): None if peak is None else round(peak / 2**20, 1) for size, peak in sorted(peaks.items())}
+            decision = {'batch_size': min(sizes.values()), 'configured_batch_size': cfg.batch_size,
+                        'max_batch_sizes': sizes, 'budget_mb': round(budget / 2**20, 1), 'budget_shares': copies, 'peaks_mb': peaks_mb,
+                        'device': cfg.device, 'input_shape': list(inputs.shape[1:]), 'input_dtype': str(inputs.dtype),
+                        'lr_scaling': cfg.get("lr_scaling", "none")}
+            if decision['batch_size'] > 0:
+                ensure_folder_exists(cfg.model_save_path)
+                save_manifest(decision_path, decision)
+            set_rng_state(rng_state)
+        decision = broadcast_object(decision)
+        if decision['batch_size'] == 0:
+            raise ValueError(f"Not even a single sample fits the memory budget of {decision['budget_mb']} MB")
+
+        # Adapt the learning rate tuned for the configured batch size
+        optimizer_params = cfg.optimizers_params[cfg.optimizers]
+        if "lr" in optimizer_params:
+            optimizer_params["lr"] = scale_learning_rate(optimizer_params["lr"], decision['batch_size'],
+                                                         decision['configured_batch_size'], decision['lr_scaling'])
+        cfg.batch_size = decision['batch_size']
+        cfg.batch_size_decision = decision
+        print_to_file(f"Batch size {decision['batch_size']} selected within {decision['budget_mb']} MB "
+                      f"(configured {decision['configured_batch_size']}, lr scaling {decision['lr_scaling']})")
+
+    # Autotuning of intra-op threads and DataLoader workers: 'cached' reuses the setting cached for this host,
+    # model group, dataset and batch size and tunes only when there is none, 'always' tunes every time
+    autotune_mode = "always" if autotune_only else cfg.get("autotune", "off")
+    autotune_cache = cfg.get("autotune_cache_path", "repromodel_core/cache/autotune.json")
+
+    def tune_threads_and_workers(group):
+        """Return and apply the threads and workers setting with the highest training throughput for the models of group."""
+        key = autotune_key(cfg, [cfg.models[m] for m in group])
+        settings = load_tuning(autotune_cache, key) if autotune_mode == "cached" else None
+        if settings is None and is_main_process():
+            # Timed trials of the actual training step on copies of the models. They draw from the global
+            # RNGs (loader shuffling and seeds, augmentation, dropout), which are restored for the training.
+            rng_state = get_rng_state()
+            trial_dataset = copy(dataset)
+            trial_dataset.set_fold(k_min)
+            trial_dataset.set_mode('train')
+            make_loader = lambda workers: DataLoader(dataset=trial_dataset, batch_size=cfg.batch_size, shuffle=True,
+                                                     drop_last=True, num_workers=workers)
+            trial_models = [deepcopy(models[m]).to(cfg.device).train() for m in group]
+            trial_optimizers = [get_optimizer(model, cfg.optimizers, cfg.optimizers_params[cfg.optimizers]) for model in trial_models]
+
+            def train_step(inputs, labels):
+                inputs, labels = prepare_batch(inputs, labels)
+                for model, optimizer in zip(trial_models, trial_optimizers):
                     optimizer.zero_grad()
-                    outputs = model(inputs)
-                    train_loss = criterion(outputs, labels)
-                    train_loss.backward()
+                    criterion(model(inputs), labels).backward()
                     optimizer.step()
 
-                    #caluclate and save train metrics
-                    for i, metric in enumerate(train_metrics):
-                        if isinstance(metric, torchmetrics.Dice):
-                            labels = labels.long()
-                        total_train_metrics[i] += metric(outputs, labels)
+            settings = autotune(make_loader, train_step, candidate_settings(), num_batches=cfg.get("autotune_batches", 20),
+                                config=cfg, model_num=group[0])
+            set_rng_state(rng_state)
+            # The standalone autotuner compares inter-op thread counts across processes and keeps the fastest
+            save_tuning(autotune_cache, key, settings, keep_faster=autotune_only)
+        settings = broadcast_object(settings)
+        torch.set_num_threads(settings['num_threads'])
+        if not set_interop_threads(settings['num_interop_threads']):
+            print_to_file(f"{settings['num_interop_threads']} inter-op threads only take effect in a new process", config=cfg, model_num=group[0])
+        print_to_file(f"Training with {settings['num_threads']} threads and {settings['num_workers']} DataLoader workers "
+                      f"({settings['samples_per_second']:.1f} samples/s when tuned)", config=cfg, model_num=group[0])
+        return settings
+
+    # Latest checkpoints every latest_checkpoint_every_steps optimizer steps and/or latest_checkpoint_every_minutes minutes
+    checkpoint_timer = CheckpointTimer(every_steps=cfg.get("latest_checkpoint_every_steps", 0),
+                                       every_minutes=cfg.get("latest_checkpoint_every_minutes", 0))
+
+    if ensemble_mode == "none" and cfg.get("lockstep_models", False):
+        # In lockstep mode all models are trained together on the same batches, otherwise one after the other
+        model_groups = [list(range(model_min, len(cfg.models)))]
+    else:
+        model_groups = [[m] for m in range(model_min, len(cfg.models))]
 
-                    total_train_loss += train_loss.item() * inputs.size(0)
-                    total_samples += inputs.size(0)
+    # Run memoization: (model, fold) units trained before with an identical fingerprint are not trained again
+    run_index = None
+    if cfg.get("memoize_runs", False):
+        if ensemble_mode != "none" or cfg.get("pbt"):
+            print_to_file("Run memoization is only available for models trained on their own, not for ensembles or population-based training")
+        else:
+            run_index = RunIndex(cfg.get("run_index_path", "repromodel_core/run_index/"))
 
-                    progress_bar.set_description(f"Fold {k}, Epoch {epoch} - Train Batch")
-                    progress_bar.set_postfix(loss=(total_train_loss / total_samples))
-
-                average_train_loss = total_train_loss / total_samples
-
-                #average metrics calculation
-                average_train_metrics = []
-                for train_m in total_train_metrics:
-                    average_train_metrics.append(train_m / total_samples)
-
-                # Validation phase
-                model.eval()
-                total_val_loss = 0.0
-                total_val_metrics = [0]*len(cfg.metrics)
-                total_samples = 0
-                progress_bar = tqdm(enumerate(val_dataloader), total=len(val_dataloader), file=tqdm_file)
-
-                with torch.no_grad():
-
-                    for batch_idx, (inputs, labels) in progress_bar:
-                        inputs, labels = inputs.to(cfg.device), labels.to(cfg.device)
-                        outputs = model(inputs)
-                        val_loss = criterion(outputs, labels)
-                        total_val_loss += val_loss.item() * inputs.size(0)
-                        total_samples += inputs.size(0)
-
-                        #caluclate and save val metrics
-                        for i, metric in enumerate(val_metrics):
-                            if isinstance(metric, torchmetrics.Dice):
-                                labels = labels.long()
-                            total_val_metrics[i] += metric(outputs, labels)
-                
-                #average loss calculation
-                average_val_loss = total_val_loss / total_samples
-
-                #average metrics calculation
-                average_val_metrics = []
-                for val_m in total_val_metrics:
-                    average_val_metrics.append(val_m / total_samples)
-
-                # Learning rate adjustment
-                current_lr = optimizer.param_groups[0]['lr']
-                try:
-                    if cfg.monitor == 'val_loss':
-                        lr_scheduler.step(average_val_loss, current_lr)
-                    elif cfg.monitor == 'train_loss':
-                        lr_scheduler.step(average_train_loss, current_lr)
-                except TypeError:
-                    lr_scheduler.step()
-
-                #log learning rate
-                lr = optimizer.param_groups[0]['lr']
-                writer.add_scalar('Train/Learning Rate', lr, epoch)
-
-                #log losses
-                writer.add_scalar('Train/Loss', average_train_loss, epoch)
-                writer.add_scalar('Validation/Loss', average_val_loss, epoch)
-
-                # Log metrics
-                for i, metric in enumerate(cfg.metrics):
-                    writer.add_scalar(f'Train/{metric}', average_train_metrics[i], epoch)
-                    writer.add_scalar(f'Validation/{metric}', average_val_metrics[i], epoch)
-
-                # Early stopping
-                early_stopper.step(epoch)
-                if early_stopper.should_stop:
-                    print_to_file(f"Early stopping at epoch {epoch+1}", config=cfg, model_num = m)
-                    writer.close()
+    # Cross-validation racing: models that are clearly worse than the best one so far skip their remaining folds
+    race = None
+    if cfg.get("cv_racing", False):
+        if ensemble_mode == "folds":
+            print_to_file("Cross-validation racing is not possible when all folds are trained at once")
+        else:
+            race = FoldRace(os.path.join(cfg.tensorboard_log_path, f"{cfg.training_name}_racing.json"),
+                            alpha=cfg.get("cv_racing_alpha", 0.05), min_folds=cfg.get("cv_racing_min_folds", 2),
+                            resume=cfg.load_from_checkpoint)
+
+    for group in model_groups:
+        if autotune_mode != "off":
+            num_workers = tune_threads_and_workers(group)['num_workers']
+            if autotune_only:
+                continue
+        for m in group:
+            print_to_file(f"Training started. Output in file {cfg.tensorboard_log_path}/{cfg.training_name}_{cfg.models[m].split('.')[-1]}_{cfg.datasets.split('.')[-1]}" + ".txt")
+            print_to_file("Training model " + cfg.models[m], config=cfg, model_num = m)
+
+        # Custom file objects for TQDM; the shared training progress bar goes to the first model's output
+        tqdm_files = {m: TqdmFile(config=cfg, model_num = m) for m in group}
+        epoch = max(0, epoch_min)
+
+        if ensemble_mode == "folds":
+            # Vectorised ensemble over the folds: every fold is a member with its own data stream.
+            # Members are stacked per batch, so all batches need the same size.
+            m = group[0]
+            fold_loaders = [build_loaders(k, drop_last=True) for k in range(k_min, cfg.data_splits.k)]
+            runs = [create_run(m, k, loaders, epoch, tqdm_files[m]) for k, loaders in zip(range(k_min, cfg.data_splits.k), fold_loaders)]
+            # The progress file names the lowest unfinished fold, so that resuming continues every member
+            GroupProgress(cfg.models[m], runs)
+            cfg.load_from_checkpoint = False
+            run_epochs(runs, [loaders[0] for loaders in fold_loaders], vectorised=True)
+        else:
+            # Training loop for each fold
+            active = list(group)
+            for k in range(k_min, cfg.data_splits.k):
+                if not active:
                     break
-
-                epoch += 1
-
-                # Save best model
-                if average_val_loss < best_val_loss:
-                    best_val_loss = average_val_loss
-                    save_model(config=cfg, 
-                               model = model, 
-                               model_name=cfg.models[m], 
-                               fold=k, 
-                               epoch=epoch, 
-                               optimizer=optimizer, 
-                               lr_scheduler=lr_scheduler, 
-                               early_stopping=early_stopper, 
-                               train_loss=average_train_loss, 
-                               val_loss=best_val_loss, 
-                               is_best=True)
-        print_to_file(f"Model {cfg.models[m]} training finished", config=cfg, model_num=m)
+                # Best validation loss of every model on this fold; of an ensemble, that of its best member
+                scores = {}
+                training_models = list(active)
+                if run_index is not None:
+                    fingerprints = {m: unit_fingerprint(cfg, cfg.models[m], k, fold_data_fingerprint(dataset, k, cfg)) for m in active}
+                    for m in active:
+                        entry = run_index.lookup(fingerprints[m])
+                        if entry is None:
+                            continue
+                        # Identical unit trained before: reuse its checkpoint and results
+                        reuse_checkpoint(entry, cfg, cfg.models[m], k)
+                        scores[m] = entry['val_loss']
+                        training_models.remove(m)
+                        print_to_file(f"Fold {k} of model {cfg.models[m]} was already trained in {entry['training_name']}; reusing its checkpoint", config=cfg, model_num=m)
+                        if cfg.get("trial_report_path") and is_main_process():
+                            report_trial_result(cfg.trial_report_path, {'model': cfg.models[m], 'fold': k, 'epoch': entry['epoch'],
+                                                                        'step': entry['step'], 'val_loss': entry['val_loss'], 'full': True, 'reused': True})
+
+                if training_models:
+                    loaders = build_loaders(k)
+                    if ensemble_mode == "hyperparameters":
+                        # Vectorised ensemble of hyperparameter variants of one model, all reading the same batches
+                        m = group[0]
+                        runs = [create_run(m, k, loaders, epoch, tqdm_files[m], member=i, member_params=member_params)
+                                for i, member_params in enumerate(get_member_params(cfg))]
+                    else:
+                        runs = [create_run(m, k, loaders, epoch, tqdm_files[m]) for m in training_models]
+                    # The progress file names the group, so that resuming continues all of its runs
+                    GroupProgress(cfg.models[group[0]], runs)
+                    # Resuming only applies to the first fold trained
+                    cfg.load_from_checkpoint = False
+                    epoch = 0
+                    run_epochs(runs, [loaders[0]] * len(runs), vectorised=ensemble_mode == "hyperparameters")
+                    for m in training_models:
+                        scores[m] = min(run.best_val_loss for run in runs if run.m == m)
+
+                    if run_index is not None:
+                        for run in runs:
+                            metadata_path = f"{cfg.model_save_path}{run.name}/{run.name}_best_fold_{k}_metadata.json"
+                            if not os.path.exists(metadata_path):
+                                continue
+                            metadata = load_json(metadata_path)
+                            run_index.record(fingerprints[run.m], {
+                                'model_name': run.name, 'fold': k, 'training_name': cfg.training_name,
+                                'metadata_path': metadata_path, 'metadata_mtime_ns': os.stat(metadata_path).st_mtime_ns,
+                                'model_state_dict_path': metadata['model_state_dict_path'],
+                                'model_mtime_ns': os.stat(metadata['model_state_dict_path']).st_mtime_ns,
+                                'epoch': metadata['epoch'], 'step': metadata.get('step'), 'val_loss': run.best_val_loss})
+
+                if race is not None:
+                    for m in active:
+                        if scores.get(m, float('inf')) < float('inf'):
+                            race.record(cfg.models[m], k, scores[m])
+                    abandoned = race.eliminate([cfg.models[m] for m in active])
+                    race.save()
+                    for m in [m for m in active if cfg.models[m] in abandoned]:
+                        candidate = race.candidates[cfg.models[m]]
+                        print_to_file(f"Model {cfg.models[m]} is out of contention after fold {k} (mean val loss {race.mean_score(cfg.models[m])}, "
+                                      f"worse than {candidate['against']} with p = {candidate['p_value']:.4f}); skipping its remaining folds", config=cfg, model_num=m)
+                    active = [m for m in active if cfg.models[m] not in abandoned]
+        k_min, epoch_min = 0, 0
+        for m in group:
+            if race is not None:
+                race.finish(cfg.models[m])
+            print_to_file(f"Model {cfg.models[m]} training finished", config=cfg, model_num=m)
+        if race is not None:
+            race.save()
+    cleanup_distributed()
 
 # Example usage
 if __name__ == '__main__':
@@ -263,4 +610,6 @@ if __name__ == '__main__':
     try:
         train(args.input_data)
     except Exception as e:
-        print_to_file(f"Trainer function failed. Exiting with an error: {e}")
\ No newline at end of file
+        print_to_file(f"Trainer function failed. Exiting with an error: {e}")
+        # A non-zero exit code marks the run as failed, e.g. for the trials of a sweep
+        sys.exit(1)
\ No newline at end of file